@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+""" Compares the memory use and lookup latency of the object existence cache backends.
+
+Each measurement runs in a fresh process so the resident set sizes do not interfere:
+
+    python benchmarks/cache_benchmark.py --devices 100000 1000000 5000000
+"""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mnubo'))
+
+
+def rss_bytes():
+    """ Resident set size of the current process, from /proc (Linux only). """
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def measure(backend, devices, lookups):
+    from object_cache import build_object_cache
+
+    device_ids = ['thing-{0:010d}'.format(i) for i in range(devices)]
+    base_rss = rss_bytes()
+    # Budget the compact cache to the same number of devices with a 50% load factor.
+    cache = build_object_cache(backend, max_entries=devices, max_memory=devices * 24)
+    expires_at = int(time.time()) + 3600
+    start = time.time()
+    for device_id in device_ids:
+        cache.set(device_id, expires_at)
+    insert_time = time.time() - start
+    cache_rss = rss_bytes() - base_rss
+
+    sample = [random.choice(device_ids) for _ in range(lookups)]
+    hits = 0
+    start = time.time()
+    for device_id in sample:
+        if cache.get(device_id):
+            hits += 1
+    lookup_time = time.time() - start
+    return dict(backend=backend, devices=devices, cache_rss_mb=round(cache_rss / 1048576.0, 1),
+                insert_us=round(insert_time * 1e6 / devices, 2), lookup_us=round(lookup_time * 1e6 / lookups, 2),
+                hit_ratio=round(hits / float(lookups), 4))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, nargs='+', default=[100000, 1000000, 5000000])
+    parser.add_argument('--backends', nargs='+', default=['lru', 'compact'])
+    parser.add_argument('--lookups', type=int, default=100000)
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.child[0], int(args.child[1]), args.lookups)))
+        return
+
+    print('{0:>8} {1:>10} {2:>12} {3:>11} {4:>11} {5:>9}'.format(
+        'backend', 'devices', 'cache RSS MB', 'insert us', 'lookup us', 'hit ratio'))
+    for devices in args.devices:
+        for backend in args.backends:
+            out = subprocess.check_output([sys.executable, __file__, '--lookups', str(args.lookups),
+                                           '--child', backend, str(devices)])
+            r = json.loads(out.decode('utf-8'))
+            print('{backend:>8} {devices:>10} {cache_rss_mb:>12} {insert_us:>11} {lookup_us:>11} {hit_ratio:>9}'
+                  .format(**r))
+
+
+if __name__ == '__main__':
+    main()
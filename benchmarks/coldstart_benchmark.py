@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+""" Measures the cold start of the forwarder: the time to load the function and to forward the first event, each run
+in a fresh process against the local stand-ins of the SmartObjects and AWS IoT APIs (tests/stubs.py):
+
+    python benchmarks/coldstart_benchmark.py --runs 10
+
+The first event is sent for a device whose object exists (`existing`, the usual case) and for a device whose object
+must be created (`missing`, which needs the AWS IoT client). With `--importtime`, the modules taking the most time
+to import are listed instead, from `python -X importtime` (Python 3.7 and later):
+
+    python benchmarks/coldstart_benchmark.py --importtime
+"""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+MNUBO = os.path.join(ROOT, 'mnubo')
+sys.path.insert(0, ROOT)
+
+
+class Context(object):
+    function_name = 'benchmark'
+
+    def get_remaining_time_in_millis(self):
+        return 300000
+
+
+def first_event(device_id):
+    """ Loads the function and forwards a first event, in this fresh process. """
+    start = time.time()
+    sys.path.insert(0, MNUBO)
+    import lambda_mnubo_forwarder as forwarder
+    loaded = time.time()
+    forwarder.iot_custom_event_handler(dict(device_id=device_id, temperature=20.5), Context())
+    done = time.time()
+    return dict(load_ms=(loaded - start) * 1000, first_event_ms=(done - loaded) * 1000,
+                total_ms=(done - start) * 1000, boto3_loaded='boto3' in sys.modules)
+
+
+def measure(stub, device_id, warm_clients):
+    env = dict(os.environ, MNUBO_ENV=stub.url, IOT_API_ENDPOINT=stub.url, MNUBO_CLIENT_ID='id',
+               MNUBO_CLIENT_SECRET='secret', AWS_DEFAULT_REGION='us-east-1', AWS_ACCESS_KEY_ID='test',
+               AWS_SECRET_ACCESS_KEY='test', METRICS_ENABLED='0', WARM_CLIENTS='1' if warm_clients else '0')
+    start = time.time()
+    out = subprocess.check_output([sys.executable, __file__, '--child', device_id], env=env)
+    result = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+    result['process_ms'] = (time.time() - start) * 1000
+    return result
+
+
+def import_times(limit):
+    """ Lists the slowest modules imported by the function, from `python -X importtime`. """
+    env = dict(os.environ, METRICS_ENABLED='0', WARM_CLIENTS='0', PYTHONPATH=MNUBO)
+    p = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', 'import lambda_mnubo_forwarder'], env=env,
+                         stderr=subprocess.PIPE)
+    _, err = p.communicate()
+    rows = list()
+    for line in err.decode('utf-8').splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), int(own), len(name) - len(name.lstrip()) - 1, name.strip()))
+    total = [r for r in rows if r[3] == 'lambda_mnubo_forwarder']
+    print('Total: {0:.1f} ms'.format(total[0][0] / 1000.0 if total else 0.0))
+    print('{0:>10} {1:>10}  {2}'.format('cumul. ms', 'self ms', 'module (top level imports of the function)'))
+    for cumulative, own, depth, name in sorted((r for r in rows if r[2] == 2), reverse=True)[:limit]:
+        print('{0:>10.1f} {1:>10.1f}  {2}'.format(cumulative / 1000.0, own / 1000.0, name))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.01, help='Seconds added to each API call')
+    parser.add_argument('--importtime', action='store_true', help='List the slowest imports instead')
+    parser.add_argument('--limit', type=int, default=15, help='Number of modules listed by --importtime')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(first_event(args.child)))
+        return
+    if args.importtime:
+        import_times(args.limit)
+        return
+
+    from tests.stubs import StubServer
+    print('{0:>9} {1:>6} {2:>8} {3:>15} {4:>9} {5:>11} {6:>6}'.format(
+        'object', 'warm', 'load ms', 'first event ms', 'total ms', 'process ms', 'boto3'))
+    for case in ('existing', 'missing'):
+        for warm_clients in (True, False):
+            runs = list()
+            with StubServer(latency=args.latency) as stub:
+                for i in range(args.runs):
+                    device_id = '{0}-{1}'.format(case, i)
+                    stub.state.add_thing(device_id, 'sensor')
+                    if case == 'existing':
+                        stub.state.objects[device_id] = dict(x_device_id=device_id)
+                    runs.append(measure(stub, device_id, warm_clients))
+            median = dict((k, sorted(r[k] for r in runs)[len(runs) // 2])
+                          for k in ('load_ms', 'first_event_ms', 'total_ms', 'process_ms'))
+            print('{0:>9} {1:>6} {load_ms:>8.0f} {first_event_ms:>15.0f} {total_ms:>9.0f} {process_ms:>11.0f} {2:>6}'
+                  .format(case, 'yes' if warm_clients else 'no', 'yes' if runs[0]['boto3_loaded'] else 'no',
+                          **median))
+
+
+if __name__ == '__main__':
+    main()
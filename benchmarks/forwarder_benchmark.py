@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+""" Runs the batch handler against the local stand-ins of the SmartObjects and AWS IoT APIs (tests/stubs.py) and
+reports its throughput, latency, API calls and memory use for several workloads:
+
+* warm: the objects exist and are already in the object cache
+* cold: the objects exist but the cache is empty at each invocation, as in a new container
+* onboarding: every invocation brings new devices, whose objects must be created
+* high_cardinality: the events come from a large population of existing devices, most not cached yet
+
+Each workload runs in a fresh process, with the stubs in this one:
+
+    python benchmarks/forwarder_benchmark.py --latency 0.02 --output results.json
+    python benchmarks/forwarder_benchmark.py --latency 0.02 --compare results.json
+"""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import resource
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'mnubo'))
+sys.path.insert(0, ROOT)
+
+SCENARIOS = ['warm', 'cold', 'onboarding', 'high_cardinality']
+# Events per device in the warm, cold and onboarding workloads
+EVENTS_PER_DEVICE = 10
+
+
+def workload(scenario, args):
+    """ The devices of a workload, generated the same way in both processes.
+    :return: (device ids with an existing object, device ids in the thing registry, list of batches of device ids)
+    """
+    if scenario == 'onboarding':
+        per_batch = max(1, args.batch_size // EVENTS_PER_DEVICE)
+        batches = [['new-{0}-{1}'.format(i, j % per_batch) for j in range(args.batch_size)]
+                   for i in range(args.invocations)]
+        return list(), sorted(set(d for batch in batches for d in batch)), batches
+    if scenario == 'high_cardinality':
+        rng = random.Random(42)
+        devices = ['device-{0}'.format(i) for i in range(args.population)]
+        batches = [[devices[rng.randrange(args.population)] for _ in range(args.batch_size)]
+                   for _ in range(args.invocations)]
+        return devices, list(), batches
+    devices = ['device-{0}'.format(i) for i in range(max(1, args.batch_size // EVENTS_PER_DEVICE))]
+    batches = [[devices[j % len(devices)] for j in range(args.batch_size)] for _ in range(args.invocations)]
+    return devices, list(), batches
+
+
+def percentile(values, ratio):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(ratio * (len(ordered) - 1))))]
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1048576.0 if sys.platform == 'darwin' else 1024.0), 1)
+
+
+class Context(object):
+    function_name = 'benchmark'
+
+    def get_remaining_time_in_millis(self):
+        return 300000
+
+
+def run(scenario, args):
+    """ Runs a workload in this process, the stubs being in the parent process. """
+    import lambda_mnubo_forwarder as forwarder
+    from metrics import MetricsAggregator
+
+    _, _, batches = workload(scenario, args)
+    aggregator = MetricsAggregator()
+    forwarder.metrics.add_sink(aggregator)
+    if scenario == 'warm':
+        expires_at = int(time.time()) + 3600
+        forwarder.get_object_cache().set_many(dict((d, expires_at) for d in set(batches[0])))
+
+    context = Context()
+    latencies = list()
+    failures = 0
+    for i, batch in enumerate(batches):
+        if scenario == 'cold':
+            forwarder.global_cache = None
+        events = [dict(device_id=device_id, sequence=j, temperature=20.5) for j, device_id in enumerate(batch)]
+        start = time.time()
+        rc = forwarder.iot_custom_event_batch_handler(events, context)
+        latencies.append(time.time() - start)
+        failures += len(rc['batchItemFailures'])
+
+    events = sum(len(batch) for batch in batches)
+    return dict(scenario=scenario, events=events, failed_events=failures,
+                events_per_second=round(events / sum(latencies), 1),
+                p50_ms=round(percentile(latencies, 0.5) * 1000, 2), p99_ms=round(percentile(latencies, 0.99) * 1000, 2),
+                peak_rss_mb=peak_rss_mb(), stages=aggregator.totals())
+
+
+def measure(scenario, args):
+    """ Runs a workload in a fresh process, against fresh stubs. """
+    from tests.stubs import StubServer
+
+    objects, things, _ = workload(scenario, args)
+    with StubServer(latency=args.latency, error_rate=args.error_rate) as stub:
+        for device_id in objects:
+            stub.state.objects[device_id] = dict(x_device_id=device_id, x_object=dict(x_object_type='sensor'))
+        for device_id in things:
+            stub.state.add_thing(device_id, 'sensor', dict(model='m1'))
+        env = dict(os.environ, MNUBO_ENV=stub.url, IOT_API_ENDPOINT=stub.url, MNUBO_CLIENT_ID='id',
+                   MNUBO_CLIENT_SECRET='secret', AWS_DEFAULT_REGION='us-east-1', AWS_ACCESS_KEY_ID='test',
+                   AWS_SECRET_ACCESS_KEY='test', METRICS_ENABLED='0')
+        out = subprocess.check_output([sys.executable, __file__, '--child', scenario] + child_arguments(args), env=env)
+        result = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+        calls = sum(stub.state.calls.values())
+    result['api_calls'] = dict(stub.state.calls)
+    result['api_calls_per_event'] = round(calls / float(result['events']), 4)
+    return result
+
+
+def child_arguments(args):
+    return ['--batch-size', str(args.batch_size), '--invocations', str(args.invocations),
+            '--population', str(args.population)]
+
+
+def print_results(results, baseline=None):
+    print('{0:>16} {1:>10} {2:>9} {3:>9} {4:>11} {5:>8} {6:>7}'.format(
+        'scenario', 'events/s', 'p50 ms', 'p99 ms', 'calls/event', 'RSS MB', 'failed'))
+    for r in results:
+        print('{scenario:>16} {events_per_second:>10} {p50_ms:>9} {p99_ms:>9} {api_calls_per_event:>11} '
+              '{peak_rss_mb:>8} {failed_events:>7}'.format(**r))
+        previous = baseline.get(r['scenario'], None) if baseline else None
+        if previous is not None:
+            print('{0:>16} {1:>+9.1f}% {2:>+8.1f}% {3:>+8.1f}% {4:>+10.1f}% {5:>+7.1f}%'.format(
+                'vs baseline', *[100.0 * (r[k] - previous[k]) / previous[k] if previous[k] else 0.0
+                                 for k in ('events_per_second', 'p50_ms', 'p99_ms', 'api_calls_per_event',
+                                           'peak_rss_mb')]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--batch-size', type=int, default=500, help='Events per invocation')
+    parser.add_argument('--invocations', type=int, default=20)
+    parser.add_argument('--population', type=int, default=100000, help='Devices of the high_cardinality workload')
+    parser.add_argument('--latency', type=float, default=0.01, help='Seconds added to each API call')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Ratio of API calls answered with a 503')
+    parser.add_argument('--output', help='JSON file where the results are written')
+    parser.add_argument('--compare', help='JSON file of a previous run to compare with')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run(args.child, args)))
+        return
+
+    results = [measure(scenario, args) for scenario in args.scenarios]
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = dict((r['scenario'], r) for r in json.load(f)['results'])
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(timestamp=int(time.time()), python=platform.python_version(),
+                           parameters=dict(vars(args), output=None, compare=None), results=results),
+                      f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
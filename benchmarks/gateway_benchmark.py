@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+""" Measures how the throughput of the ingestion gateway (mnubo/gateway.py) scales with its number of worker
+processes. For each number of workers, a gateway is started against the local stand-ins of the SmartObjects and AWS
+IoT APIs (tests/stubs.py, in a process of their own), and `--clients` load generating processes post
+newline-delimited JSON requests of `--request-size` events to it for `--duration` seconds:
+
+    python benchmarks/gateway_benchmark.py --workers 1 2 4 8 --duration 20 --output results.json
+
+The events come from `--devices` devices whose objects exist. The first `--warmup` seconds, during which the workers
+fill their caches, are not measured. The load generators, the stubs and the gateway share the host: keep some cores
+for them, the scaling is otherwise limited by the host rather than by the gateway.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import random
+import socket
+import platform
+import argparse
+import subprocess
+import multiprocessing
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+
+def percentile(values, ratio):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(ratio * (len(ordered) - 1))))] if ordered else 0.0
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def serve_stubs(port, latency, devices, ready, stop, counts):
+    """ Runs the stubs until `stop` is set, then reports the number of events they received. """
+    from tests.stubs import StubServer
+    with StubServer(latency=latency, keep_events=False, port=port) as stub:
+        for i in range(devices):
+            device_id = 'device-{0}'.format(i)
+            stub.state.objects[device_id] = dict(x_device_id=device_id, x_object=dict(x_object_type='sensor'))
+        ready.set()
+        stop.wait()
+        counts.put(dict(events=stub.state.event_count, api_calls=dict(stub.state.calls)))
+
+
+def load(arguments):
+    """ Posts requests to the gateway until the end of the run, in a load generating process.
+    :return: (events acknowledged, events failed, latencies of the measured requests in seconds)
+    """
+    import requests
+    url, client, args = arguments
+    rng = random.Random(client)
+    bodies = list()
+    for _ in range(20):
+        lines = [json.dumps(dict(device_id='device-{0}'.format(rng.randrange(args.devices)), sequence=i,
+                                 temperature=round(rng.uniform(-10, 40), 2), timestamp=1500000000000 + i))
+                 for i in range(args.request_size)]
+        bodies.append('\n'.join(lines).encode('utf-8'))
+    session = requests.Session()
+    start = time.time()
+    measured = start + args.warmup
+    end = measured + args.duration
+    events = 0
+    failed = 0
+    latencies = list()
+    i = 0
+    while True:
+        before = time.time()
+        if before >= end:
+            break
+        r = session.post(url + '/events/custom', data=bodies[i % len(bodies)])
+        i += 1
+        after = time.time()
+        if before < measured:
+            continue
+        rc = r.json() if r.status_code == 200 else dict(records=args.request_size, failed=range(args.request_size))
+        events += rc['records'] - len(rc['failed'])
+        failed += len(rc['failed'])
+        latencies.append(after - before)
+    return events, failed, latencies
+
+
+def measure(workers, stub_url, args):
+    """ Runs a gateway with a number of workers and loads it. """
+    port = free_port()
+    env = dict(os.environ, MNUBO_ENV=stub_url, IOT_API_ENDPOINT=stub_url, MNUBO_CLIENT_ID='id',
+               MNUBO_CLIENT_SECRET='secret', AWS_DEFAULT_REGION='us-east-1', AWS_ACCESS_KEY_ID='test',
+               AWS_SECRET_ACCESS_KEY='test', METRICS_ENABLED='0', EVENTS_BATCH_SIZE=str(args.batch_size))
+    gateway = subprocess.Popen([sys.executable, os.path.join(ROOT, 'mnubo', 'gateway.py'), '--port', str(port),
+                                '--workers', str(workers), '--linger', str(args.linger)], env=env)
+    url = 'http://127.0.0.1:{0}'.format(port)
+    try:
+        import requests
+        for _ in range(600):
+            try:
+                if requests.get(url + '/health').status_code == 200:
+                    break
+            except requests.ConnectionError:
+                pass
+            time.sleep(0.1)
+        pool = multiprocessing.Pool(args.clients)
+        try:
+            results = pool.map(load, [(url, client, args) for client in range(args.clients)])
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        gateway.terminate()
+        gateway.wait()
+    events = sum(r[0] for r in results)
+    latencies = [latency for r in results for latency in r[2]]
+    return dict(workers=workers, events=events, failed_events=sum(r[1] for r in results),
+                events_per_second=round(events / float(args.duration), 1),
+                p50_ms=round(percentile(latencies, 0.5) * 1000, 2), p99_ms=round(percentile(latencies, 0.99) * 1000, 2))
+
+
+def print_results(results):
+    print('{0:>8} {1:>12} {2:>8} {3:>9} {4:>9} {5:>8}'.format(
+        'workers', 'events/s', 'speedup', 'p50 ms', 'p99 ms', 'failed'))
+    for r in results:
+        print('{workers:>8} {events_per_second:>12} {speedup:>8} {p50_ms:>9} {p99_ms:>9} {failed_events:>8}'.format(**r))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    cpus = multiprocessing.cpu_count()
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[n for n in (1, 2, 4, 8, 16, 32) if n <= max(1, cpus // 2)] or [1],
+                        help='Numbers of worker processes to measure')
+    parser.add_argument('--clients', type=int, default=max(2, cpus // 2), help='Number of load generating processes')
+    parser.add_argument('--request-size', type=int, default=200, help='Events per request')
+    parser.add_argument('--batch-size', type=int, default=1000, help='EVENTS_BATCH_SIZE of the gateway')
+    parser.add_argument('--linger', type=float, default=0.005, help='--linger of the gateway')
+    parser.add_argument('--devices', type=int, default=10000)
+    parser.add_argument('--duration', type=float, default=10, help='Seconds measured per number of workers')
+    parser.add_argument('--warmup', type=float, default=2, help='Seconds of load before the measure')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to each API call')
+    parser.add_argument('--output', help='JSON file where the results are written')
+    args = parser.parse_args()
+
+    port = free_port()
+    ready = multiprocessing.Event()
+    stop = multiprocessing.Event()
+    counts = multiprocessing.Queue()
+    stubs = multiprocessing.Process(target=serve_stubs, args=(port, args.latency, args.devices, ready, stop, counts))
+    stubs.start()
+    ready.wait()
+    try:
+        results = [measure(workers, 'http://127.0.0.1:{0}'.format(port), args) for workers in args.workers]
+    finally:
+        stop.set()
+        received = counts.get()
+        stubs.join()
+    for r in results:
+        r['speedup'] = round(r['events_per_second'] / results[0]['events_per_second'], 2) \
+            if results[0]['events_per_second'] else 0.0
+    print_results(results)
+    print('{0} events received by the stubs'.format(received['events']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(timestamp=int(time.time()), python=platform.python_version(), cpus=cpus,
+                           parameters=dict(vars(args), output=None), results=results, stubs=received),
+                      f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
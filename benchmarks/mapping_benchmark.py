@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+""" Measures the per-event cost of the mappers with 10, 100 and 1000 attributes, with a mapping and a blacklist
+covering 10% of the attributes each:
+
+    python benchmarks/mapping_benchmark.py
+"""
+
+from __future__ import print_function
+import os
+import sys
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mnubo'))
+
+import lambda_mnubo_forwarder as forwarder  # noqa: E402
+
+
+def configure(attributes):
+    """ Maps and blacklists 10% of the attributes each. """
+    names = ['attribute_{0}'.format(i) for i in range(attributes)]
+    forwarder.event_attributes_mapping.clear()
+    forwarder.event_attributes_mapping.update((k, 'mapped_' + k) for k in names[::10])
+    del forwarder.event_attributes_blacklist[:]
+    forwarder.event_attributes_blacklist.extend(names[5::10])
+    forwarder.smart_object_attributes_mapping.clear()
+    forwarder.smart_object_attributes_mapping.update(forwarder.event_attributes_mapping)
+    del forwarder.smart_object_attributes_blacklist[:]
+    forwarder.smart_object_attributes_blacklist.extend(forwarder.event_attributes_blacklist)
+    forwarder.compile_attribute_transformers()
+    return dict((k, float(i)) for i, k in enumerate(names))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--attributes', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--events', type=int, default=20000, help='Number of attributes mapped per measurement')
+    args = parser.parse_args()
+
+    print('{0:>10} {1:>14} {2:>14} {3:>14}'.format('attributes', 'iot event us', 'shadow us', 'thing us'))
+    for attributes in args.attributes:
+        payload = configure(attributes)
+        iot_event = dict(payload, device_id='thing-1', event_type='telemetry', timestamp=1500000000)
+        shadow = dict(device_id='thing-1', state=dict(reported=payload), metadata=dict(timestamp=1500000000))
+        thing = dict(thingName='thing-1', thingTypeName='sensor', attributes=payload)
+        number = max(args.events // attributes, 10)
+        results = list()
+        for mapper, event in ((forwarder.map_iot_event_to_mnubo_event, iot_event),
+                              (forwarder.map_shadow_update_to_mnubo_event, shadow),
+                              (forwarder.map_thing_to_smart_object, thing)):
+            if mapper is forwarder.map_thing_to_smart_object:
+                best = min(timeit.repeat(lambda: mapper(thing=event), number=number, repeat=5))
+            else:
+                best = min(timeit.repeat(lambda: mapper(event=event), number=number, repeat=5))
+            results.append(best * 1e6 / number)
+        print('{0:>10} {1:>14.2f} {2:>14.2f} {3:>14.2f}'.format(attributes, *results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+""" Measures the mapping throughput and memory allocations of large shadow update documents, with and without the
+defensive deep copy the handlers used to make before mapping:
+
+    python benchmarks/shadow_benchmark.py --attributes 50 200
+"""
+
+from __future__ import print_function
+import os
+import sys
+import copy
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mnubo'))
+
+import lambda_mnubo_forwarder as forwarder  # noqa: E402
+
+
+def shadow_document(attributes):
+    """ A shadow update accepted document: every reported value has its nested metadata. """
+    reported = dict()
+    metadata = dict()
+    for i in range(attributes):
+        name = 'sensor_{0}'.format(i)
+        if i % 5 == 0:
+            reported[name] = dict(value=float(i), unit='C', calibration=dict(offset=0.5, gain=[1.0, 0.98, 1.02]))
+            metadata[name] = dict(value=dict(timestamp=1500000000), unit=dict(timestamp=1500000000),
+                                  calibration=dict(offset=dict(timestamp=1500000000),
+                                                   gain=[dict(timestamp=1500000000)] * 3))
+        else:
+            reported[name] = float(i)
+            metadata[name] = dict(timestamp=1500000000)
+    return dict(device_id='thing-1', state=dict(reported=reported),
+                metadata=dict(reported=metadata, timestamp=1500000000), version=42, timestamp=1500000000)
+
+
+def run(mapper, event, deep_copy, events):
+    """ :return: (events per second, peak bytes allocated while mapping 100 events) """
+    start = time.time()
+    for _ in range(events):
+        mapper(event=copy.deepcopy(event) if deep_copy else event)
+    elapsed = time.time() - start
+
+    tracemalloc.start()
+    for _ in range(100):
+        mapper(event=copy.deepcopy(event) if deep_copy else event)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return events / elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--attributes', type=int, nargs='+', default=[50, 200])
+    parser.add_argument('--events', type=int, default=2000)
+    args = parser.parse_args()
+
+    print('{0:>10} {1:>10} {2:>12} {3:>16}'.format('attributes', 'deepcopy', 'events/s', 'peak alloc KB'))
+    for attributes in args.attributes:
+        event = shadow_document(attributes)
+        for deep_copy in (True, False):
+            rate, peak = run(forwarder.map_shadow_update_to_mnubo_event, event, deep_copy, args.events)
+            print('{0:>10} {1:>10} {2:>12.0f} {3:>16.1f}'.format(attributes, 'yes' if deep_copy else 'no', rate,
+                                                                 peak / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,8 +4,9 @@ set -e
 
 BUILD_IMAGE_NAME="lambda-packager:latest"
 
-docker build -t "${BUILD_IMAGE_NAME}" $(pwd)
-docker run --rm -ti -v "$(pwd):/data" "${BUILD_IMAGE_NAME}"
+docker build --build-arg PYTHON_VERSION="${PYTHON_VERSION:-3.11}" -t "${BUILD_IMAGE_NAME}" $(pwd)
+docker run --rm -ti -e PACKAGE_LAYER="${PACKAGE_LAYER:-0}" -v "$(pwd):/data" "${BUILD_IMAGE_NAME}"
 
 [ -d package-env ] && rm -fr package-env
+[ -d package-staging ] && rm -fr package-staging
 # End of file
\ No newline at end of file
@@ -2,32 +2,90 @@
 
 set -e
 
-DATA_DIR=/data
+DATA_DIR="${DATA_DIR:-/data}"
 PACKAGE_FILE="${DATA_DIR}/lambda_package.zip"
+LAYER_FILE="${DATA_DIR}/lambda_layer.zip"
+REPORT_FILE="${DATA_DIR}/package_report.json"
+# Set to 1 to put the dependencies in a Lambda layer instead of the function package
+PACKAGE_LAYER="${PACKAGE_LAYER:-0}"
+# Interpreter of the target Lambda runtime, set by the build image
+PYTHON="${PYTHON:-python3}"
+
+# Provided by the AWS Lambda runtime
+RUNTIME_PACKAGES="boto3 botocore s3transfer jmespath dateutil"
+# Backports of standard library modules, which would shadow the ones of the runtime
+BACKPORT_PACKAGES="dataclasses"
+# Only needed to build the virtualenv
+BUILD_PACKAGES="pip setuptools wheel pkg_resources easy_install.py _distutils_hack distutils-precedence.pth"
 
 cd ${DATA_DIR}
-virtualenv package-env
+rm -f ${PACKAGE_FILE} ${LAYER_FILE} ${REPORT_FILE}
+rm -fr package-env
+${PYTHON} -m venv package-env
 VENV_ROOT="${DATA_DIR}/package-env"
 source ${VENV_ROOT}/bin/activate
 
-pip install -r requirements.txt
+python -m pip install -r requirements.txt
+
+# Gather the dependencies in a staging folder, without the packages the function does not need at run time
+STAGING_DIR="${DATA_DIR}/package-staging"
+DEPS_DIR="${STAGING_DIR}/deps"
+FUNCTION_DIR="${STAGING_DIR}/function"
+rm -fr ${STAGING_DIR}
+mkdir -p ${DEPS_DIR} ${FUNCTION_DIR}
+for SITE_PACKAGES in ${VENV_ROOT}/lib/python*/site-packages ${VENV_ROOT}/lib64/python*/site-packages
+do
+    if [ -d "${SITE_PACKAGES}" ]
+    then
+        cp -r ${SITE_PACKAGES}/. ${DEPS_DIR}/
+    fi
+done
+
+cd ${DEPS_DIR}
+for PACKAGE in ${RUNTIME_PACKAGES} ${BACKPORT_PACKAGES} ${BUILD_PACKAGES}
+do
+    rm -fr ${PACKAGE} ${PACKAGE}.py ${PACKAGE}-*.dist-info ${PACKAGE}-*.egg-info
+done
+# Strip the metadata, tests, documentation and stale bytecode of the dependencies
+find . -depth -type d \( -name '*.dist-info' -o -name '*.egg-info' -o -name tests -o -name test -o -name docs \
+    -o -name __pycache__ \) -exec rm -fr {} +
+find . -type f \( -name '*.pyc' -o -name '*.pyo' -o -name '*.pyi' -o -name '*.md' -o -name '*.rst' \) -delete
 
-zip -9 ${PACKAGE_FILE} requirements.txt
+cp ${DATA_DIR}/mnubo/*.py ${FUNCTION_DIR}/
+# The package init and the command line tools are not used by the function
+rm -f ${FUNCTION_DIR}/__init__.py ${FUNCTION_DIR}/backfill.py ${FUNCTION_DIR}/gateway.py
 
-if [ -d "${VENV_ROOT}/lib/python2.7/site-packages" ]
+# Precompile with the target interpreter: the Lambda file system is read-only, so the bytecode of the modules would
+# otherwise be compiled again at every cold start. The bytecode is checked against a hash of the source rather than its
+# modification time, which the zip file does not keep to the second.
+${VENV_ROOT}/bin/python -m compileall -q --invalidation-mode checked-hash ${DEPS_DIR} ${FUNCTION_DIR}
+
+cd ${FUNCTION_DIR}
+zip -qr9 ${PACKAGE_FILE} .
+if [ "${PACKAGE_LAYER}" = "1" ]
 then
-    cd ${VENV_ROOT}/lib/python2.7/site-packages
-    zip -gr9 ${PACKAGE_FILE} *
+    # Lambda adds the python folder of the layers to the path
+    mv ${DEPS_DIR} ${STAGING_DIR}/python
+    cd ${STAGING_DIR}
+    zip -qr9 ${LAYER_FILE} python
+else
+    cd ${DEPS_DIR}
+    zip -qr9 ${PACKAGE_FILE} .
 fi
 
-if [ -d "${VENV_ROOT}/lib64/python2.7/site-packages" ]
+# Report the sizes, to track them over time
+cd ${DATA_DIR}
+if [ "${PACKAGE_LAYER}" = "1" ]
 then
-    cd ${VENV_ROOT}/lib64/python2.7/site-packages
-    zip -gr9 ${PACKAGE_FILE} *
+    PACKAGE_CONTENT="${FUNCTION_DIR}"
+    LAYER_REPORT=", \"layer_bytes\": $(stat -c %s ${LAYER_FILE}), \"layer_unpacked_bytes\": $(du -sb ${STAGING_DIR}/python | cut -f1)"
+else
+    PACKAGE_CONTENT="${FUNCTION_DIR} ${DEPS_DIR}"
+    LAYER_REPORT=""
 fi
+echo "{\"timestamp\": $(date +%s), \"package_bytes\": $(stat -c %s ${PACKAGE_FILE}), \"package_unpacked_bytes\": $(du -sbc ${PACKAGE_CONTENT} | tail -1 | cut -f1)${LAYER_REPORT}}" | tee ${REPORT_FILE}
 
+deactivate
+rm -fr ${STAGING_DIR}
 
-cd ${DATA_DIR}/mnubo
-zip -g9 ${PACKAGE_FILE} $(ls *.py | grep -v '__init__.py')
-
-# End of file
\ No newline at end of file
+# End of file
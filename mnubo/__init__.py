@@ -9,3 +9,56 @@ from lambda_mnubo_forwarder import mnubo_create_object
 from lambda_mnubo_forwarder import mnubo_object_exists
 from lambda_mnubo_forwarder import cached_mnubo_object_exists
 from lambda_mnubo_forwarder import get_thing_attributes
+from lambda_mnubo_forwarder import send_mnubo_events
+from lambda_mnubo_forwarder import extract_batch_records
+from lambda_mnubo_forwarder import decode_batch_record
+from lambda_mnubo_forwarder import mnubo_objects_exist
+from lambda_mnubo_forwarder import cached_mnubo_objects_exist
+from lambda_mnubo_forwarder import resolve_objects_exist
+from lambda_mnubo_forwarder import manage_missing_objects
+from lambda_mnubo_forwarder import resolve_owners_exist
+from object_cache import ObjectCache
+from object_cache import LRUObjectCache
+from object_cache import CompactObjectCache
+from object_cache import RedisObjectCache
+from object_cache import SqliteObjectCache
+from object_cache import TieredObjectCache
+from object_cache import build_object_cache
+from lambda_mnubo_forwarder import compile_attribute_transformers
+from attribute_transformer import AttributeTransformer
+from lambda_mnubo_forwarder import apply_mapping_config
+from lambda_mnubo_forwarder import refresh_mapping_config
+from mapping_config import parse_mapping_config
+from mapping_config import MappingConfigSource
+from forwarding_engine import ForwardingEngine
+from lambda_mnubo_forwarder import get_connection_stats
+from http_pooling import PooledHTTPAdapter
+from lambda_mnubo_forwarder import prefetch_things
+from throttling import AdaptiveBackoff
+from metrics import Metrics
+from metrics import EMFSink
+from metrics import MetricsAggregator
+from metrics import emf_document
+from timestamp_normalizer import normalize_timestamp
+from timestamp_normalizer import normalize_timestamps
+from event_batcher import EventBatcher
+from event_batcher import PayloadTooLarge
+from delivery import CircuitBreaker
+from delivery import CircuitOpen
+from delivery import DeliveryFailed
+from delivery import RetryPolicy
+from delivery import SpillQueue
+from delivery import DiskSpillQueue
+from delivery import SqsSpillQueue
+from delivery import build_spill_queue
+from lambda_mnubo_forwarder import replay_spilled_events
+from time_budget import CostEstimator
+from time_budget import TimeBudget
+from delta_filter import DeltaFilter
+from delta_filter import parse_deadbands
+from downsampling import WindowAggregator
+from downsampling import parse_reductions
+from downsampling import parse_default_reductions
+from object_cache import object_fingerprint
+from lambda_mnubo_forwarder import mnubo_update_objects
+from lambda_mnubo_forwarder import sync_objects
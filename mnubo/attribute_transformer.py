@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+
+class AttributeTransformer(object):
+    """ Attribute mapping and blacklist rules compiled into a single key to action table. Built once, then used to
+    split each payload in one pass into its well-known fields and its custom attributes.
+
+    The actions are, by key:
+    - well-known field: kept aside under its own name, the mapping and blacklist rules do not apply.
+    - blacklisted: dropped.
+    - mapped: renamed to its target name.
+    - anything else: passed through as-is.
+    """
+    def __init__(self, mapping=None, blacklist=None, well_known=None):
+        """
+        :param mapping: A dict of source attribute names to target attribute names
+        :param blacklist: A list of attribute names to drop
+        :param well_known: A list of field names handled by the mapper itself
+        """
+        self.well_known = frozenset(well_known or list())
+        actions = dict()
+        for k, v in (mapping or dict()).items():
+            actions[k] = v
+        # The blacklist wins over the mapping
+        for k in blacklist or list():
+            actions[k] = None
+        self.actions = actions
+
+    def transform(self, attributes):
+        """ Method to apply the rules to a payload. The payload is not modified.
+        :param attributes: The payload dict
+        :return: A (well-known fields dict, custom attributes dict) tuple
+        """
+        well_known = self.well_known
+        actions = self.actions
+        known = dict()
+        custom = dict()
+        for k, v in attributes.items():
+            if k in well_known:
+                known[k] = v
+                continue
+            target = actions.get(k, k)
+            if target is not None:
+                custom[target] = v
+        return known, custom
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+""" Command line tool to backfill or replay events, or a thing registry export, into the mnubo platform without going
+through the AWS Lambda functions. It is configured with the same environment variables as the functions:
+
+    python mnubo/backfill.py --mode custom --checkpoint replay.json events-2017-06-01.jsonl.gz
+    python mnubo/backfill.py --mode things --workers 16 registry-export.jsonl
+
+The inputs are newline-delimited JSON files, optionally gzipped. In the `custom` and `shadow` modes each line is an
+event, mapped like the batch handlers do and sent with the same pipeline: the missing objects are created and the
+events are sent in chunks, by `--workers` concurrent requests. In the `things` mode each line is a thing definition
+(as returned by describe-thing), created or updated as a SmartObject.
+
+The progress is saved in the checkpoint file after each batch: running the same command again resumes where it
+stopped. The records that could not be sent are appended to the failures file, which can be replayed in turn.
+"""
+
+from __future__ import print_function
+import io
+import os
+import sys
+import gzip
+import json
+import time
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import lambda_mnubo_forwarder as forwarder
+
+logger = logging.getLogger()
+
+GZIP_MAGIC = b'\x1f\x8b'
+READ_BUFFER_SIZE = 1024 * 1024
+
+MAPPERS = dict(custom=forwarder.map_iot_event_to_mnubo_event, shadow=forwarder.map_shadow_update_to_mnubo_event)
+
+
+def read_batches(path, batch_size, offset=0):
+    """ Method to read the lines of a newline-delimited JSON file in batches, without loading the whole file.
+    :param path: The path of the file, gzipped or not
+    :param batch_size: The maximum number of lines in a batch
+    :param offset: The position, in the uncompressed content, of the first line to read
+    :return: A generator of (offset after the batch, list of lines) tuples. Blank lines are skipped.
+    """
+    with io.open(path, 'rb', buffering=READ_BUFFER_SIZE) as raw:
+        f = gzip.GzipFile(fileobj=raw, mode='rb') if raw.peek(2)[:2] == GZIP_MAGIC else raw
+        if offset:
+            f.seek(offset)
+        batch = list()
+        for line in f:
+            offset += len(line)
+            if line.strip():
+                batch.append(line)
+            if len(batch) >= batch_size:
+                yield offset, batch
+                batch = list()
+        if batch:
+            yield offset, batch
+
+
+class Checkpoint(object):
+    """ The progress of a backfill by input file, saved after each batch so an interrupted backfill can resume. """
+    def __init__(self, path=None):
+        """
+        :param path: The path of the checkpoint file, None to not save the progress
+        """
+        self.path = path
+        self.progress = dict()
+        if path is not None and os.path.exists(path):
+            with open(path, 'r') as f:
+                self.progress = json.load(f)
+
+    def offset(self, input_path):
+        """ Method to get the position where the backfill of a file stopped.
+        :param input_path: The path of the input file
+        :return: The position in the uncompressed content, 0 if the file was not started
+        """
+        return self.progress.get(os.path.abspath(input_path), dict()).get('offset', 0)
+
+    def save(self, input_path, offset, records, failures):
+        """ Method to record the backfill of a batch.
+        :param input_path: The path of the input file
+        :param offset: The position after the batch
+        :param records: The number of records of the batch
+        :param failures: The number of records of the batch that could not be sent
+        """
+        entry = self.progress.setdefault(os.path.abspath(input_path), dict(offset=0, records=0, failures=0))
+        entry['offset'] = offset
+        entry['records'] += records
+        entry['failures'] += failures
+        if self.path is None:
+            return
+        # Write then rename, so an interruption never leaves a truncated checkpoint
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.progress, f)
+        os.rename(temp_path, self.path)
+
+
+class RateLimiter(object):
+    """ Spaces the batches so the records are sent at `rate` records per second on average. """
+    def __init__(self, rate):
+        """
+        :param rate: The maximum number of records per second, 0 for no limit
+        """
+        self.rate = rate
+        self.next_time = time.time()
+
+    def acquire(self, count):
+        """ Method to wait until `count` records can be sent.
+        :param count: The number of records about to be sent
+        """
+        if not self.rate:
+            return
+        now = time.time()
+        if self.next_time > now:
+            time.sleep(self.next_time - now)
+            now = self.next_time
+        self.next_time = max(self.next_time, now) + float(count) / self.rate
+
+
+def backfill_events(lines, mapper):
+    """ Method to map and send a batch of events with the batch handlers pipeline.
+    :param lines: The JSON lines of the events
+    :param mapper: The method used to map each event to a mnubo Event
+    :return: The lines that could not be sent
+    """
+    failed = list()
+    events = list()
+    event_lines = list()
+    for line in lines:
+        try:
+            events.append(json.loads(line.decode('utf-8')))
+            event_lines.append(line)
+        except ValueError:
+            logger.error('Invalid JSON line: {0}'.format(line[:200]))
+            failed.append(line)
+    rc = forwarder.forward_event_batch(event=events, mapper=mapper)
+    failed.extend(event_lines[int(failure['itemIdentifier'])] for failure in rc['batchItemFailures'])
+    return failed
+
+
+def backfill_things(lines, executor, workers):
+    """ Method to create or update the SmartObjects of a batch of thing definitions, using concurrent batch calls.
+    :param lines: The JSON lines of the thing definitions
+    :param executor: The executor making the calls
+    :param workers: The number of concurrent calls
+    :return: The lines that could not be sent
+    """
+    failed = list()
+    mnubo_objects = list()
+    object_lines = dict()
+    for line in lines:
+        try:
+            mnubo_object = forwarder.map_thing_to_smart_object(thing=json.loads(line.decode('utf-8')))
+            if mnubo_object.device_id is None:
+                raise ValueError('Missing thingName')
+        except Exception:
+            logger.exception('Could not map thing: {0}'.format(line[:200]))
+            failed.append(line)
+            continue
+        mnubo_objects.append(mnubo_object)
+        object_lines[mnubo_object.device_id] = line
+    if not mnubo_objects:
+        return failed
+
+    size = min(forwarder.config['objects_batch_size'], -(-len(mnubo_objects) // workers))
+    chunks = [mnubo_objects[start:start + size] for start in range(0, len(mnubo_objects), size)]
+    futures = [(chunk, executor.submit(forwarder.mnubo_create_objects, chunk)) for chunk in chunks]
+    for chunk, future in futures:
+        try:
+            errors = future.result()
+        except Exception:
+            logger.exception('Could not create {0} objects.'.format(len(chunk)))
+            errors = dict((o.device_id, 'Batch creation failed') for o in chunk)
+        for device_id, message in errors.items():
+            logger.error('Could not create object {0}: {1}'.format(device_id, message))
+            failed.append(object_lines[device_id])
+    return failed
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Backfill or replay events or thing registry exports into mnubo.')
+    parser.add_argument('inputs', nargs='+', help='Newline-delimited JSON files, optionally gzipped')
+    parser.add_argument('--mode', choices=['custom', 'shadow', 'things'], default='custom',
+                        help='custom MQTT topic events, shadow update documents or thing definitions')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Number of records read and sent at a time')
+    parser.add_argument('--workers', type=int, default=forwarder.config['max_in_flight'],
+                        help='Number of concurrent requests')
+    parser.add_argument('--rate', type=float, default=0, help='Maximum records per second, 0 for no limit')
+    parser.add_argument('--checkpoint', help='File where the progress is saved, to resume an interrupted backfill')
+    parser.add_argument('--failures', help='File where the records that could not be sent are appended')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """ Method to run the backfill.
+    :param argv: The command line arguments, sys.argv by default
+    :return: 0 if every record was sent, 1 if not
+    """
+    args = parse_args(argv)
+    if args.workers < 1 or args.batch_size < 1:
+        raise ValueError('--workers and --batch-size must be positive integers')
+    forwarder.config['max_in_flight'] = args.workers
+    # Keep the batches small enough for the rate limit not to be met in bursts
+    batch_size = max(1, min(args.batch_size, int(args.rate))) if args.rate else args.batch_size
+    checkpoint = Checkpoint(args.checkpoint)
+    limiter = RateLimiter(args.rate)
+    failures_file = io.open(args.failures, 'ab') if args.failures else None
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    records = 0
+    failures = 0
+    start = time.time()
+    try:
+        for path in args.inputs:
+            for offset, lines in read_batches(path, batch_size, checkpoint.offset(path)):
+                limiter.acquire(len(lines))
+                if args.mode == 'things':
+                    failed = backfill_things(lines, executor, args.workers)
+                else:
+                    failed = backfill_events(lines, MAPPERS[args.mode])
+                if failures_file is not None and failed:
+                    failures_file.writelines(line if line.endswith(b'\n') else line + b'\n' for line in failed)
+                    failures_file.flush()
+                checkpoint.save(path, offset, len(lines), len(failed))
+                records += len(lines)
+                failures += len(failed)
+                logger.info('{0}: {1} records, {2} failed, {3:.0f} records/s'
+                            .format(path, records, failures, records / max(time.time() - start, 1e-6)))
+    finally:
+        executor.shutdown(wait=True)
+        if failures_file is not None:
+            failures_file.close()
+    print('{0} records sent, {1} failed'.format(records - failures, failures))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import os
+import time
+import uuid
+import random
+import logging
+import threading
+
+logger = logging.getLogger()
+
+
+class CircuitOpen(Exception):
+    """ Raised instead of making a call while the circuit breaker is open. """
+    pass
+
+
+class DeliveryFailed(Exception):
+    """ Raised when events were neither accepted by the mnubo platform nor spilled. """
+    pass
+
+
+class CircuitBreaker(object):
+    """ Fails the calls fast once the backend has failed `failure_threshold` times in a row. After `reset_timeout`
+    seconds, a single trial call is let through: its success closes the circuit, its failure opens it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.time):
+        """
+        :param failure_threshold: Number of consecutive failures opening the circuit
+        :param reset_timeout: Seconds after which an open circuit lets a trial call through
+        :param clock: Method returning the current time in seconds
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """ Method to tell if a call can be made now.
+        :return: True if the circuit is closed, or if this call is the trial call of a half open circuit
+        """
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and self.clock() >= self.opened_at + self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                logger.info('Circuit closed.')
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and
+                                                 self.failures >= self.failure_threshold):
+                logger.warning('Circuit opened after {0} consecutive failures.'.format(self.failures))
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+
+
+class RetryPolicy(object):
+    """ Retries the calls failing with a transient error, with an exponential backoff and full jitter, as long as the
+    next attempt can start before the deadline. The calls go through an optional circuit breaker.
+    """
+    def __init__(self, is_retryable, breaker=None, max_attempts=4, initial_delay=0.1, max_delay=2.0,
+                 safety_margin=1.0, on_retry=None, clock=time.time, sleep=time.sleep):
+        """
+        :param is_retryable: Method taking an exception and returning True if it is a transient backend error
+        :param breaker: An optional CircuitBreaker
+        :param max_attempts: Maximum number of attempts of a call
+        :param initial_delay: Maximum delay in seconds before the second attempt, doubled for each next attempt
+        :param max_delay: Maximum delay in seconds between two attempts
+        :param safety_margin: Seconds kept before the deadline, no attempt starts after it
+        :param on_retry: Optional method called with the exception of each retried attempt
+        :param clock: Method returning the current time in seconds
+        :param sleep: Method waiting a number of seconds
+        """
+        self.is_retryable = is_retryable
+        self.breaker = breaker
+        self.max_attempts = max_attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.safety_margin = safety_margin
+        self.on_retry = on_retry
+        self.clock = clock
+        self.sleep = sleep
+
+    def call(self, fn, *args, **kwargs):
+        """ Method to make a call, retrying it while it fails with a transient error.
+        :param fn: The method to call, with the other arguments
+        :param deadline: Keyword argument, the time (as returned by the clock) after which no attempt is made. None
+        or missing for no deadline.
+        :return: The result of the call
+        """
+        deadline = kwargs.pop('deadline', None)
+        attempt = 1
+        while True:
+            if self.breaker is not None and not self.breaker.allow():
+                raise CircuitOpen('The mnubo platform is failing, the circuit is open.')
+            try:
+                rc = fn(*args, **kwargs)
+            except Exception as e:
+                if not self.is_retryable(e):
+                    # The backend answered, it is not failing
+                    if self.breaker is not None:
+                        self.breaker.record_success()
+                    raise
+                if self.breaker is not None:
+                    self.breaker.record_failure()
+                delay = random.uniform(0, min(self.max_delay, self.initial_delay * 2 ** (attempt - 1)))
+                if attempt >= self.max_attempts or \
+                        (deadline is not None and self.clock() + delay + self.safety_margin >= deadline):
+                    raise
+                logger.warning('Transient error, attempt {0} of {1}: {2}'.format(attempt, self.max_attempts, e))
+                if self.on_retry is not None:
+                    self.on_retry(e)
+                self.sleep(delay)
+                attempt += 1
+                continue
+            if self.breaker is not None:
+                self.breaker.record_success()
+            return rc
+
+
+class SpillQueue(object):
+    """ Base class of the durable queues keeping the event requests that could not be delivered, to replay them
+    later. The items are the JSON array bodies of the requests, as bytes.
+    """
+    def put(self, payload):
+        """ Method to store a request body.
+        :param payload: The JSON array of the events, as bytes
+        """
+        raise NotImplementedError()
+
+    def peek(self, limit):
+        """ Method to get the oldest request bodies, without removing them.
+        :param limit: The maximum number of bodies
+        :return: A list of (key, payload) tuples, the key being used to remove the body once replayed
+        """
+        raise NotImplementedError()
+
+    def remove(self, key):
+        """ Method to remove a replayed request body.
+        :param key: The key returned by peek
+        """
+        raise NotImplementedError()
+
+
+class DiskSpillQueue(SpillQueue):
+    """ Queue stored as one file per request body in a local directory. On AWS Lambda, it only lasts as long as the
+    container, use it for tests and local runs.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def put(self, payload):
+        # Named after the time so they are replayed in order, written aside and renamed so they are never partial
+        name = '{0:020d}-{1}.json'.format(int(time.time() * 1000000), uuid.uuid4().hex)
+        path = os.path.join(self.directory, name)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(payload)
+        os.rename(path + '.tmp', path)
+
+    def peek(self, limit):
+        rc = list()
+        for name in sorted(n for n in os.listdir(self.directory) if n.endswith('.json'))[:limit]:
+            try:
+                with open(os.path.join(self.directory, name), 'rb') as f:
+                    rc.append((name, f.read()))
+            except IOError:
+                # Replayed and removed by another process in the meantime
+                pass
+        return rc
+
+    def remove(self, key):
+        try:
+            os.remove(os.path.join(self.directory, key))
+        except OSError:
+            pass
+
+    def __len__(self):
+        return len([n for n in os.listdir(self.directory) if n.endswith('.json')])
+
+
+class SqsSpillQueue(SpillQueue):
+    """ Queue stored in an Amazon SQS queue, shared by all the Lambda containers. The bodies must fit in a message:
+    keep `events_max_bytes` below 256 KB when using it.
+    """
+    def __init__(self, queue_url, visibility_timeout=60):
+        import boto3
+        self.client = boto3.client('sqs')
+        self.queue_url = queue_url
+        self.visibility_timeout = visibility_timeout
+
+    def put(self, payload):
+        self.client.send_message(QueueUrl=self.queue_url, MessageBody=payload.decode('utf-8'))
+
+    def peek(self, limit):
+        rc = list()
+        while len(rc) < limit:
+            messages = self.client.receive_message(QueueUrl=self.queue_url,
+                                                   MaxNumberOfMessages=min(10, limit - len(rc)),
+                                                   VisibilityTimeout=self.visibility_timeout).get('Messages', list())
+            if not messages:
+                break
+            rc.extend((m['ReceiptHandle'], m['Body'].encode('utf-8')) for m in messages)
+        return rc
+
+    def remove(self, key):
+        self.client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=key)
+
+    def __len__(self):
+        attributes = self.client.get_queue_attributes(QueueUrl=self.queue_url,
+                                                      AttributeNames=['ApproximateNumberOfMessages'])
+        return int(attributes['Attributes']['ApproximateNumberOfMessages'])
+
+
+def build_spill_queue(backend, url=None):
+    """ Method to build the spill queue selected by the configuration.
+    :param backend: 'disk' or 'sqs', None to disable the spilling
+    :param url: The directory of the disk queue or the URL of the SQS queue
+    :return: A SpillQueue or None
+    """
+    if not backend:
+        return None
+    elif backend == 'disk':
+        return DiskSpillQueue(url or '/tmp/mnubo-spill')
+    elif backend == 'sqs':
+        if not url:
+            raise EnvironmentError('The sqs spill queue backend requires SPILL_QUEUE_URL')
+        return SqsSpillQueue(url)
+    raise EnvironmentError('Do not know about spill queue backend {0}'.format(backend))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import time
+import json
+import threading
+import six
+from lru import LRU
+
+NUMBER_TYPES = (float,) + six.integer_types
+
+
+def compact_value(value):
+    """ Method to reduce a value to what is needed to detect its changes: numbers are kept for the deadbands, other
+    values are hashed.
+    :param value: An attribute value
+    :return: A float, or the hash of the JSON encoding of the value
+    """
+    if isinstance(value, NUMBER_TYPES) and not isinstance(value, bool):
+        return float(value)
+    # The type is part of the hash so True and 1, or '1' and 1, are different values
+    return hash((type(value).__name__, json.dumps(value, sort_keys=True, default=str)))
+
+
+def parse_deadbands(text):
+    """ Method to parse the deadbands of the configuration.
+    :param text: A comma separated list of attribute:threshold pairs, like 'temperature:0.5,humidity:2'
+    :return: A dict of attribute name to threshold
+    """
+    rc = dict()
+    for pair in (text or '').split(','):
+        if not pair.strip():
+            continue
+        name, _, threshold = pair.rpartition(':')
+        if not name:
+            raise ValueError('Invalid deadband {0}, expected attribute:threshold'.format(pair))
+        rc[name.strip()] = float(threshold)
+    return rc
+
+
+class DeltaFilter(object):
+    """ Drops the attribute values that did not change since they were last forwarded for a device. The last forwarded
+    value of each attribute is kept in a compact form, for a bounded number of devices.
+
+    A numeric value is a change when it differs by at least its deadband from the last forwarded value, any difference
+    when it has no deadband. A value is forwarded anyway when it was last forwarded `keepalive` seconds ago or more, so
+    the platform still hears from the devices reporting steady values.
+    """
+    def __init__(self, max_devices=10000, keepalive=600, deadbands=None, clock=time.time):
+        """
+        :param max_devices: The maximum number of devices whose last values are kept
+        :param keepalive: Seconds after which an unchanged value is forwarded again, 0 to never forward it again
+        :param deadbands: A dict of attribute name to the minimum change of its numeric values
+        :param clock: Method returning the current time in seconds
+        """
+        if not isinstance(max_devices, int) or max_devices < 1:
+            raise ValueError('shadow_delta_max_devices must be a positive integer')
+        self.keepalive = keepalive
+        self.deadbands = deadbands or dict()
+        self.clock = clock
+        # Device id to a dict of attribute name to (compact value, time forwarded)
+        self.devices = LRU(max_devices)
+        self.lock = threading.Lock()
+        self.counts = dict(events=0, events_suppressed=0, values=0, values_suppressed=0)
+
+    def stats(self):
+        """ Method to return the amounts filtered so far.
+        :return: A dict with the numbers of `events` and `values` seen, and of `events_suppressed` (all their values
+        were unchanged) and `values_suppressed`
+        """
+        with self.lock:
+            return dict(self.counts)
+
+    def _changed(self, name, compact, last, now):
+        if last is None:
+            return True
+        if self.keepalive and now - last[1] >= self.keepalive:
+            return True
+        if isinstance(compact, float) and isinstance(last[0], float):
+            return abs(compact - last[0]) >= self.deadbands.get(name, 0.0) and compact != last[0]
+        return compact != last[0]
+
+    def apply(self, device_id, values):
+        """ Method to filter the values reported by a device, remembering the ones forwarded.
+        :param device_id: The device id
+        :param values: A dict of attribute name to value
+        :return: The dict of the values to forward, empty if none changed
+        """
+        now = self.clock()
+        rc = dict()
+        with self.lock:
+            last_values = self.devices.get(device_id, None)
+            if last_values is None:
+                last_values = dict()
+                self.devices[device_id] = last_values
+            for name, value in values.items():
+                compact = compact_value(value)
+                if self._changed(name, compact, last_values.get(name, None), now):
+                    rc[name] = value
+                    last_values[name] = (compact, now)
+            self.counts['events'] += 1
+            self.counts['values'] += len(values)
+            self.counts['values_suppressed'] += len(values) - len(rc)
+            if values and not rc:
+                self.counts['events_suppressed'] += 1
+        return rc
+
+    def forget(self, device_id):
+        """ Method to forget the values forwarded for a device, when they could not be delivered after all.
+        :param device_id: The device id
+        """
+        with self.lock:
+            if device_id in self.devices:
+                del self.devices[device_id]
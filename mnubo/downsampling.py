@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import re
+import math
+import time
+import datetime
+from collections import OrderedDict
+import six
+from smartobjects import Event
+from timestamp_normalizer import epoch_unit
+from timestamp_normalizer import get_numpy
+from timestamp_normalizer import NUMBER_TYPES
+from timestamp_normalizer import NUMERIC_STRING
+from timestamp_normalizer import SECONDS_LIMIT
+
+REDUCTIONS = ('last', 'min', 'max', 'mean', 'count')
+# Below this number of values, the reductions of an attribute are computed without NumPy
+NUMPY_MIN_VALUES = 256
+# ISO 8601 timestamps in UTC: the fraction and the time zone designator are optional
+ISO_UTC = re.compile(r'^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(\.\d+)?(Z|[+-]00:?00)?$')
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def check_reductions(reductions):
+    """ Method to check a list of reduction names.
+    :param reductions: A list of reduction names
+    :return: The list, unchanged
+    """
+    unknown = [r for r in reductions if r not in REDUCTIONS]
+    if not reductions or unknown:
+        raise ValueError('Invalid reductions {0}, expected reductions among {1}'
+                         .format('+'.join(reductions), ', '.join(REDUCTIONS)))
+    return reductions
+
+
+def parse_default_reductions(text):
+    """ Method to parse the reductions of the attributes without specific reductions in the configuration.
+    :param text: A list of reductions separated by '+', like 'mean+max'
+    :return: The list of the reductions
+    """
+    return check_reductions([r.strip() for r in (text or '').split('+') if r.strip()])
+
+
+def parse_reductions(text):
+    """ Method to parse the reductions of the configuration.
+    :param text: A comma separated list of attribute:reduction+reduction items, like 'temperature:mean+max,state:last'
+    :return: A dict of attribute name to the list of its reductions
+    """
+    rc = dict()
+    for item in (text or '').split(','):
+        if not item.strip():
+            continue
+        name, _, reductions = item.rpartition(':')
+        reductions = [r.strip() for r in reductions.split('+') if r.strip()]
+        if not name or not reductions or any(r not in REDUCTIONS for r in reductions):
+            raise ValueError('Invalid reductions {0}, expected attribute:reduction+reduction with reductions among {1}'
+                             .format(item, ', '.join(REDUCTIONS)))
+        rc[name.strip()] = reductions
+    return rc
+
+
+def epoch_seconds(ts):
+    """ Method to get the epoch second of a raw event timestamp.
+    :param ts: An epoch timestamp in any unit, as a number or a string of digits, or an ISO 8601 timestamp in UTC
+    :return: The epoch timestamp in seconds, None if it cannot be read
+    """
+    if isinstance(ts, six.string_types):
+        if NUMERIC_STRING.match(ts):
+            ts = float(ts)
+        else:
+            found = ISO_UTC.match(ts)
+            if found is None:
+                return None
+            moment = datetime.datetime.strptime(found.group(1), '%Y-%m-%dT%H:%M:%S')
+            return (moment - EPOCH).days * 86400 + (moment - EPOCH).seconds
+    if not isinstance(ts, NUMBER_TYPES) or isinstance(ts, bool):
+        return None
+    if isinstance(ts, float) and (math.isnan(ts) or math.isinf(ts)):
+        return None
+    second = ts // epoch_unit(ts)[1]
+    # The aggregated events are timestamped in seconds, which must not read as another unit
+    return second if abs(second) < SECONDS_LIMIT else None
+
+
+def reduce_columns(groups, values):
+    """ Method to compute the min, max, sum and count of the numeric values of an attribute, by group.
+    :param groups: The list of the group index of each value
+    :param values: The list of the values
+    :return: A dict of group index to a (min, max, sum, count) tuple, for the groups with values
+    """
+    np = get_numpy() if len(values) >= NUMPY_MIN_VALUES else False
+    if not np:
+        rc = dict()
+        for group, value in zip(groups, values):
+            found = rc.get(group, None)
+            if found is None:
+                rc[group] = (value, value, value, 1)
+            else:
+                rc[group] = (min(found[0], value), max(found[1], value), found[2] + value, found[3] + 1)
+        return rc
+    # Sort the values by group, then reduce the runs of each group at once
+    g = np.asarray(groups, dtype=np.int64)
+    order = np.argsort(g, kind='stable')
+    g = g[order]
+    v = np.asarray(values, dtype=np.float64)[order]
+    starts = np.flatnonzero(np.concatenate(([True], g[1:] != g[:-1])))
+    counts = np.diff(np.append(starts, len(g)))
+    return dict(zip(g[starts].tolist(), zip(np.minimum.reduceat(v, starts).tolist(),
+                                              np.maximum.reduceat(v, starts).tolist(),
+                                              np.add.reduceat(v, starts).tolist(), counts.tolist())))
+
+
+class WindowAggregator(object):
+    """ Downsamples the events of high frequency devices: the events of a device and event type are grouped in
+    tumbling windows of `window` seconds, and each window is replaced by a single event holding reductions of their
+    attribute values.
+
+    An attribute with a single reduction keeps its name, an attribute with several reductions gives one attribute
+    per reduction, named `<attribute>_<reduction>`. `min`, `max` and `mean` only apply to numbers, the other values
+    get their `last` value instead. The aggregated event is timestamped with the start of its window and gets the
+    last position reported in it.
+    """
+    def __init__(self, window, reductions=None, default_reductions=('last',), clock=time.time):
+        """
+        :param window: The length of the windows in seconds
+        :param reductions: A dict of attribute name to the list of its reductions
+        :param default_reductions: The reductions of the other attributes
+        :param clock: Method returning the current time in seconds, used for the events without timestamp
+        """
+        if not isinstance(window, six.integer_types) or window < 1:
+            raise ValueError('aggregation_window must be a positive integer')
+        self.window = window
+        self.reductions = reductions or dict()
+        self.default_reductions = check_reductions(list(default_reductions))
+        for attribute_reductions in self.reductions.values():
+            check_reductions(attribute_reductions)
+        self.clock = clock
+
+    def aggregate(self, items):
+        """ Method to aggregate mapped events.
+        :param items: A list of (identifier, mnubo Event) tuples, the events having their raw timestamps
+        :return: A list of (list of the identifiers, mnubo Event) tuples, one per window. The events whose timestamp
+        cannot be read are passed on their own.
+        """
+        now = int(self.clock())
+        windows = OrderedDict()
+        rc = list()
+        for identifier, event in items:
+            second = now if event.timestamp is None else epoch_seconds(event.timestamp)
+            if second is None:
+                rc.append(([identifier], event))
+                continue
+            key = (event.device_id, event.event_type, int(second - second % self.window))
+            windows.setdefault(key, list()).append((identifier, event))
+
+        # The values of each attribute, in the order of the events
+        columns = OrderedDict()
+        for group, window_events in enumerate(windows.values()):
+            for _, event in window_events:
+                for name, value in event.event_data.items():
+                    if value is not None:
+                        columns.setdefault(name, list()).append((group, value))
+        data = [dict() for _ in windows]
+        for name, column in columns.items():
+            self._reduce(name, column, data)
+
+        for (key, window_events), event_data in zip(windows.items(), data):
+            aggregated = Event()
+            aggregated.device_id, aggregated.event_type, aggregated.timestamp = key
+            for _, event in window_events:
+                if event.latitude is not None or event.longitude is not None:
+                    aggregated.latitude = event.latitude
+                    aggregated.longitude = event.longitude
+            aggregated.event_data = event_data
+            rc.append(([identifier for identifier, _ in window_events], aggregated))
+        return rc
+
+    def _reduce(self, name, column, data):
+        reductions = self.reductions.get(name, self.default_reductions)
+        single = len(reductions) == 1
+        last = dict()
+        counts = dict()
+        for group, value in column:
+            last[group] = value
+            counts[group] = counts.get(group, 0) + 1
+        numbers = [(group, value) for group, value in column
+                   if isinstance(value, NUMBER_TYPES) and not isinstance(value, bool)]
+        stats = dict()
+        if numbers and any(r in ('min', 'max', 'mean') for r in reductions):
+            stats = reduce_columns([g for g, _ in numbers], [v for _, v in numbers])
+            # Integers stay integers when they are all integers
+            if all(isinstance(v, six.integer_types) for _, v in numbers):
+                stats = dict((g, (int(s[0]), int(s[1]), s[2], s[3])) for g, s in stats.items())
+        for group in last:
+            found = stats.get(group, None)
+            for reduction in reductions:
+                key = name if single else '{0}_{1}'.format(name, reduction)
+                if reduction == 'count':
+                    data[group][key] = counts[group]
+                elif reduction == 'last' or found is None:
+                    data[group][key] = last[group]
+                elif reduction == 'min':
+                    data[group][key] = found[0]
+                elif reduction == 'max':
+                    data[group][key] = found[1]
+                elif reduction == 'mean':
+                    data[group][key] = found[2] / float(found[3])
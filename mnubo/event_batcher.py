@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import io
+import json
+import gzip
+import logging
+import threading
+
+logger = logging.getLogger()
+
+
+class PayloadTooLarge(Exception):
+    """ Raised by the post method of an EventBatcher when the request body was rejected for its size. """
+    pass
+
+
+def gzip_bytes(data, level):
+    """ Method to gzip a request body.
+    :param data: The bytes to compress
+    :param level: The compression level, from 1 (fastest) to 9 (smallest)
+    :return: The compressed bytes
+    """
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=level) as f:
+        f.write(data)
+    return out.getvalue()
+
+
+class EventBatcher(object):
+    """ Sends events in requests bounded by a number of events and by a size in bytes, instead of a number of events
+    only. Each event is serialized once: its bytes are used to size the chunks and are joined into the request bodies,
+    including when a chunk rejected for its size is split and sent again.
+    """
+    def __init__(self, post, max_events=1000, max_bytes=1048576, compress=False, compress_level=6, on_sent=None,
+                 spill=None, spillable=None):
+        """
+        :param post: Method taking a JSON array body and a flag telling if it is gzipped, posting it and returning the
+        list of the result dicts, in the order of the events. It raises PayloadTooLarge if the body is too large.
+        :param max_events: The maximum number of events in a request
+        :param max_bytes: The maximum size of the uncompressed JSON body of a request
+        :param compress: If True, gzip the request bodies
+        :param compress_level: The gzip compression level
+        :param on_sent: Optional method called after each request with its number of events, the size of its body
+        before and after compression
+        :param spill: Optional method storing the JSON array body of a request that could not be delivered, to send
+        it again later with resend. Its events are then not reported as failed.
+        :param spillable: Optional method taking the exception of a request that failed and returning True if the
+        request can succeed later, to spill it. The events of the other failed requests are reported as failed. All
+        the failed requests are spilled if missing.
+        """
+        if not isinstance(max_events, int) or max_events < 1:
+            raise ValueError('events_batch_size must be a positive integer')
+        if not isinstance(max_bytes, int) or max_bytes < 2:
+            raise ValueError('events_max_bytes must be an integer greater than 1')
+        self.post = post
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.compress_level = compress_level
+        self.on_sent = on_sent
+        self.spill = spill
+        self.spillable = spillable
+        self.lock = threading.Lock()
+        self.counts = dict(requests=0, events=0, payload_bytes=0, sent_bytes=0, split_requests=0,
+                           oversized_events=0, spilled_events=0)
+
+    def stats(self):
+        """ Method to return the amounts sent so far.
+        :return: A dict with the numbers of `requests` and `events`, the `payload_bytes` before compression, the
+        `sent_bytes` after compression, their `bytes_per_event` and the number of `split_requests`,
+        `oversized_events` and `spilled_events`
+        """
+        with self.lock:
+            rc = dict(self.counts)
+        rc['bytes_per_event'] = rc['sent_bytes'] / float(rc['events']) if rc['events'] else 0.0
+        return rc
+
+    def serialize(self, event):
+        return json.dumps(event, separators=(',', ':'), default=str).encode('utf-8')
+
+    def chunks(self, encoded):
+        """ Method to split serialized events into chunks within the limits, keeping their order.
+        :param encoded: A list of (index, bytes) tuples
+        :return: A list of lists of (index, bytes) tuples
+        """
+        rc = list()
+        chunk = list()
+        # The brackets of the JSON array
+        size = 2
+        for item in encoded:
+            # The comma separating the event from the previous one
+            item_size = len(item[1]) + (1 if chunk else 0)
+            if chunk and (len(chunk) >= self.max_events or size + item_size > self.max_bytes):
+                rc.append(chunk)
+                chunk = list()
+                size = 2
+                item_size = len(item[1])
+            chunk.append(item)
+            size += item_size
+        if chunk:
+            rc.append(chunk)
+        return rc
+
+    def send(self, events):
+        """ Method to send events.
+        :param events: A list of event dicts, as built by Event.build
+        :return: A list of the indexes (in events) of the events that were not accepted
+        """
+        failed = list()
+        encoded = list()
+        for i, event in enumerate(events):
+            data = self.serialize(event)
+            if len(data) + 2 > self.max_bytes:
+                logger.error('Event of {0} bytes larger than the {1} bytes limit.'.format(len(data), self.max_bytes))
+                failed.append(i)
+                with self.lock:
+                    self.counts['oversized_events'] += 1
+                continue
+            encoded.append((i, data))
+        for chunk in self.chunks(encoded):
+            failed.extend(self.send_chunk(chunk))
+        return sorted(failed)
+
+    def send_chunk(self, chunk):
+        """ Method to send a chunk of serialized events, splitting it in halves while it is rejected for its size.
+        :param chunk: A list of (index, bytes) tuples
+        :return: A list of the indexes of the events that were not accepted
+        """
+        payload = b'[' + b','.join(data for _, data in chunk) + b']'
+        body = gzip_bytes(payload, self.compress_level) if self.compress else payload
+        try:
+            results = self.post(body, self.compress)
+        except PayloadTooLarge:
+            if len(chunk) == 1:
+                logger.error('Event of {0} bytes rejected for its size.'.format(len(payload)))
+                return [chunk[0][0]]
+            with self.lock:
+                self.counts['split_requests'] += 1
+            half = len(chunk) // 2
+            return self.send_chunk(chunk[:half]) + self.send_chunk(chunk[half:])
+        except Exception as e:
+            logger.exception('Could not send a chunk of {0} events.'.format(len(chunk)))
+            if self.spill is not None and (self.spillable is None or self.spillable(e)):
+                try:
+                    self.spill(payload)
+                except Exception:
+                    logger.exception('Could not spill a chunk of {0} events.'.format(len(chunk)))
+                else:
+                    with self.lock:
+                        self.counts['spilled_events'] += len(chunk)
+                    return list()
+            return [index for index, _ in chunk]
+
+        with self.lock:
+            self.counts['requests'] += 1
+            self.counts['events'] += len(chunk)
+            self.counts['payload_bytes'] += len(payload)
+            self.counts['sent_bytes'] += len(body)
+        if self.on_sent is not None:
+            self.on_sent(len(chunk), len(payload), len(body))
+        # Results are reported in the same order as the events were sent.
+        failed = list()
+        for (index, _), result in zip(chunk, results or list()):
+            if result.get('result', None) != 'success':
+                logger.error('Event rejected by the mnubo platform: {0}'.format(result.get('message', None)))
+                failed.append(index)
+        return failed
+
+    def resend(self, payload):
+        """ Method to send again the body of a request that was spilled.
+        :param payload: The JSON array of the events, as bytes
+        :return: The number of events rejected by the mnubo platform, they are logged and dropped
+        """
+        body = gzip_bytes(payload, self.compress_level) if self.compress else payload
+        results = self.post(body, self.compress)
+        rejected = [r for r in results or list() if r.get('result', None) != 'success']
+        for result in rejected:
+            logger.error('Replayed event rejected by the mnubo platform: {0}'.format(result.get('message', None)))
+        return len(rejected)
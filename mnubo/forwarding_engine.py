@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from concurrent.futures import wait
+
+logger = logging.getLogger()
+
+
+class ForwardingEngine(object):
+    """ Pipelined forwarding of the events of a multi-record invocation, on a bounded pool of threads.
+
+    The existence of the objects is resolved in bulk first. The events of the devices whose object exists are sent
+    right away while the missing objects are created concurrently in batches, their events following as each batch
+    completes.
+    Each thread makes one request at a time, so `max_in_flight` bounds the number of concurrent requests.
+
+    The events of a device are always put in the chunks in their original order. When they span several chunks, a
+    chunk is only sent once the previous chunk holding events of the same device is done, so the order is kept for
+    each device. When a chunk fails as a whole, the later events of its devices are reported as failed without being
+    sent, so that none of them gets ahead of the failed ones.
+
+    With a TimeBudget, each batch of objects and each chunk of events only starts if it can be done in time. The
+    records of the batches and chunks not started are reported as failed, to be retried by the next invocation.
+    """
+    def __init__(self, resolve_existing, create_objects, send_events, max_in_flight=8, batch_size=1000,
+                 objects_batch_size=1000, budget=None):
+        """
+        :param resolve_existing: Method taking a list of device ids and returning a dict of device id to True if the
+        object exists, False if it doesn't
+        :param create_objects: Method taking a list of device ids, creating their objects and returning the set of
+        device ids that could not be created
+        :param send_events: Method taking a list of events, sending them and returning the indexes of the failed ones
+        :param max_in_flight: The maximum number of concurrent requests
+        :param batch_size: The maximum number of events sent in a single call
+        :param objects_batch_size: The maximum number of objects created in a single call
+        :param budget: An optional TimeBudget of the invocation
+        """
+        if not isinstance(max_in_flight, int) or max_in_flight < 1:
+            raise ValueError('max_in_flight must be a positive integer')
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise ValueError('events_batch_size must be a positive integer')
+        if not isinstance(objects_batch_size, int) or objects_batch_size < 1:
+            raise ValueError('objects_batch_size must be a positive integer')
+        self.resolve_existing = resolve_existing
+        self.create_objects = create_objects
+        self.send_events = send_events
+        self.max_in_flight = max_in_flight
+        self.batch_size = batch_size
+        self.objects_batch_size = objects_batch_size
+        self.budget = budget
+
+    def forward(self, items):
+        """ Method to forward mapped events.
+        :param items: A list of (item identifier, device id, event) tuples
+        :return: The list of the identifiers of the items that could not be forwarded
+        """
+        by_device = OrderedDict()
+        for identifier, device_id, event in items:
+            by_device.setdefault(device_id, list()).append((identifier, event))
+        if not by_device:
+            return list()
+
+        failures = list()
+        executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        try:
+            sender = _ChunkSender(executor, self.send_events, self.batch_size, self.budget)
+            try:
+                existing = self.resolve_existing(list(by_device.keys()))
+            except Exception:
+                logger.exception('Could not lookup {0} objects.'.format(len(by_device)))
+                return [identifier for device_events in by_device.values() for identifier, _ in device_events]
+
+            missing = list()
+            for device_id, device_events in by_device.items():
+                if existing.get(device_id, False):
+                    sender.add(device_id, device_events)
+                else:
+                    missing.append(device_id)
+            creations = dict()
+            for chunk in self._creation_chunks(missing):
+                creations[executor.submit(self._create, chunk, sum(len(by_device[d]) for d in chunk))] = chunk
+            for future in as_completed(creations):
+                chunk = creations[future]
+                try:
+                    failed = future.result()
+                except Exception:
+                    logger.exception('Could not manage {0} objects.'.format(len(chunk)))
+                    failed = chunk
+                for device_id in chunk:
+                    if device_id in failed:
+                        failures.extend(identifier for identifier, _ in by_device[device_id])
+                    else:
+                        sender.add(device_id, by_device[device_id])
+            failures.extend(sender.finish())
+        finally:
+            executor.shutdown(wait=True)
+        return failures
+
+    def _create(self, device_ids, records):
+        """ Method to create a batch of objects if the budget allows it.
+        :param device_ids: The device ids of the missing objects
+        :param records: The number of events of these devices
+        :return: The set of device ids that could not be created
+        """
+        if self.budget is None:
+            return self.create_objects(device_ids)
+        if not self.budget.admit('create_objects', len(device_ids)):
+            self.budget.defer(records)
+            return set(device_ids)
+        start = self.budget.clock()
+        failed = self.create_objects(device_ids)
+        self.budget.record('create_objects', len(device_ids), self.budget.clock() - start)
+        return failed
+
+    def _creation_chunks(self, device_ids):
+        """ Method to split the missing devices in batches, spread on the threads but never larger than
+        `objects_batch_size`.
+        :param device_ids: The list of the device ids of the missing objects
+        :return: A list of lists of device ids
+        """
+        if not device_ids:
+            return list()
+        size = min(self.objects_batch_size, -(-len(device_ids) // self.max_in_flight))
+        return [device_ids[start:start + size] for start in range(0, len(device_ids), size)]
+
+
+class _ChunkSender(object):
+    """ Fills the chunks of events and sends them on the executor, keeping the order of the events of each device. """
+    def __init__(self, executor, send_events, batch_size, budget=None):
+        self.executor = executor
+        self.send_events = send_events
+        self.batch_size = batch_size
+        self.budget = budget
+        self.chunk = list()
+        self.chunk_devices = set()
+        # The last chunk sent for each device
+        self.last_sent = dict()
+        self.sent = list()
+        # The devices of the chunks that failed as a whole, their later events are not sent. True when the chunk was
+        # refused by the budget, so the later events are deferred too.
+        self.failed_devices = dict()
+        self.lock = threading.Lock()
+
+    def add(self, device_id, device_events):
+        for identifier, event in device_events:
+            self.chunk.append((identifier, device_id, event))
+            self.chunk_devices.add(device_id)
+            if len(self.chunk) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        if not self.chunk:
+            return
+        dependencies = set(self.last_sent[d] for d in self.chunk_devices if d in self.last_sent)
+        future = self.executor.submit(self._send, dependencies, self.chunk)
+        for device_id in self.chunk_devices:
+            self.last_sent[device_id] = future
+        self.sent.append(future)
+        self.chunk = list()
+        self.chunk_devices = set()
+
+    def _fail_devices(self, chunk, deferred=False):
+        with self.lock:
+            for _, device_id, _ in chunk:
+                self.failed_devices.setdefault(device_id, deferred)
+        return [identifier for identifier, _, _ in chunk]
+
+    def _send(self, dependencies, chunk):
+        # The dependencies were submitted before this chunk: they are already running or done.
+        wait(dependencies)
+        with self.lock:
+            skipped = [entry for entry in chunk if entry[1] in self.failed_devices]
+            if skipped:
+                chunk = [entry for entry in chunk if entry[1] not in self.failed_devices]
+                if self.budget is not None:
+                    self.budget.defer(sum(1 for entry in skipped if self.failed_devices[entry[1]]))
+            skipped = [identifier for identifier, _, _ in skipped]
+        if not chunk:
+            return skipped
+        if self.budget is not None:
+            # Checked once the previous chunks of the devices are done: a smaller chunk could still be admitted, so
+            # the devices of a refused chunk are failed too
+            if not self.budget.admit('send_events', len(chunk)):
+                self.budget.defer(len(chunk))
+                return skipped + self._fail_devices(chunk, deferred=True)
+            start = self.budget.clock()
+        try:
+            failed = self.send_events([event for _, _, event in chunk])
+        except Exception:
+            logger.exception('Could not send a chunk of {0} events.'.format(len(chunk)))
+            return skipped + self._fail_devices(chunk)
+        if self.budget is not None:
+            self.budget.record('send_events', len(chunk), self.budget.clock() - start)
+        return skipped + [chunk[i][0] for i in failed]
+
+    def finish(self):
+        """ Method to send the last chunk and wait for all the chunks.
+        :return: The identifiers of the events that could not be sent
+        """
+        self.flush()
+        failures = list()
+        for future in self.sent:
+            failures.extend(future.result())
+        return failures
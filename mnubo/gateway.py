@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+""" Long-running ingestion gateway: runs the forwarder as a persistent service instead of AWS Lambda functions, for
+the highest volumes. It is configured with the same environment variables as the functions:
+
+    python mnubo/gateway.py --port 8080 --workers 4
+
+The events are posted to `/events/custom` or `/events/shadow`, as a JSON array, a single JSON object or
+newline-delimited JSON objects, optionally gzipped. An AWS IoT rule HTTP action, or an MQTT bridge posting the
+messages of a topic, can send them. The gateway answers once the events are forwarded, with the number of `records`
+and the positions of the `failed` ones, to be posted again.
+
+The events are sharded by device id across `--workers` processes. Each worker owns the object existence, thing and
+shadow caches of its devices and its pooled clients, and forwards the events with the batch handlers pipeline. The
+requests waiting for a worker are coalesced into batches of up to `--max-batch` events, waiting at most `--linger`
+seconds for more.
+"""
+
+from __future__ import print_function
+import io
+import sys
+import gzip
+import json
+import zlib
+import time
+import signal
+import logging
+import argparse
+import itertools
+import threading
+import multiprocessing
+from six.moves.queue import Empty
+from six.moves.BaseHTTPServer import HTTPServer
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
+
+import lambda_mnubo_forwarder as forwarder
+
+logger = logging.getLogger()
+
+MAPPERS = dict(custom=forwarder.map_iot_event_to_mnubo_event, shadow=forwarder.map_shadow_update_to_mnubo_event)
+ROUTES = {'/events/custom': 'custom', '/events/shadow': 'shadow'}
+
+
+def shard_of(event, shards):
+    """ Method to get the worker owning the device of an event. The hash is stable across processes and restarts.
+    :param event: An event dict
+    :param shards: The number of workers
+    :return: The index of the worker, 0 for the events without device id
+    """
+    device_id = event.get('device_id', None) if isinstance(event, dict) else None
+    if device_id is None:
+        return 0
+    return (zlib.crc32(u'{0}'.format(device_id).encode('utf-8')) & 0xffffffff) % shards
+
+
+def parse_events(body):
+    """ Method to read the events of a request body.
+    :param body: A JSON array, a JSON object or newline-delimited JSON objects, as bytes
+    :return: The list of the events. The lines of newline-delimited JSON that cannot be read are returned as None, to be
+    reported as failed.
+    """
+    text = body.decode('utf-8')
+    try:
+        doc = json.loads(text)
+    except ValueError:
+        if text.lstrip().startswith('['):
+            raise
+    else:
+        return doc if isinstance(doc, list) else [doc]
+    events = list()
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        try:
+            events.append(json.loads(line))
+        except ValueError:
+            logger.error('Invalid JSON line: {0}'.format(line[:200]))
+            events.append(None)
+    return events
+
+
+def next_batch(tasks, linger, max_batch, timeout):
+    """ Method to wait for the next requests of a worker, coalescing the ones already waiting and the ones arriving
+    within `linger` seconds.
+    :param tasks: The queue of the worker
+    :param linger: The maximum number of seconds to wait for more requests once one is received
+    :param max_batch: The number of events after which no more requests are coalesced
+    :param timeout: The maximum number of seconds to wait for a first request
+    :return: A (list of (request id, mode, list of (position, event) tuples) tasks, True if the worker must stop) tuple
+    """
+    batch = list()
+    try:
+        task = tasks.get(timeout=timeout)
+    except Empty:
+        return batch, False
+    deadline = time.time() + linger
+    count = 0
+    while task is not None:
+        batch.append(task)
+        count += len(task[2])
+        if count >= max_batch:
+            return batch, False
+        remaining = deadline - time.time()
+        try:
+            task = tasks.get(timeout=remaining) if remaining > 0 else tasks.get_nowait()
+        except Empty:
+            return batch, False
+    return batch, True
+
+
+def forward_tasks(batch):
+    """ Method to forward the events of coalesced requests, in one batch per mode.
+    :param batch: A list of (request id, mode, list of (position, event) tuples) tasks
+    :return: A list of (request id, list of the positions of the events that could not be forwarded) tuples, one per
+    task
+    """
+    failed = dict((request_id, list()) for request_id, _, _ in batch)
+    for mode, mapper in MAPPERS.items():
+        origins = list()
+        events = list()
+        for request_id, task_mode, items in batch:
+            if task_mode != mode:
+                continue
+            for position, event in items:
+                origins.append((request_id, position))
+                events.append(event)
+        if not events:
+            continue
+        if mode == 'shadow':
+            options = dict(suppress_unchanged=forwarder.config['shadow_delta_suppression'])
+        else:
+            options = dict(aggregate=forwarder.config['aggregation_window'] > 0)
+        try:
+            rc = forwarder.forward_event_batch(event=events, mapper=mapper, **options)
+            identifiers = [int(f['itemIdentifier']) for f in rc['batchItemFailures']]
+        except Exception:
+            logger.exception('Could not forward {0} events.'.format(len(events)))
+            identifiers = range(len(events))
+        for identifier in identifiers:
+            request_id, position = origins[identifier]
+            failed[request_id].append(position)
+    return list(failed.items())
+
+
+def run_worker(shard, tasks, results, config, linger, max_batch, metrics_interval):
+    """ Method run by the worker processes: forwards the events of a shard until it gets None.
+    :param shard: The index of the worker
+    :param tasks: The queue of the requests of the worker
+    :param results: The queue where the (request id, failed positions) results are put
+    :param config: The forwarder configuration
+    :param linger: See next_batch
+    :param max_batch: See next_batch
+    :param metrics_interval: The number of seconds between two flushes of the metrics
+    """
+    # Stopped by the gateway process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    forwarder.config.update(config)
+    # The clients of the gateway process must not be shared
+    forwarder.mnubo_client = None
+    forwarder.iot_client = None
+    if forwarder.config['warm_clients']:
+        forwarder.warm_clients()
+    next_flush = time.time() + metrics_interval
+    stop = False
+    while not stop:
+        batch, stop = next_batch(tasks, linger, max_batch, timeout=max(next_flush - time.time(), 0.01))
+        if batch:
+            forwarder.refresh_mapping_config()
+            # The spilled events are sent first, but the replay can stop early: they may arrive after newer ones
+            forwarder.replay_spilled_events()
+            for result in forward_tasks(batch):
+                results.put(result)
+        if stop or time.time() >= next_flush:
+            forwarder.metrics.flush(FunctionName='gateway', Worker=str(shard))
+            next_flush = time.time() + metrics_interval
+
+
+class _PendingRequest(object):
+    """ A request waiting for the results of the workers its events were sent to. """
+    def __init__(self, shards):
+        self.remaining = shards
+        self.failed = list()
+        self.done = threading.Event()
+
+
+class Router(object):
+    """ Sends the events of each request to the workers owning their devices, and collects their results. """
+    def __init__(self, tasks, results):
+        """
+        :param tasks: The queues of the workers
+        :param results: The queue where the workers put their results
+        """
+        self.tasks = tasks
+        self.results = results
+        self.lock = threading.Lock()
+        self.pending = dict()
+        self.ids = itertools.count()
+        self.thread = threading.Thread(target=self._collect)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def forward(self, mode, events, timeout):
+        """ Method to forward the events of a request.
+        :param mode: 'custom' or 'shadow'
+        :param events: A list of events
+        :param timeout: The maximum number of seconds to wait for the workers
+        :return: The sorted positions of the events that could not be forwarded, all of them on timeout
+        """
+        shards = dict()
+        for position, event in enumerate(events):
+            shards.setdefault(shard_of(event, len(self.tasks)), list()).append((position, event))
+        if not shards:
+            return list()
+        request = _PendingRequest(len(shards))
+        with self.lock:
+            request_id = next(self.ids)
+            self.pending[request_id] = request
+        for shard, items in shards.items():
+            self.tasks[shard].put((request_id, mode, items))
+        if not request.done.wait(timeout):
+            with self.lock:
+                self.pending.pop(request_id, None)
+            logger.error('No result after {0}s for {1} events.'.format(timeout, len(events)))
+            return list(range(len(events)))
+        return sorted(request.failed)
+
+    def _collect(self):
+        while True:
+            result = self.results.get()
+            if result is None:
+                return
+            request_id, failed = result
+            with self.lock:
+                request = self.pending.get(request_id, None)
+                if request is None:
+                    # Timed out
+                    continue
+                request.failed.extend(failed)
+                request.remaining -= 1
+                if request.remaining == 0:
+                    del self.pending[request_id]
+                    request.done.set()
+
+    def stop(self):
+        self.results.put(None)
+        self.thread.join()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, doc):
+        data = json.dumps(doc).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self._reply(404, dict(message='Unknown route'))
+        gateway = self.server.gateway
+        alive = len([w for w in gateway.processes if w.is_alive()])
+        return self._reply(200 if alive == len(gateway.processes) else 503,
+                           dict(workers=len(gateway.processes), alive=alive))
+
+    def do_POST(self):
+        length = int(self.headers.get('content-length', 0))
+        body = self.rfile.read(length) if length else b''
+        mode = ROUTES.get(self.path.split('?')[0], None)
+        if mode is None:
+            return self._reply(404, dict(message='Unknown route'))
+        try:
+            if self.headers.get('content-encoding', None) == 'gzip':
+                body = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+            events = parse_events(body)
+        except (IOError, ValueError) as e:
+            return self._reply(400, dict(message='Invalid body: {0}'.format(e)))
+        gateway = self.server.gateway
+        failed = gateway.router.forward(mode, events, gateway.timeout)
+        return self._reply(200, dict(records=len(events), failed=failed))
+
+
+class Gateway(object):
+    """ The HTTP endpoint, in this process, and the worker processes forwarding the events. """
+    def __init__(self, host='127.0.0.1', port=8080, workers=None, linger=0.005, max_batch=None, timeout=30.0,
+                 metrics_interval=60.0):
+        """
+        :param host: The address the endpoint listens on
+        :param port: The port the endpoint listens on, 0 for a random port
+        :param workers: The number of worker processes, the number of CPUs by default
+        :param linger: See next_batch
+        :param max_batch: See next_batch, `events_batch_size` by default
+        :param timeout: The maximum number of seconds a request waits for the workers
+        :param metrics_interval: The number of seconds between two flushes of the metrics of a worker
+        """
+        self.workers = workers or multiprocessing.cpu_count()
+        if not isinstance(self.workers, int) or self.workers < 1:
+            raise ValueError('workers must be a positive integer')
+        self.linger = linger
+        self.max_batch = max_batch or forwarder.config['events_batch_size']
+        self.timeout = timeout
+        self.metrics_interval = metrics_interval
+        self.server = _ThreadingHTTPServer((host, port), _Handler)
+        self.server.gateway = self
+        self.url = 'http://{0}:{1}'.format(host, self.server.server_address[1])
+        self.queues = list()
+        self.processes = list()
+        self.router = None
+        self.thread = None
+
+    def start(self):
+        """ Method to start the workers, then the endpoint in a background thread. """
+        results = multiprocessing.Queue()
+        for shard in range(self.workers):
+            tasks = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_worker,
+                                              args=(shard, tasks, results, dict(forwarder.config), self.linger,
+                                                    self.max_batch, self.metrics_interval))
+            process.daemon = True
+            process.start()
+            self.queues.append(tasks)
+            self.processes.append(process)
+        self.router = Router(self.queues, results)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info('Gateway listening on {0} with {1} workers.'.format(self.url, self.workers))
+        return self
+
+    def stop(self):
+        """ Method to stop the endpoint, then the workers once they forwarded the events they received. """
+        self.server.shutdown()
+        self.server.server_close()
+        for tasks in self.queues:
+            tasks.put(None)
+        for process in self.processes:
+            process.join()
+        self.router.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Forward the events posted over HTTP to mnubo.')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='Number of worker processes')
+    parser.add_argument('--linger', type=float, default=0.005,
+                        help='Seconds a worker waits for more requests to coalesce')
+    parser.add_argument('--max-batch', type=int, default=forwarder.config['events_batch_size'],
+                        help='Number of events after which a worker stops coalescing requests')
+    parser.add_argument('--timeout', type=float, default=30, help='Seconds a request waits for the workers')
+    parser.add_argument('--metrics-interval', type=float, default=60,
+                        help='Seconds between two flushes of the metrics of a worker')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """ Method to run the gateway until it is interrupted or terminated.
+    :param argv: The command line arguments, sys.argv by default
+    """
+    args = parse_args(argv)
+    gateway = Gateway(host=args.host, port=args.port, workers=args.workers, linger=args.linger,
+                      max_batch=args.max_batch, timeout=args.timeout, metrics_interval=args.metrics_interval)
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    gateway.start()
+    try:
+        while not stopping.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    logger.info('Stopping the gateway.')
+    gateway.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import socket
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+
+def keepalive_socket_options(keepalive):
+    """ Method to build the socket options of the pooled connections.
+    :param keepalive: If True, enable TCP keep-alive so idle pooled connections survive between invocations
+    :return: A list of socket options
+    """
+    options = list(HTTPConnection.default_socket_options)
+    if keepalive:
+        options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+    return options
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """ A requests adapter with a configurable connection pool size, default timeouts and TCP keep-alive. """
+    def __init__(self, pool_size=10, connect_timeout=None, read_timeout=None, keepalive=True, max_retries=0):
+        """
+        :param pool_size: Maximum number of connections kept open by host
+        :param connect_timeout: Default connection timeout in seconds, None to wait forever
+        :param read_timeout: Default read timeout in seconds, None to wait forever
+        :param keepalive: If True, enable TCP keep-alive on the connections
+        :param max_retries: Number of retries of the failed connections
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.socket_options = keepalive_socket_options(keepalive)
+        super(PooledHTTPAdapter, self).__init__(pool_connections=pool_size, pool_maxsize=pool_size,
+                                                max_retries=max_retries)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = self.socket_options
+        return super(PooledHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout', None) is None:
+            kwargs['timeout'] = self.timeout
+        return super(PooledHTTPAdapter, self).send(request, **kwargs)
+
+
+def pool_manager_stats(pool_manager):
+    """ Method to count the connections opened and the requests made through an urllib3 pool manager.
+    :param pool_manager: An urllib3 PoolManager
+    :return: A dict with the `connections` and `requests` counts
+    """
+    connections = 0
+    requests = 0
+    for key in list(pool_manager.pools.keys()):
+        pool = pool_manager.pools.get(key)
+        if pool is not None:
+            connections += pool.num_connections
+            requests += pool.num_requests
+    return dict(connections=connections, requests=requests)
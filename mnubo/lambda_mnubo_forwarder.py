@@ -1,64 +1,287 @@
 #!/usr/bin/env python
 
 from __future__ import print_function
+import time
+# When the function started to load, to log how long it took
+load_start = time.time()
 import os
 import logging
-import re
-import time
-import copy
-import datetime
+import json
+import base64
+import threading
+import requests
 from lru import LRU
+from object_cache import ObjectCache
+from object_cache import build_object_cache
+from object_cache import object_fingerprint
+from attribute_transformer import AttributeTransformer
+from mapping_config import MappingConfigSource
+from forwarding_engine import ForwardingEngine
+from event_batcher import EventBatcher
+from event_batcher import PayloadTooLarge
+from delivery import CircuitBreaker
+from delivery import CircuitOpen
+from delivery import DeliveryFailed
+from delivery import RetryPolicy
+from delivery import build_spill_queue
+from time_budget import CostEstimator
+from time_budget import TimeBudget
+from delta_filter import DeltaFilter
+from delta_filter import parse_deadbands
+from downsampling import WindowAggregator
+from downsampling import parse_reductions
+from downsampling import parse_default_reductions
+from http_pooling import PooledHTTPAdapter
+from http_pooling import pool_manager_stats
+from throttling import AdaptiveBackoff
+from metrics import Metrics
+from metrics import EMFSink
+from metrics import clock as metrics_clock
+from timestamp_normalizer import normalize_timestamp
+from timestamp_normalizer import normalize_timestamps
 from smartobjects import SmartObjectsClient
 from smartobjects import Environments
 from smartobjects import SmartObject
 from smartobjects import Event
-import boto3
 
 
 # Global variables
 global_cache = None
+# Devices whose object is missing and could not be created, to their retry timestamp
+negative_cache = None
+# Object creations in progress, by device id
+pending_creations = dict()
+pending_creations_lock = threading.Lock()
+# Stage timers, counters and payload sizes of the current invocation
+metrics = Metrics()
 
 # Mnubo config
 config = dict(
     environment=None,
     client_id=os.environ.get('MNUBO_CLIENT_ID', None),
     client_secret=os.environ.get('MNUBO_CLIENT_SECRET', None),
+    iot_endpoint=os.environ.get('IOT_API_ENDPOINT', None),
+    http_pool_size=int(os.environ.get('HTTP_POOL_SIZE', 10)),
+    http_connect_timeout=float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5)),
+    http_read_timeout=float(os.environ.get('HTTP_READ_TIMEOUT', 30)),
+    http_keepalive=os.environ.get('HTTP_KEEPALIVE', '1') == '1',
+    iot_max_attempts=int(os.environ.get('IOT_MAX_ATTEMPTS', 5)),
+    warm_clients=os.environ.get('WARM_CLIENTS', '1') == '1',
+    warm_iot_client=os.environ.get('WARM_IOT_CLIENT', '0') == '1',
+    iot_throttling_max_attempts=int(os.environ.get('IOT_THROTTLING_MAX_ATTEMPTS', 5)),
+    metrics_enabled=os.environ.get('METRICS_ENABLED', '1') == '1',
+    metrics_namespace=os.environ.get('METRICS_NAMESPACE', 'mnubo/forwarder'),
+    owner_cache_max_entries=int(os.environ.get('OWNER_CACHE_MAX_ENTRIES', 10000)),
+    thing_cache_max_entries=int(os.environ.get('THING_CACHE_MAX_ENTRIES', 10000)),
+    thing_cache_validity_period=int(os.environ.get('THING_CACHE_VALIDITY_PERIOD', 300)),
+    thing_prefetch_threshold=int(os.environ.get('THING_PREFETCH_THRESHOLD', 0)),
+    thing_prefetch_types=[t for t in os.environ.get('THING_PREFETCH_TYPES', '').split(',') if t],
+    thing_prefetch_max_pages=int(os.environ.get('THING_PREFETCH_MAX_PAGES', 40)),
     use_object_cache=bool(os.environ.get('USE_OBJECT_CACHE', 1)),
     cache_max_entries=int(os.environ.get('CACHE_MAX_ENTRIES', 1000000)),
-    cache_validity_period=int(os.environ.get('CACHE_VALIDITY_PERIOD', 3600))
+    cache_validity_period=int(os.environ.get('CACHE_VALIDITY_PERIOD', 3600)),
+    mapping_config_file=os.environ.get('MAPPING_CONFIG_FILE', None),
+    mapping_config_check_interval=int(os.environ.get('MAPPING_CONFIG_CHECK_INTERVAL', 60)),
+    cache_max_memory=int(os.environ.get('CACHE_MAX_MEMORY_MB', 64)) * 1024 * 1024,
+    cache_backend=os.environ.get('OBJECT_CACHE_BACKEND', 'lru'),
+    cache_url=os.environ.get('OBJECT_CACHE_URL', None),
+    cache_local_tier=os.environ.get('OBJECT_CACHE_LOCAL_TIER', '1') == '1',
+    events_batch_size=int(os.environ.get('EVENTS_BATCH_SIZE', 1000)),
+    events_max_bytes=int(os.environ.get('EVENTS_MAX_BYTES', 1048576)),
+    events_compression=os.environ.get('EVENTS_COMPRESSION', '0') == '1',
+    events_compression_level=int(os.environ.get('EVENTS_COMPRESSION_LEVEL', 6)),
+    delivery_max_attempts=int(os.environ.get('DELIVERY_MAX_ATTEMPTS', 4)),
+    delivery_initial_delay=float(os.environ.get('DELIVERY_INITIAL_DELAY', 0.1)),
+    delivery_max_delay=float(os.environ.get('DELIVERY_MAX_DELAY', 2)),
+    delivery_safety_margin=float(os.environ.get('DELIVERY_SAFETY_MARGIN', 1)),
+    circuit_failure_threshold=int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 5)),
+    circuit_reset_timeout=float(os.environ.get('CIRCUIT_RESET_TIMEOUT', 30)),
+    spill_queue_backend=os.environ.get('SPILL_QUEUE_BACKEND', None),
+    spill_queue_url=os.environ.get('SPILL_QUEUE_URL', None),
+    spill_replay_max_batches=int(os.environ.get('SPILL_REPLAY_MAX_BATCHES', 10)),
+    time_budget_enabled=os.environ.get('TIME_BUDGET_ENABLED', '1') == '1',
+    time_budget_safety_margin=float(os.environ.get('TIME_BUDGET_SAFETY_MARGIN', 3)),
+    shadow_delta_suppression=os.environ.get('SHADOW_DELTA_SUPPRESSION', '0') == '1',
+    shadow_delta_max_devices=int(os.environ.get('SHADOW_DELTA_MAX_DEVICES', 10000)),
+    shadow_delta_keepalive=int(os.environ.get('SHADOW_DELTA_KEEPALIVE', 600)),
+    shadow_deadbands=parse_deadbands(os.environ.get('SHADOW_DEADBANDS', '')),
+    aggregation_window=int(os.environ.get('AGGREGATION_WINDOW', 0)),
+    aggregation_reductions=parse_reductions(os.environ.get('AGGREGATION_REDUCTIONS', '')),
+    aggregation_default_reductions=parse_default_reductions(os.environ.get('AGGREGATION_DEFAULT_REDUCTIONS', 'last')),
+    objects_batch_size=int(os.environ.get('OBJECTS_BATCH_SIZE', 1000)),
+    attribute_sync=os.environ.get('ATTRIBUTE_SYNC', '0') == '1',
+    max_in_flight=int(os.environ.get('MAX_IN_FLIGHT_REQUESTS', 8)),
+    negative_cache_max_entries=int(os.environ.get('NEGATIVE_CACHE_MAX_ENTRIES', 10000)),
+    negative_cache_validity_period=int(os.environ.get('NEGATIVE_CACHE_VALIDITY_PERIOD', 60))
 )
 
 # Mnubo SmartObjects Client
 mnubo_client = None
 # AWS IoT Client
 iot_client = None
+# Adaptive backoff of the AWS IoT API calls
+iot_backoff = None
+# Thing definitions, by device id
+thing_cache = None
+# Owner existence, by username
+owner_cache = None
+# Size-aware batcher of the outbound events
+event_batcher = None
+# Retries and circuit breaker of the outbound events, shared by the invocations of the container
+delivery_policy = None
+# Durable queue of the events that could not be delivered, False when disabled
+spill_queue = None
+# Time after which the current invocation must not start new calls, None outside the handlers
+invocation_deadline = None
+# Time taken per record by the forwarding stages, learnt across the invocations
+cost_estimator = None
+# Last shadow values forwarded, by device id
+shadow_delta_filter = None
+# Downsampling of the custom events of the batch invocations
+window_aggregator = None
+# Timestamp after which the thing definitions can be prefetched again
+next_thing_prefetch = 0
 
 SHADOW_UPDATE_EVENT_TYPE = os.environ.get('SHADOW_UPDATE_DEFAULT_EVENT_TYPE', 'shadow_update')
 IOT_MQTT_EVENT_TYPE = os.environ.get('IOT_MQTT_DEFAULT_EVENT_TYPE', 'aws_iot_event')
 
-# TODO: Find a way to take the event attribute mapping data from a configuration file
+# The attribute mapping and blacklist variables. They are loaded from the MAPPING_CONFIG_FILE file when it is set.
 event_attributes_mapping = dict()
-# TODO: Find a way to take the event attribute blacklist data from a configuration file
 event_attributes_blacklist = list()
-# TODO: Find a way to take the smart object attribute mapping data from a configuration file
 smart_object_attributes_mapping = dict()
-# TODO: Find a way to take the smart object attribute blacklist data from a configuration file
 smart_object_attributes_blacklist = list()
+# Additional rules by event type and by thing type, merged with the variables above.
+event_type_rules = dict()
+thing_type_rules = dict()
+
+# Fields handled by the mappers themselves, the attribute mapping and blacklist do not apply to them.
+THING_WELL_KNOWN_ATTRIBUTES = ['owner_username', 'latitude', 'last_update', 'longitude', 'registration_date',
+                               'timestamp']
+SHADOW_WELL_KNOWN_ATTRIBUTES = ['event_id', 'latitude', 'longitude']
+IOT_EVENT_WELL_KNOWN_ATTRIBUTES = ['event_type', 'timestamp', 'device_id', 'event_id', 'latitude', 'longitude']
+
+# Attribute transformers compiled by compile_attribute_transformers, by event type or thing type. The None key holds
+# the transformer of the types without specific rules.
+smart_object_transformers = dict()
+shadow_transformers = dict()
+iot_event_transformers = dict()
+
+# The mapping configuration file, see refresh_mapping_config
+mapping_config_source = None
 
 # Initialize the logger
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
+def reset_state():
+    """
+    Method to drop the clients, caches and policies kept across the invocations, so that they are created again from
+    the current config, and the metrics not flushed yet. The mapping and the metrics sinks are kept.
+    :return:
+    """
+    global mnubo_client, iot_client, iot_backoff, global_cache, negative_cache, thing_cache, owner_cache
+    global event_batcher, delivery_policy, spill_queue, invocation_deadline, cost_estimator, shadow_delta_filter
+    global window_aggregator, next_thing_prefetch
+    mnubo_client = None
+    iot_client = None
+    iot_backoff = None
+    global_cache = None
+    negative_cache = None
+    thing_cache = None
+    owner_cache = None
+    event_batcher = None
+    delivery_policy = None
+    spill_queue = None
+    invocation_deadline = None
+    cost_estimator = None
+    shadow_delta_filter = None
+    window_aggregator = None
+    next_thing_prefetch = 0
+    with pending_creations_lock:
+        pending_creations.clear()
+    metrics.reset()
+
+
+def compile_attribute_transformers():
+    """ Method to compile the attribute mapping and blacklist variables into the transformers used by the mappers.
+    Must be called again when these variables are modified.
+    """
+    global smart_object_transformers
+    global shadow_transformers
+    global iot_event_transformers
+
+    def merged(mapping, blacklist, rules, prefix):
+        # The type specific mapping overrides the global one, the blacklists add up
+        mapping = dict(mapping)
+        mapping.update(rules.get(prefix + '_mapping', dict()))
+        return mapping, list(blacklist) + list(rules.get(prefix + '_blacklist', list()))
+
+    smart_object = dict()
+    for type_name, rules in [(None, dict())] + list(thing_type_rules.items()):
+        mapping, blacklist = merged(smart_object_attributes_mapping, smart_object_attributes_blacklist, rules,
+                                    'smart_object_attributes')
+        smart_object[type_name] = AttributeTransformer(mapping=mapping, blacklist=blacklist,
+                                                       well_known=THING_WELL_KNOWN_ATTRIBUTES)
+    shadow = dict()
+    iot_event = dict()
+    for type_name, rules in [(None, dict())] + list(event_type_rules.items()):
+        mapping, blacklist = merged(event_attributes_mapping, event_attributes_blacklist, rules, 'event_attributes')
+        shadow[type_name] = AttributeTransformer(mapping=mapping, blacklist=blacklist,
+                                                 well_known=SHADOW_WELL_KNOWN_ATTRIBUTES)
+        iot_event[type_name] = AttributeTransformer(mapping=mapping, blacklist=blacklist,
+                                                    well_known=IOT_EVENT_WELL_KNOWN_ATTRIBUTES)
+    smart_object_transformers = smart_object
+    shadow_transformers = shadow
+    iot_event_transformers = iot_event
+
+
+def apply_mapping_config(doc):
+    """ Method to replace the attribute mapping and blacklist variables with the content of a mapping configuration
+    document, and compile them.
+    :param doc: The mapping configuration dict, see parse_mapping_config
+    """
+    event_attributes_mapping.clear()
+    event_attributes_mapping.update(doc.get('event_attributes_mapping', dict()))
+    event_attributes_blacklist[:] = doc.get('event_attributes_blacklist', list())
+    smart_object_attributes_mapping.clear()
+    smart_object_attributes_mapping.update(doc.get('smart_object_attributes_mapping', dict()))
+    smart_object_attributes_blacklist[:] = doc.get('smart_object_attributes_blacklist', list())
+    event_type_rules.clear()
+    event_type_rules.update(doc.get('event_types', dict()))
+    thing_type_rules.clear()
+    thing_type_rules.update(doc.get('thing_types', dict()))
+    compile_attribute_transformers()
+
+
+def refresh_mapping_config():
+    """ Method to reload the mapping configuration file if it changed. The file is checked at most once every
+    `mapping_config_check_interval` seconds. To be called at the beginning of each invocation. A configuration that
+    cannot be loaded is logged and the current rules are kept.
+    """
+    global mapping_config_source
+    if config['mapping_config_file'] is None:
+        return
+    if mapping_config_source is None:
+        mapping_config_source = MappingConfigSource(location=config['mapping_config_file'],
+                                                    check_interval=config['mapping_config_check_interval'])
+    try:
+        doc = mapping_config_source.poll()
+    except Exception:
+        logger.exception('Could not reload the mapping configuration: {0}'.format(config['mapping_config_file']))
+        return
+    if doc is not None:
+        logger.info('Loading the mapping configuration: {0}'.format(config['mapping_config_file']))
+        apply_mapping_config(doc)
+
+
 def standardize_timestamp(ts):
     """ Utility method to convert a timestamp to a ISO format if it can.
-    :param ts: timestamp in epoch format. Will try any number as long as it's not None or a string.
+    :param ts: timestamp in epoch format, in seconds, milliseconds, microseconds or nanoseconds (detected from its
+    magnitude). Strings of digits are epochs too, other strings are left as they are.
     :return: timestamp in ISO format or a String passed to it or None
     """
-    if ts is not None and not isinstance(ts, str):
-        return datetime.datetime.utcfromtimestamp(ts).isoformat()
-    else:
-        return ts
+    return normalize_timestamp(ts)
 
 
 def mnubo_object_exists(device_id):
@@ -67,119 +290,688 @@ def mnubo_object_exists(device_id):
     :return: True if it exists, false if it doesn't
     """
     c = get_mnubo_client()
-    if c.objects.object_exists(device_id):
+    with metrics.timer('object_exists'):
+        exists = c.objects.object_exists(device_id)
+    if exists:
         return True
     else:
         return False
 
 
-def cached_mnubo_object_exists(device_id):
-    """ Method to wrap the object existence checking in a cached object
-    :param device_id: The device id of the object
-    :return: True of the object exists or False if it doesn't
+def get_object_cache():
+    """ Method to return the object existence cache and initialize it if not initialized
+    :return: The ObjectCache of device ids to expiration timestamps
     """
     global global_cache
     global config
-    now = int(time.time())
 
-    if not isinstance(global_cache, LRU):
-        if not isinstance(config['cache_max_entries'], int):
-            raise ValueError('cache_max_entries must be an integer')
-        global_cache = LRU(config['cache_max_entries'])
+    if not isinstance(global_cache, ObjectCache):
+        global_cache = build_object_cache(backend=config['cache_backend'],
+                                          max_entries=config['cache_max_entries'],
+                                          max_memory=config['cache_max_memory'],
+                                          url=config['cache_url'],
+                                          local_tier=config['cache_local_tier'])
 
     if not isinstance(config['cache_validity_period'], int):
         raise ValueError('cache_validity_period must be an integer')
+    return global_cache
 
-    found = global_cache.get(device_id, None)
+
+def cached_mnubo_object_exists(device_id):
+    """ Method to wrap the object existence checking in a cached object
+    :param device_id: The device id of the object
+    :return: True of the object exists or False if it doesn't
+    """
+    cache = get_object_cache()
+    now = int(time.time())
+
+    found = cache.get(device_id)
     if found and found > now:
+        metrics.increment('object_cache_hits')
         rc = True
     else:
+        metrics.increment('object_cache_misses')
         rc = mnubo_object_exists(device_id)
         if rc:
-            global_cache[device_id] = now + config['cache_validity_period']
+            cache.set(device_id, now + config['cache_validity_period'])
+    return rc
+
+
+def mnubo_objects_exist(device_ids):
+    """ Method to lookup many objects on the mnubo platform using bulk calls of at most `objects_batch_size` ids.
+    :param device_ids: A list of distinct device ids
+    :return: A dict of device id to True if it exists, False if it doesn't
+    """
+    c = get_mnubo_client()
+    batch_size = config['objects_batch_size']
+    if not isinstance(batch_size, int) or batch_size < 1:
+        raise ValueError('objects_batch_size must be a positive integer')
+    found = dict()
+    for start in range(0, len(device_ids), batch_size):
+        with metrics.timer('object_exists'):
+            found.update(c.objects.objects_exist(device_ids[start:start + batch_size]))
+    return dict((device_id, bool(found.get(device_id, False))) for device_id in device_ids)
+
+
+def cached_mnubo_objects_exist(device_ids):
+    """ Method to resolve the existence of many objects at once. Duplicates are removed, the cache is checked in one
+    pass and only the misses are looked up on the mnubo platform.
+    :param device_ids: An iterable of device ids, duplicates allowed
+    :return: A dict of device id to True if it exists, False if it doesn't
+    """
+    cache = get_object_cache()
+    now = int(time.time())
+
+    device_ids = list(set(device_ids))
+    cached = cache.get_many(device_ids)
+    rc = dict()
+    misses = list()
+    for device_id in device_ids:
+        found = cached.get(device_id, None)
+        if found and found > now:
+            rc[device_id] = True
+        else:
+            misses.append(device_id)
+    metrics.increment('object_cache_hits', len(rc))
+    metrics.increment('object_cache_misses', len(misses))
+    if misses:
+        found = mnubo_objects_exist(misses)
+        rc.update(found)
+        cache.set_many(dict((device_id, now + config['cache_validity_period'])
+                            for device_id, exists in found.items() if exists))
+    return rc
+
+
+def get_owner_cache():
+    """ Method to return the owner existence cache and initialize it if not initialized
+    :return: The LRU cache of usernames to (expiration timestamp, exists) tuples
+    """
+    global owner_cache
+    global config
+
+    if not isinstance(owner_cache, LRU):
+        if not isinstance(config['owner_cache_max_entries'], int):
+            raise ValueError('owner_cache_max_entries must be an integer')
+        owner_cache = LRU(config['owner_cache_max_entries'])
+    return owner_cache
+
+
+def resolve_owners_exist(usernames):
+    """ Method to resolve the existence of many owners at once. The known owners are cached for
+    `cache_validity_period` seconds, the unknown ones for `negative_cache_validity_period` seconds, and the others are
+    looked up with bulk calls.
+    :param usernames: An iterable of owner usernames, duplicates allowed
+    :return: A dict of username to True if the owner exists, False if it doesn't
+    """
+    cache = get_owner_cache()
+    now = int(time.time())
+    rc = dict()
+    misses = list()
+    for username in set(usernames):
+        found = cache.get(username, None)
+        if found is not None and found[0] > now:
+            rc[username] = found[1]
+        else:
+            misses.append(username)
+    c = get_mnubo_client()
+    batch_size = config['objects_batch_size']
+    for start in range(0, len(misses), batch_size):
+        chunk = misses[start:start + batch_size]
+        with metrics.timer('owners_exist'):
+            found = c.owners.owners_exist(chunk)
+        for username in chunk:
+            exists = bool(found.get(username, False))
+            rc[username] = exists
+            if exists:
+                cache[username] = (now + config['cache_validity_period'], True)
+            else:
+                cache[username] = (now + config['negative_cache_validity_period'], False)
     return rc
 
 
 def mnubo_create_object(mnubo_object):
-    """ Method to handle the mnubo object creation
+    """ Method to handle the mnubo object creation, as mnubo_create_objects does. An object that already exists is
+    updated.
     :param mnubo_object: Takes the MnuboObject object and creates the object.
     """
     assert isinstance(mnubo_object, SmartObject)
+    errors = mnubo_create_objects([mnubo_object])
+    if errors:
+        raise ValueError('Could not create object {0}: {1}'.format(mnubo_object.device_id,
+                                                                   errors[mnubo_object.device_id]))
+
+
+def mnubo_create_objects(mnubo_objects):
+    """ Method to handle the creation of many mnubo objects, using batch calls of at most `objects_batch_size`
+    objects. The owners are checked once per distinct username, the owners that do not exist are removed.
+    :param mnubo_objects: A list of SmartObjects
+    :return: A dict of device id to error message, for the objects that could not be created
+    """
+    errors = mnubo_create_update_objects(mnubo_objects)
+    metrics.increment('objects_created', len(mnubo_objects) - len(errors))
+    metrics.increment('object_creation_errors', len(errors))
+    return errors
+
+
+def mnubo_update_objects(mnubo_objects):
+    """ Method to update the attributes of many mnubo objects, as mnubo_create_objects does. The objects that do not
+    exist yet are created.
+    :param mnubo_objects: A list of SmartObjects
+    :return: A dict of device id to error message, for the objects that could not be updated
+    """
+    errors = mnubo_create_update_objects(mnubo_objects, stage='update_objects')
+    metrics.increment('objects_updated', len(mnubo_objects) - len(errors))
+    metrics.increment('object_update_errors', len(errors))
+    return errors
+
+
+def mnubo_create_update_objects(mnubo_objects, stage='create_objects'):
+    """ Method to create or update many mnubo objects, using batch calls of at most `objects_batch_size` objects.
+    The owners are checked once per distinct username, the owners that do not exist are removed.
+    :param mnubo_objects: A list of SmartObjects
+    :param stage: The name of the stage timing the calls
+    :return: A dict of device id to error message, for the objects that could not be created or updated
+    """
     c = get_mnubo_client()
-    if mnubo_object.owner_username is not None:
-        if not c.owners.owner_exists(mnubo_object.owner_username):
+    owners = resolve_owners_exist(o.owner_username for o in mnubo_objects if o.owner_username is not None)
+    errors = dict()
+    built = list()
+    for mnubo_object in mnubo_objects:
+        assert isinstance(mnubo_object, SmartObject)
+        if mnubo_object.owner_username is not None and not owners[mnubo_object.owner_username]:
             mnubo_object.owner_username = None
-    try:
-        c.objects.create(mnubo_object.build())
-    except ValueError as e:
-        p = re.compile(r'already exists')
-        if p.search(e.message):
-            pass
-        else:
-            raise
+        try:
+            built.append(mnubo_object.build())
+        except ValueError as e:
+            errors[mnubo_object.device_id] = str(e)
+
+    batch_size = config['objects_batch_size']
+    for start in range(0, len(built), batch_size):
+        chunk = built[start:start + batch_size]
+        with metrics.timer(stage):
+            results = dict((r.id, r) for r in c.objects.create_update(chunk))
+        for obj in chunk:
+            device_id = obj['x_device_id']
+            result = results.get(device_id, None)
+            if result is None:
+                errors[device_id] = 'No result returned by the mnubo platform'
+            elif result.result != 'success':
+                errors[device_id] = result.message or result.result
+    return errors
 
 
 def send_mnubo_event(mnubo_event):
-    """ Method to send events to the mnubo platform.
+    """ Method to send events to the mnubo platform, as send_mnubo_events does.
     :param mnubo_event: Takes a MnuboEvent and sends it to the mnubo platform
-    :return: True if the event was sent, False if not.
+    :return: True if the event was sent or spilled. Raises DeliveryFailed if not.
     """
-    rc = False
-    c = get_mnubo_client()
     if mnubo_event.device_id is None or mnubo_event.event_type is None:
         raise ValueError('We cannot send an event because of missing [ {0} ] or [ {1} ] fields.'
                          .format('device_id', 'event_type'))
-    results = c.events.send(events=[mnubo_event.build()])
-    if results is not None:
-        rc = True
-    return rc
+    if send_mnubo_events([mnubo_event]):
+        raise DeliveryFailed('The event of {0} was not accepted by the mnubo platform.'.format(mnubo_event.device_id))
+    return True
+
+
+def post_mnubo_events(body, compressed):
+    """ Method to post a serialized batch of events to the mnubo platform, as the SDK does but without encoding the
+    events again.
+    :param body: The JSON array of the events, as bytes
+    :param compressed: True if the body is gzipped
+    :return: The list of the result dicts, in the order of the events
+    """
+    c = get_mnubo_client()
+    api_manager = c._api_manager
+    if api_manager.should_fetch_token() and not api_manager.is_access_token_valid():
+        api_manager.access_token = api_manager.fetch_access_token()
+    headers = api_manager.get_authorization_header()
+    if compressed:
+        headers['content-encoding'] = 'gzip'
+    with metrics.timer('send_events'):
+        response = get_mnubo_session(c).post(api_manager.get_api_url() + '/api/v3/events?report_results=true',
+                                             data=body, headers=headers)
+    if response.status_code == 413:
+        raise PayloadTooLarge('Request of {0} bytes too large.'.format(len(body)))
+    api_manager.validate_response(response)
+    return response.json()
+
+
+def is_transient_error(e):
+    """ Method to tell if a mnubo API call failed because of an error worth retrying: the platform is unavailable,
+    overloaded or could not be reached.
+    :param e: The exception raised by the call
+    :return: True if the call can be retried
+    """
+    if type(e).__name__ == 'ServiceUnavailable' or isinstance(e, (requests.ConnectionError, requests.Timeout)):
+        return True
+    response = getattr(e, 'response', None)
+    return isinstance(e, requests.HTTPError) and response is not None and \
+        (response.status_code >= 500 or response.status_code == 429)
+
+
+def is_spillable_error(e):
+    """ Method to tell if an events call failed because of an error that can go away, so that its events are worth
+    spilling and replaying later: a transient error, or the circuit breaker being open.
+    :param e: The exception raised by the call
+    :return: True if the call can succeed later
+    """
+    return isinstance(e, CircuitOpen) or is_transient_error(e)
+
+
+def get_delivery_policy():
+    """ A method to return the retry policy of the outbound events and initialize it if not initialized. Its circuit
+    breaker is shared by all the invocations of the container.
+    :return: A RetryPolicy
+    """
+    global delivery_policy
+    if delivery_policy is None:
+        delivery_policy = RetryPolicy(is_transient_error,
+                                      breaker=CircuitBreaker(failure_threshold=config['circuit_failure_threshold'],
+                                                             reset_timeout=config['circuit_reset_timeout']),
+                                      max_attempts=config['delivery_max_attempts'],
+                                      initial_delay=config['delivery_initial_delay'],
+                                      max_delay=config['delivery_max_delay'],
+                                      safety_margin=config['delivery_safety_margin'],
+                                      on_retry=lambda e: metrics.increment('delivery_retries'))
+    return delivery_policy
+
+
+def deliver_mnubo_events(body, compressed):
+    """ Method to post a serialized batch of events, retrying the transient errors within the time left to the
+    invocation. Fails fast while the circuit breaker is open.
+    :param body: The JSON array of the events, as bytes
+    :param compressed: True if the body is gzipped
+    :return: The list of the result dicts, in the order of the events
+    """
+    return get_delivery_policy().call(post_mnubo_events, body, compressed, deadline=invocation_deadline)
+
+
+def get_spill_queue():
+    """ A method to return the spill queue selected by `spill_queue_backend` and initialize it if not initialized.
+    :return: A SpillQueue, or None if the spilling is disabled
+    """
+    global spill_queue
+    if spill_queue is None:
+        queue = build_spill_queue(config['spill_queue_backend'], config['spill_queue_url'])
+        spill_queue = False if queue is None else queue
+    return None if spill_queue is False else spill_queue
+
+
+def spill_mnubo_events(payload):
+    """ Method to store the body of an events request that could not be delivered, to replay it later.
+    :param payload: The JSON array of the events, as bytes
+    """
+    get_spill_queue().put(payload)
+    metrics.increment('event_requests_spilled')
+
+
+def replay_spilled_events():
+    """ Method to send again the event requests spilled by the previous invocations, the oldest first. It stops at the
+    first transient failure, which is immediate while the circuit breaker is open, at `spill_replay_max_batches`
+    requests or when the invocation runs out of time. The requests failing with other errors would never succeed:
+    they are logged and dropped, not to block the queue.
+    :return: The number of requests replayed
+    """
+    queue = get_spill_queue()
+    if queue is None:
+        return 0
+    replayed = 0
+    for key, payload in queue.peek(config['spill_replay_max_batches']):
+        if invocation_deadline is not None and time.time() + config['delivery_safety_margin'] >= invocation_deadline:
+            break
+        try:
+            get_event_batcher().resend(payload)
+        except Exception as e:
+            if is_spillable_error(e):
+                logger.warning('Could not replay the spilled events: {0}'.format(e))
+                break
+            logger.error('Dropped a spilled events request of {0} bytes, rejected by the mnubo platform: {1}'
+                         .format(len(payload), e))
+            queue.remove(key)
+            metrics.increment('event_requests_dropped')
+            continue
+        queue.remove(key)
+        replayed += 1
+    metrics.increment('event_requests_replayed', replayed)
+    return replayed
+
+
+def set_invocation_deadline(context):
+    """ Method to set the time after which the current invocation must not start new calls.
+    :param context: A AWS Lambda Context object
+    """
+    global invocation_deadline
+    invocation_deadline = time.time() + context.get_remaining_time_in_millis() / 1000.0
+
+
+def record_event_request(events, payload_bytes, sent_bytes):
+    """ Method recording the size of an events request, before and after compression. The bytes sent per event are
+    their totals divided by the `events_sent` counter.
+    """
+    metrics.record_size('event_payload_bytes', payload_bytes)
+    metrics.record_size('event_sent_bytes', sent_bytes)
+
+
+def get_event_batcher():
+    """ A method to return the batcher of the outbound events and initialize it if not initialized.
+    :return: An EventBatcher
+    """
+    global event_batcher
+    if event_batcher is None:
+        event_batcher = EventBatcher(deliver_mnubo_events,
+                                     max_events=config['events_batch_size'],
+                                     max_bytes=config['events_max_bytes'],
+                                     compress=config['events_compression'],
+                                     compress_level=config['events_compression_level'],
+                                     on_sent=record_event_request,
+                                     spill=spill_mnubo_events if get_spill_queue() is not None else None,
+                                     spillable=is_spillable_error)
+    return event_batcher
+
+
+def send_mnubo_events(mnubo_events):
+    """ Method to send many events to the mnubo platform using as few calls as possible. The events are sent in
+    chunks of at most `events_batch_size` events and `events_max_bytes` bytes per call, gzipped if
+    `events_compression` is set. The calls failing with transient errors are retried, and spilled to the spill queue
+    if they still fail or if the circuit breaker is open: their events are not reported as failed.
+    :param mnubo_events: A list of MnuboEvents
+    :return: A list of the indexes (in mnubo_events) of the events that were not accepted by the mnubo platform.
+    """
+    failed = get_event_batcher().send([e.build() for e in mnubo_events])
+    metrics.increment('events_sent', len(mnubo_events) - len(failed))
+    metrics.increment('event_errors', len(failed))
+    return failed
+
+
+def get_mnubo_session(client):
+    """ Method to return the requests session used by a SmartObjectsClient.
+    :param client: A SmartObjectsClient
+    :return: The requests Session, or None if it cannot be found
+    """
+    api_manager = getattr(client, '_api_manager', None)
+    return getattr(api_manager, '_APIManager__session', getattr(api_manager, 'session', None))
+
+
+def record_payload_sizes(response, *args, **kwargs):
+    """ Requests response hook recording the size of the mnubo API requests and responses, as sent on the wire.
+    :param response: The requests Response
+    """
+    body = response.request.body
+    metrics.record_size('request_bytes', len(body) if body else 0)
+    metrics.record_size('response_bytes', int(response.headers.get('Content-Length', 0)))
 
 
 def get_mnubo_client():
-    """ A method to return the mnubo client and initialize it if not initialized
+    """ A method to return the mnubo client and initialize it if not initialized. Its HTTP connection pool is sized,
+    given timeouts and TCP keep-alive according to the `http_*` configuration values. Raises a requests
+    ConnectionError if the mnubo platform cannot be reached, and EnvironmentError if the credentials are missing.
     :return: A SmartObjectsClient
     """
     global mnubo_client
     global config
     if not isinstance(mnubo_client, SmartObjectsClient):
-        mnubo_client = SmartObjectsClient(client_id=config['client_id'],
-                                          client_secret=config['client_secret'],
-                                          environment=config['environment'])
+        if config['environment'] is None:
+            config['environment'] = select_mnubo_env(env_name=os.environ.get('MNUBO_ENV', 'sandbox'))
+        try:
+            client = SmartObjectsClient(client_id=config['client_id'],
+                                        client_secret=config['client_secret'],
+                                        environment=config['environment'])
+        except ValueError as e:
+            # The SDK raises ValueError for these too: they are not caused by the objects or events being sent
+            if 'not reachable' in str(e):
+                raise requests.ConnectionError(str(e))
+            raise EnvironmentError(str(e))
+        session = get_mnubo_session(client)
+        if session is not None:
+            adapter = PooledHTTPAdapter(pool_size=max(config['http_pool_size'], config['max_in_flight']),
+                                        connect_timeout=config['http_connect_timeout'],
+                                        read_timeout=config['http_read_timeout'],
+                                        keepalive=config['http_keepalive'])
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.hooks['response'].append(record_payload_sizes)
+        else:
+            logger.warning('Could not configure the connection pool of the mnubo client.')
+        mnubo_client = client
     return mnubo_client
 
 
 def get_aws_iot_client():
-    """ A method to initialize and return the AWS SDK IoT client.
+    """ A method to initialize and return the AWS SDK IoT client. Its connection pool, timeouts and retries follow
+    the `http_*` and `iot_max_attempts` configuration values. When the calls are retried by the adaptive backoff, the
+    SDK makes a single attempt, so that the retries do not multiply.
     :return: A boto3 IoT client.
     """
     global iot_client
     if iot_client is None:
-        iot_client = boto3.client('iot')
+        # boto3 takes a good part of the cold start and is only needed for the missing objects: load it on first use
+        import boto3
+        from botocore.config import Config as BotocoreConfig
+        options = dict(max_pool_connections=max(config['http_pool_size'], config['max_in_flight']),
+                       connect_timeout=config['http_connect_timeout'],
+                       read_timeout=config['http_read_timeout'],
+                       # The number of retries, after the first attempt
+                       retries=dict(max_attempts=0 if config['iot_throttling_max_attempts'] > 1
+                                    else config['iot_max_attempts'] - 1))
+        if 'tcp_keepalive' in BotocoreConfig.OPTION_DEFAULTS:
+            options['tcp_keepalive'] = config['http_keepalive']
+        iot_client = boto3.client('iot', endpoint_url=config['iot_endpoint'], config=BotocoreConfig(**options))
     return iot_client
 
 
+def warm_clients():
+    """ Method to create the clients and open their first connection when the function is loaded, so the first event
+    does not pay for it. The AWS IoT client is only created if `warm_iot_client` is set: it is rarely needed once the
+    objects exist. Errors are logged, the clients will be created again by the first event.
+    """
+    global mnubo_client
+    if config['client_id'] is None or config['client_secret'] is None:
+        logger.info('No mnubo credentials, not warming up the clients.')
+        return
+    try:
+        client = get_mnubo_client()
+        session = get_mnubo_session(client)
+        if session is not None:
+            # The client was authenticated through the default pool: open a connection in the configured one.
+            session.head(config['environment'])
+    except Exception:
+        logger.exception('Could not warm up the mnubo client.')
+        mnubo_client = None
+    if not config['warm_iot_client']:
+        return
+    try:
+        get_aws_iot_client()
+    except Exception:
+        logger.exception('Could not warm up the AWS IoT client.')
+
+
+def get_connection_stats():
+    """ Method to count the HTTP connections opened and the requests made by the clients since they were created. A
+    number of requests much higher than the number of connections means the connections are reused.
+    :return: A dict of client name to a dict with the `connections` and `requests` counts
+    """
+    rc = dict()
+    session = get_mnubo_session(mnubo_client) if mnubo_client is not None else None
+    if session is not None:
+        stats = dict(connections=0, requests=0)
+        for adapter in set(session.adapters.values()):
+            for k, v in pool_manager_stats(adapter.poolmanager).items():
+                stats[k] += v
+        rc['mnubo'] = stats
+    if iot_client is not None:
+        try:
+            rc['iot'] = pool_manager_stats(iot_client._endpoint.http_session._manager)
+        except AttributeError:
+            pass
+    return rc
+
+
+def log_connection_stats():
+    """ Method to log the connection reuse metrics of the clients. """
+    for name, stats in get_connection_stats().items():
+        logger.info('Connections of the {0} client: {1} opened for {2} requests'
+                    .format(name, stats['connections'], stats['requests']))
+
+
+def is_throttling_error(e):
+    """ Method to tell if an AWS API call failed because of throttling.
+    :param e: The exception raised by the call
+    :return: True if the call was throttled
+    """
+    code = getattr(e, 'response', dict()).get('Error', dict()).get('Code', None)
+    return code in ('ThrottlingException', 'TooManyRequestsException', 'Throttling', 'RequestLimitExceeded')
+
+
+def is_retryable_iot_error(e):
+    """ Method to tell if an AWS IoT API call failed because of an error the SDK would retry: throttling, a server
+    error or a connection error.
+    :param e: The exception raised by the call
+    :return: True if the call can be retried
+    """
+    if is_throttling_error(e):
+        return True
+    response = getattr(e, 'response', None) or dict()
+    if response.get('ResponseMetadata', dict()).get('HTTPStatusCode', 0) >= 500:
+        return True
+    # By name, botocore is only loaded with the client
+    names = set(cls.__module__ + '.' + cls.__name__ for cls in type(e).__mro__)
+    return 'botocore.exceptions.ConnectionError' in names or 'botocore.exceptions.HTTPClientError' in names
+
+
+def get_iot_backoff():
+    """ A method to return the adaptive backoff shared by the AWS IoT API calls and initialize it if not initialized.
+    The SDK does not retry the calls when it is enabled, so it retries the errors the SDK would have retried as well.
+    :return: An AdaptiveBackoff
+    """
+    global iot_backoff
+    if iot_backoff is None:
+        iot_backoff = AdaptiveBackoff(is_retryable_iot_error, max_attempts=config['iot_throttling_max_attempts'])
+    return iot_backoff
+
+
+def get_thing_cache():
+    """ Method to return the thing definition cache and initialize it if not initialized
+    :return: The LRU cache of device ids to (expiration timestamp, thing definition) tuples
+    """
+    global thing_cache
+    global config
+
+    if not isinstance(thing_cache, LRU):
+        if not isinstance(config['thing_cache_max_entries'], int):
+            raise ValueError('thing_cache_max_entries must be an integer')
+        thing_cache = LRU(config['thing_cache_max_entries'])
+
+    if not isinstance(config['thing_cache_validity_period'], int):
+        raise ValueError('thing_cache_validity_period must be an integer')
+    return thing_cache
+
+
+def clean_thing(thing):
+    """ Method to remove the fields of a thing definition that are not used by the mapping.
+    :param thing: A thing definition returned by describe_thing or list_things
+    :return: The cleaned thing definition
+    """
+    # Cleanup
+    thing.pop('ResponseMetadata', None)
+    thing.pop('version', None)
+    thing.pop('defaultClientId', None)
+    return thing
+
+
 def get_thing_attributes(device_id):
     """ Method to wrap getting the AWS IoT device registry thing attributes. We must clean the returned data structure
-    to use it later on.
+    to use it later on. The definitions are cached for `thing_cache_validity_period` seconds and the throttled calls
+    are retried with an adaptive backoff.
     :param device_id: The AWS IoT thing name, the mnubo device ID.
     :return: The cleaned thing dict data structure.
     """
+    cache = get_thing_cache()
+    now = int(time.time())
+    found = cache.get(device_id, None)
+    if found is not None and found[0] > now:
+        metrics.increment('thing_cache_hits')
+        return dict(found[1])
+
+    metrics.increment('thing_cache_misses')
     c = get_aws_iot_client()
-    r = c.describe_thing(thingName=device_id)
-    # Cleanup
-    r.pop('ResponseMetadata', None)
-    r.pop('version', None)
-    r.pop('defaultClientId', None)
-    return r
+    with metrics.timer('describe_thing'):
+        r = clean_thing(get_iot_backoff().call(c.describe_thing, thingName=device_id))
+    cache[device_id] = (now + config['thing_cache_validity_period'], r)
+    return dict(r)
+
+
+def list_things_page(thing_type_name=None, next_token=None):
+    """ Method to get a page of thing definitions with a list_things call. The definitions are also put in the thing
+    definition cache.
+    :param thing_type_name: Only list the things of this type if set
+    :param next_token: The token of the page, None for the first page
+    :return: A (list of up to 250 cleaned thing definitions, token of the next page or None) tuple
+    """
+    cache = get_thing_cache()
+    c = get_aws_iot_client()
+    kwargs = dict(maxResults=250)
+    if thing_type_name is not None:
+        kwargs['thingTypeName'] = thing_type_name
+    if next_token:
+        kwargs['nextToken'] = next_token
+    with metrics.timer('list_things'):
+        r = get_iot_backoff().call(c.list_things, **kwargs)
+    expires_at = int(time.time()) + config['thing_cache_validity_period']
+    things = list()
+    for thing in r.get('things', list()):
+        thing.pop('thingArn', None)
+        cache[thing['thingName']] = (expires_at, clean_thing(thing))
+        things.append(dict(thing))
+    return things, r.get('nextToken', None) or None
+
+
+def prefetch_things(thing_type_name=None, max_pages=None):
+    """ Method to warm the thing definition cache with the definitions of many things, using paginated list_things
+    calls instead of one describe_thing call per thing.
+    :param thing_type_name: Only prefetch the things of this type if set
+    :param max_pages: The maximum number of pages of 250 things to fetch, no limit if None
+    :return: The number of things cached
+    """
+    count = 0
+    pages = 0
+    next_token = None
+    while max_pages is None or pages < max_pages:
+        things, next_token = list_things_page(thing_type_name, next_token)
+        pages += 1
+        count += len(things)
+        if not next_token:
+            break
+    logger.info('Prefetched {0} things in {1} calls.'.format(count, pages))
+    return count
+
+
+def prefetch_missing_things(missing):
+    """ Method to prefetch the thing definitions when a batch has many missing objects. The prefetch is done at most
+    once every `thing_cache_validity_period` seconds, for the thing types of `thing_prefetch_types` or for all things.
+    :param missing: The number of missing objects in the batch
+    """
+    global next_thing_prefetch
+    threshold = config['thing_prefetch_threshold']
+    if threshold < 1 or missing < threshold or time.time() < next_thing_prefetch:
+        return
+    next_thing_prefetch = time.time() + config['thing_cache_validity_period']
+    try:
+        for thing_type_name in config['thing_prefetch_types'] or [None]:
+            prefetch_things(thing_type_name=thing_type_name, max_pages=config['thing_prefetch_max_pages'])
+    except Exception:
+        logger.exception('Could not prefetch the things.')
 
 
 def select_mnubo_env(env_name):
     """ Method to return the SmartObjectsClient environment object matched to the environment variable.
-    :param env_name: 'production' or 'sandbox'
+    :param env_name: 'production', 'sandbox' or the URL of another SmartObjects endpoint (a local stub for instance)
     :return: A mnubo object for the environment
     """
     # Do some sanity checks on the environments and return the right value for the mnubo client
-    if env_name == 'production':
+    if env_name.startswith('http://') or env_name.startswith('https://'):
+        logger.info('Loading with endpoint: {0}'.format(env_name))
+        return env_name
+    elif env_name == 'production':
         logger.info('Loading with environment: {0}'.format(env_name))
         return Environments.Production
     elif env_name == 'sandbox':
@@ -192,7 +984,7 @@ def select_mnubo_env(env_name):
 
 def map_thing_to_smart_object(thing):
     """ Mapping method for AWS IoT device registry Thing to a mnubo SmartObject This method operates with well-known
-    field names, builds a SmartObject ready to be sent to the mnubo platform.
+    field names, builds a SmartObject ready to be sent to the mnubo platform. The thing definition is not modified.
 
     :param thing: The thing definition JSON document.
     :return: A SmartObject object.
@@ -204,44 +996,137 @@ def map_thing_to_smart_object(thing):
     mnubo_object.device_id = thing.get('thingName', None)
     # Assign the thing type name as the mnubo SmartObject type
     mnubo_object.object_type = thing.get('thingTypeName', None)
-    # Get a copy of the attributes so we can manipulate them later.
-    thing_attrs = copy.deepcopy(thing.get('attributes', dict()))
+    # Split the well-known fields from the custom attributes, applying the mapping and blacklist rules.
+    transformer = smart_object_transformers.get(mnubo_object.object_type, smart_object_transformers[None])
+    thing_attrs, custom_attributes = transformer.transform(thing.get('attributes', dict()))
 
     # If the owner username is present, take it.
-    mnubo_object.owner_username = thing_attrs.pop('owner_username', None)
+    mnubo_object.owner_username = thing_attrs.get('owner_username', None)
     # If a latitude was defined, take it.
-    mnubo_object.latitude = thing_attrs.pop('latitude', None)
+    mnubo_object.latitude = thing_attrs.get('latitude', None)
     # If a last update timestamp is available, take it.
-    mnubo_object.last_update_timestamp = standardize_timestamp(thing_attrs.pop('last_update', None))
+    mnubo_object.last_update_timestamp = standardize_timestamp(thing_attrs.get('last_update', None))
     # If a longitude was defined, take it.
-    mnubo_object.longitude = thing_attrs.pop('longitude', None)
+    mnubo_object.longitude = thing_attrs.get('longitude', None)
     # If a registration date is available, take it.
-    mnubo_object.registration_date = standardize_timestamp(thing_attrs.pop('registration_date', None))
+    mnubo_object.registration_date = standardize_timestamp(thing_attrs.get('registration_date', None))
     # If a timestamp for the object is available, take it.
-    mnubo_object.timestamp = standardize_timestamp(thing_attrs.pop('timestamp', None))
-
-    # Cleanup unwanted keys defined in the blacklist variable.
-    for v in smart_object_attributes_blacklist:
-        thing_attrs.pop(v, None)
+    mnubo_object.timestamp = standardize_timestamp(thing_attrs.get('timestamp', None))
 
     # Add custom attributes to be added to the mnubo SmartObject
-    for k, v in thing_attrs.items():
-        # If the attribute key is to be mapped to another key
-        if k in smart_object_attributes_mapping:
-            # Perform key mapping and assign value
-            mnubo_object.custom_attributes.update({smart_object_attributes_mapping[k]: v})
-        else:
-            # Assign key and value directly
-            mnubo_object.custom_attributes.update({k: v})
+    mnubo_object.custom_attributes.update(custom_attributes)
 
     # Returned the mnubo-compatible object
     return mnubo_object
 
 
+def get_negative_cache():
+    """ Method to return the cache of objects that could not be created and initialize it if not initialized
+    :return: The LRU cache of device ids to retry timestamps
+    """
+    global negative_cache
+    global config
+
+    if not isinstance(negative_cache, LRU):
+        if not isinstance(config['negative_cache_max_entries'], int):
+            raise ValueError('negative_cache_max_entries must be an integer')
+        negative_cache = LRU(config['negative_cache_max_entries'])
+
+    if not isinstance(config['negative_cache_validity_period'], int):
+        raise ValueError('negative_cache_validity_period must be an integer')
+    return negative_cache
+
+
+def recently_failed_object(device_id):
+    """ Method to check if the object of a device could not be created recently.
+    :param device_id: The thing name or mnubo SmartObject device id
+    :return: True if the creation failed less than `negative_cache_validity_period` seconds ago
+    """
+    if not config['use_object_cache']:
+        return False
+    found = get_negative_cache().get(device_id, None)
+    if found is not None and found > int(time.time()):
+        metrics.increment('negative_cache_hits')
+        return True
+    return False
+
+
+def is_permanent_creation_error(e):
+    """ Method to tell if an object creation failed for a reason that will not go away by itself: the thing does not
+    exist, cannot be mapped to an object, or the object was rejected by the mnubo platform. Throttling, server and
+    connection errors are not.
+    :param e: The exception raised by the creation
+    :return: True if the creation should not be attempted again before `negative_cache_validity_period` seconds
+    """
+    # The SmartObjects SDK raises ValueError for the invalid objects and the 400 and 409 answers. The ValueErrors of the
+    # client creation, when the platform cannot be reached, are raised as connection errors by get_mnubo_client.
+    if isinstance(e, ValueError):
+        return True
+    response = getattr(e, 'response', None)
+    if isinstance(response, dict):
+        # AWS IoT: the thing does not exist
+        return response.get('Error', dict()).get('Code', None) == 'ResourceNotFoundException' or \
+            response.get('ResponseMetadata', dict()).get('HTTPStatusCode', 0) == 404
+    return getattr(response, 'status_code', None) in (400, 404, 409, 422)
+
+
+class PendingCreation(object):
+    """ An object creation in progress, for other callers to wait on. """
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+
+def create_missing_object(device_id):
+    """ Method to create a SmartObject from its AWS IoT device registry Thing definition. Concurrent calls for the same
+    device wait on the creation in progress instead of repeating it. When the object cache is used, a successful
+    creation is cached and a permanent failure (see is_permanent_creation_error) is remembered for
+    `negative_cache_validity_period` seconds.
+    :param device_id: The thing name or mnubo SmartObject device id
+    """
+    with pending_creations_lock:
+        pending = pending_creations.get(device_id, None)
+        owner = pending is None
+        if owner:
+            pending = PendingCreation()
+            pending_creations[device_id] = pending
+
+    if not owner:
+        pending.done.wait()
+        if pending.error is not None:
+            raise ValueError('The object creation failed for: {0}'.format(device_id))
+        return
+
+    try:
+        # Get the Device Registry Thing definition
+        logger.info('About to get thing data on: {0}'.format(device_id))
+        thing = get_thing_attributes(device_id=device_id)
+        # If the object does not exist, perform the mapping and create it.
+        mnubo_object = map_thing_to_smart_object(thing=thing)
+        fingerprints = object_fingerprints([mnubo_object]) if config['attribute_sync'] else dict()
+        mnubo_create_object(mnubo_object)
+        if config['use_object_cache']:
+            get_object_cache().set(device_id, int(time.time()) + config['cache_validity_period'])
+        if fingerprints:
+            get_object_cache().set_fingerprints(fingerprints)
+    except Exception as e:
+        pending.error = e
+        if config['use_object_cache'] and is_permanent_creation_error(e):
+            get_negative_cache()[device_id] = int(time.time()) + config['negative_cache_validity_period']
+        raise
+    finally:
+        with pending_creations_lock:
+            pending_creations.pop(device_id, None)
+        pending.done.set()
+
+
 def manage_object(device_id):
     """ Method to manipulate mnubo SmartObjects. To be used in the different handlers.
     :param device_id: The thing name or mnubo SmartObject device id
     """
+    # Do not hammer the APIs for an object that could not be created moments ago
+    if recently_failed_object(device_id):
+        raise ValueError('The object creation failed recently for: {0}'.format(device_id))
     # If we are to use local caching of objects
     if config['use_object_cache']:
         # Check using the cache
@@ -250,18 +1135,360 @@ def manage_object(device_id):
         # Check directly
         target_object_exists = mnubo_object_exists(device_id)
     if not target_object_exists:
-        # Get the Device Registry Thing definition
-        logger.info('About to get thing data on: {0}'.format(device_id))
-        thing = get_thing_attributes(device_id=device_id)
-        # If the object does not exist, perform the mapping and create it.
-        mnubo_object = map_thing_to_smart_object(thing=thing)
-        mnubo_create_object(mnubo_object)
+        create_missing_object(device_id)
+    elif config['attribute_sync']:
+        sync_object_attributes([device_id])
+
+
+def resolve_objects_exist(device_ids):
+    """ Method to resolve the existence of many objects at once, using the cache if it is enabled. The objects that
+    could not be created recently are reported as missing without being looked up.
+    :param device_ids: An iterable of thing names or mnubo SmartObject device ids, duplicates allowed
+    :return: A dict of device id to True if it exists, False if it doesn't
+    """
+    device_ids = set(device_ids)
+    rc = dict((device_id, False) for device_id in device_ids if recently_failed_object(device_id))
+    lookup = [device_id for device_id in device_ids if device_id not in rc]
+    if lookup:
+        if config['use_object_cache']:
+            rc.update(cached_mnubo_objects_exist(lookup))
+        else:
+            rc.update(mnubo_objects_exist(lookup))
+    # Onboarding wave: fetch the thing definitions in bulk before the objects are created
+    prefetch_missing_things(len([device_id for device_id in lookup if not rc[device_id]]))
+    if config['attribute_sync']:
+        sync_object_attributes([device_id for device_id in lookup if rc[device_id]])
+    return rc
+
+
+def manage_missing_objects(device_ids):
+    """ Method to create the objects of devices reported missing by resolve_objects_exist, using batch calls. When the
+    object cache is used, the created objects are cached and the ones whose thing does not exist or that were rejected
+    are remembered for `negative_cache_validity_period` seconds. The failures of a whole batch because of throttling,
+    server or connection errors are not remembered.
+    :param device_ids: A list of distinct thing names or mnubo SmartObject device ids
+    :return: The set of device ids for which the object could not be created
+    """
+    failed = set(device_id for device_id in device_ids if recently_failed_object(device_id))
+    # The failures not worth retrying before negative_cache_validity_period
+    rejected = set()
+    mnubo_objects = list()
+    for device_id in device_ids:
+        if device_id in failed:
+            continue
+        try:
+            mnubo_objects.append(map_thing_to_smart_object(thing=get_thing_attributes(device_id=device_id)))
+        except Exception as e:
+            logger.exception('Could not get thing data on: {0}'.format(device_id))
+            failed.add(device_id)
+            if is_permanent_creation_error(e):
+                rejected.add(device_id)
+
+    # Computed before the creation, which removes the unknown owners
+    fingerprints = object_fingerprints(mnubo_objects) if config['attribute_sync'] else dict()
+    if mnubo_objects:
+        try:
+            errors = mnubo_create_objects(mnubo_objects)
+            # Rejected one by one by the platform
+            rejected.update(errors.keys())
+        except Exception as e:
+            logger.exception('Could not create {0} objects.'.format(len(mnubo_objects)))
+            errors = dict((o.device_id, 'Batch creation failed') for o in mnubo_objects)
+            if is_permanent_creation_error(e):
+                rejected.update(errors.keys())
+        for device_id, message in errors.items():
+            logger.error('Could not create object {0}: {1}'.format(device_id, message))
+            failed.add(device_id)
+
+    if config['use_object_cache']:
+        now = int(time.time())
+        get_object_cache().set_many(dict((device_id, now + config['cache_validity_period'])
+                                         for device_id in device_ids if device_id not in failed))
+        negative = get_negative_cache()
+        for device_id in rejected:
+            negative[device_id] = now + config['negative_cache_validity_period']
+    if fingerprints:
+        get_object_cache().set_fingerprints(dict((device_id, fingerprint) for device_id, fingerprint
+                                                 in fingerprints.items() if device_id not in failed))
+    return failed
+
+
+def object_fingerprints(mnubo_objects):
+    """ Method to compute the fingerprints of the attributes of SmartObjects.
+    :param mnubo_objects: A list of SmartObjects
+    :return: A dict of device id to fingerprint, for the objects that can be built
+    """
+    rc = dict()
+    for mnubo_object in mnubo_objects:
+        try:
+            rc[mnubo_object.device_id] = object_fingerprint(mnubo_object.build())
+        except ValueError:
+            pass
+    return rc
+
+
+def sync_objects(mnubo_objects):
+    """ Method to update the objects whose attributes changed since they were last sent, using batch calls. The
+    fingerprints of the attributes sent are kept next to the existence of the objects in the object cache, so an
+    object without fingerprint (created before `attribute_sync` was enabled, or evicted) is sent once.
+    :param mnubo_objects: A list of SmartObjects, mapped from their things
+    :return: A (list of the device ids of the objects updated, dict of device id to error message for the objects that
+    could not be updated) tuple
+    """
+    cache = get_object_cache()
+    # Computed before the update, which removes the unknown owners
+    fingerprints = object_fingerprints(mnubo_objects)
+    known = cache.get_fingerprints(list(fingerprints.keys()))
+    changed = [o for o in mnubo_objects if fingerprints.get(o.device_id, None) is None or
+               known.get(o.device_id, None) != fingerprints[o.device_id]]
+    metrics.increment('objects_unchanged', len(mnubo_objects) - len(changed))
+    if not changed:
+        return list(), dict()
+    errors = mnubo_update_objects(changed)
+    now = int(time.time())
+    updated = [o.device_id for o in changed if o.device_id not in errors]
+    cache.set_many(dict((device_id, now + config['cache_validity_period']) for device_id in updated))
+    cache.set_fingerprints(dict((device_id, fingerprints[device_id]) for device_id in updated
+                                 if device_id in fingerprints))
+    return updated, errors
 
 
-def map_shadow_update_to_mnubo_event(event):
+def sync_object_attributes(device_ids):
+    """ Method to send the changes of the thing attributes of existing objects, when `attribute_sync` is enabled. The
+    thing definitions come from the thing cache, so a thing is described at most once every
+    `thing_cache_validity_period` seconds. The failures are logged, they do not prevent the events from being sent.
+    :param device_ids: A list of distinct device ids whose object exists
+    """
+    mnubo_objects = list()
+    for device_id in device_ids:
+        try:
+            mnubo_objects.append(map_thing_to_smart_object(thing=get_thing_attributes(device_id=device_id)))
+        except Exception:
+            logger.exception('Could not get thing data on: {0}'.format(device_id))
+    if not mnubo_objects:
+        return
+    try:
+        _, errors = sync_objects(mnubo_objects)
+    except Exception:
+        logger.exception('Could not sync {0} objects.'.format(len(mnubo_objects)))
+        return
+    for device_id, message in errors.items():
+        logger.error('Could not update object {0}: {1}'.format(device_id, message))
+
+
+def get_cost_estimator():
+    """ A method to return the estimator of the time taken per record and initialize it if not initialized.
+    :return: A CostEstimator
+    """
+    global cost_estimator
+    if cost_estimator is None:
+        cost_estimator = CostEstimator()
+    return cost_estimator
+
+
+def get_forwarding_engine():
+    """ A method to build the engine forwarding the events of the batch invocations. Within a handler, and if
+    `time_budget_enabled` is set, the engine only starts the work that can be done `time_budget_safety_margin`
+    seconds before the invocation times out.
+    :return: A ForwardingEngine
+    """
+    return ForwardingEngine(resolve_existing=resolve_objects_exist,
+                            create_objects=manage_missing_objects,
+                            send_events=send_mnubo_events,
+                            max_in_flight=config['max_in_flight'],
+                            batch_size=config['events_batch_size'],
+                            objects_batch_size=config['objects_batch_size'],
+                            budget=get_time_budget())
+
+
+def get_time_budget():
+    """ A method to build the time budget of the current invocation, if `time_budget_enabled` is set.
+    :return: A TimeBudget, None outside the handlers or if disabled
+    """
+    if not config['time_budget_enabled'] or invocation_deadline is None:
+        return None
+    return TimeBudget(invocation_deadline, get_cost_estimator(), safety_margin=config['time_budget_safety_margin'])
+
+
+def flush_metrics(context, start):
+    """ Method to emit the metrics of an invocation, once at its end.
+    :param context: A AWS Lambda Context object, its function name is used as a dimension
+    :param start: The metrics clock value at the beginning of the invocation
+    """
+    metrics.record_time('invocation', metrics_clock() - start)
+    metrics.flush(FunctionName=getattr(context, 'function_name', 'local'))
+
+
+def get_shadow_delta_filter():
+    """ A method to return the filter of the unchanged shadow values and initialize it if not initialized.
+    :return: A DeltaFilter
+    """
+    global shadow_delta_filter
+    if shadow_delta_filter is None:
+        shadow_delta_filter = DeltaFilter(max_devices=config['shadow_delta_max_devices'],
+                                          keepalive=config['shadow_delta_keepalive'],
+                                          deadbands=config['shadow_deadbands'])
+    return shadow_delta_filter
+
+
+def suppress_unchanged_values(mnubo_event):
+    """ Method to remove from a shadow update event the values that did not change since they were last forwarded
+    for its device, including its position.
+    :param mnubo_event: A mnubo Event, modified in place
+    :return: False if none of its values changed and the event must not be sent, True otherwise
+    """
+    values = dict(mnubo_event.event_data)
+    for name in ('latitude', 'longitude'):
+        if getattr(mnubo_event, name) is not None:
+            values['x_' + name] = getattr(mnubo_event, name)
+    kept = get_shadow_delta_filter().apply(mnubo_event.device_id, values)
+    metrics.increment('shadow_values_suppressed', len(values) - len(kept))
+    if values and not kept:
+        metrics.increment('shadow_events_suppressed')
+        return False
+    mnubo_event.latitude = kept.pop('x_latitude', None)
+    mnubo_event.longitude = kept.pop('x_longitude', None)
+    mnubo_event.event_data = kept
+    return True
+
+
+def get_window_aggregator():
+    """ A method to return the aggregator of the custom events and initialize it if not initialized.
+    :return: A WindowAggregator
+    """
+    global window_aggregator
+    if window_aggregator is None:
+        window_aggregator = WindowAggregator(config['aggregation_window'],
+                                             reductions=config['aggregation_reductions'],
+                                             default_reductions=config['aggregation_default_reductions'])
+    return window_aggregator
+
+
+def extract_batch_records(event):
+    """ Method to extract the individual records out of a batch invocation. Supports Kinesis and SQS triggers, as well
+    as AWS IoT rules sending a list of events.
+    :param event: The event received by the handler
+    :return: A list of (item identifier, record) tuples. The record still needs to be decoded with decode_batch_record.
+    """
+    if isinstance(event, list):
+        # IoT rule batch, the position in the batch identifies the record
+        return [(str(i), record) for i, record in enumerate(event)]
+    if isinstance(event, dict) and isinstance(event.get('Records', None), list):
+        records = list()
+        for record in event['Records']:
+            if 'kinesis' in record:
+                records.append((record['kinesis']['sequenceNumber'], record))
+            else:
+                records.append((record.get('messageId', None), record))
+        return records
+    # A single event
+    return [('0', event)]
+
+
+def decode_batch_record(record):
+    """ Method to turn a record extracted by extract_batch_records into an event dict.
+    :param record: A Kinesis record, an SQS message or a plain event dict.
+    :return: The event dict.
+    """
+    if 'kinesis' in record:
+        payload = base64.b64decode(record['kinesis']['data']).decode('utf-8')
+    elif record.get('eventSource', None) == 'aws:sqs':
+        payload = record['body']
+    else:
+        return record
+    event = json.loads(payload)
+    if not isinstance(event, dict):
+        raise ValueError('Batch record payload must be a JSON object')
+    return event
+
+
+def forward_event_batch(event, mapper, suppress_unchanged=False, aggregate=False):
+    """ Method to map, group and send all the events of a batch invocation. Objects are managed once per device and
+    events are sent in chunks, with up to `max_in_flight` concurrent requests. The records left when the invocation
+    is running out of time are reported as failed.
+    :param event: The event received by the handler
+    :param mapper: The method used to map each record to a mnubo Event
+    :param suppress_unchanged: If True, the values that did not change are not sent, see suppress_unchanged_values
+    :param aggregate: If True, the events are aggregated by window, see WindowAggregator. The records of an
+    aggregated event that fails are all reported as failed.
+    :return: A partial batch response listing the records that failed and must be retried.
+    """
+    failures = list()
+    suppressed = 0
+    # Map every record
+    items = list()
+    for identifier, record in extract_batch_records(event):
+        try:
+            with metrics.timer('map'):
+                mnubo_event = mapper(event=decode_batch_record(record), raw_timestamp=True)
+            if mnubo_event.device_id is None or mnubo_event.event_type is None:
+                raise ValueError('We cannot send an event because of missing [ {0} ] or [ {1} ] fields.'
+                                 .format('device_id', 'event_type'))
+        except Exception:
+            logger.exception('Could not map record {0}: {1}'.format(identifier, str(record)))
+            failures.append(identifier)
+            continue
+        if suppress_unchanged and not suppress_unchanged_values(mnubo_event):
+            suppressed += 1
+            continue
+        items.append((identifier, mnubo_event.device_id, mnubo_event))
+    metrics.increment('records', len(items) + len(failures) + suppressed)
+    metrics.increment('mapping_errors', len(failures))
+    # Replace the events of each window by their aggregate, identified by the first of their records
+    windows = dict()
+    if aggregate and items:
+        with metrics.timer('aggregate'):
+            aggregated = get_window_aggregator().aggregate([(identifier, e) for identifier, _, e in items])
+        metrics.increment('events_aggregated', len(items))
+        metrics.increment('aggregated_events', len(aggregated))
+        windows = dict((identifiers[0], identifiers) for identifiers, _ in aggregated)
+        items = [(identifiers[0], e.device_id, e) for identifiers, e in aggregated]
+    # Normalize the timestamps of the whole batch at once, or one by one to find the invalid ones
+    with metrics.timer('normalize_timestamps'):
+        try:
+            timestamps = normalize_timestamps([mnubo_event.timestamp for _, _, mnubo_event in items])
+        except (ValueError, OverflowError):
+            timestamps = None
+        if timestamps is not None:
+            for (_, _, mnubo_event), timestamp in zip(items, timestamps):
+                mnubo_event.timestamp = timestamp
+        else:
+            valid = list()
+            for identifier, device_id, mnubo_event in items:
+                try:
+                    mnubo_event.timestamp = normalize_timestamp(mnubo_event.timestamp)
+                except (ValueError, OverflowError):
+                    logger.error('Invalid timestamp in record {0}: {1}'.format(identifier, mnubo_event.timestamp))
+                    failures.append(identifier)
+                    if suppress_unchanged:
+                        get_shadow_delta_filter().forget(device_id)
+                    continue
+                valid.append((identifier, device_id, mnubo_event))
+            metrics.increment('mapping_errors', len(items) - len(valid))
+            items = valid
+
+    # Create the objects if needed, once per device, and send the events to the mnubo platform
+    engine = get_forwarding_engine()
+    with metrics.timer('forward'):
+        failures.extend(engine.forward(items))
+    if engine.budget is not None:
+        metrics.increment('records_deferred', engine.budget.deferred)
+    if suppress_unchanged and failures:
+        # The failed records are retried: their values must not be suppressed as if they had been forwarded
+        failed = set(failures)
+        for device_id in set(device_id for identifier, device_id, _ in items if identifier in failed):
+            get_shadow_delta_filter().forget(device_id)
+    if windows:
+        failures = [f for identifier in failures for f in windows.get(identifier, [identifier])]
+
+    return dict(batchItemFailures=[dict(itemIdentifier=identifier) for identifier in failures])
+
+
+def map_shadow_update_to_mnubo_event(event, raw_timestamp=False):
     """ Mapping method for AWS IoT shadow device documents to a mnubo event This method operates with well-known
-    field names, builds a mnubo event ready to be sent to the mnubo platform.
+    field names, builds a mnubo event ready to be sent to the mnubo platform. The document is not modified.
     :param event: The event received by the handler
+    :param raw_timestamp: If True, the timestamp is left as it is, to be normalized with the rest of the batch
     :return: A mnubo Event
     """
     # Sanity check, we must have a dict shadow document.
@@ -275,73 +1502,65 @@ def map_shadow_update_to_mnubo_event(event):
     # Sanity check #2, It must be a dict
     assert isinstance(shadow_reported, dict)
 
+    # Split the well-known fields from the custom time series, applying the mapping and blacklist rules.
+    transformer = shadow_transformers.get(SHADOW_UPDATE_EVENT_TYPE, shadow_transformers[None])
+    known, event_data = transformer.transform(shadow_reported)
+
     # Assign a default or environment variable event type to this event
     mnubo_data.event_type = SHADOW_UPDATE_EVENT_TYPE
     # Get the timestamp of this shadow update accepted document
-    mnubo_data.timestamp = standardize_timestamp(event.get('metadata', dict()).get('timestamp', None))
+    mnubo_data.timestamp = event.get('metadata', dict()).get('timestamp', None)
+    if not raw_timestamp:
+        mnubo_data.timestamp = standardize_timestamp(mnubo_data.timestamp)
     # If an event id is present, use it. Else, the mnubo platform will generate one.
-    mnubo_data.event_id = shadow_reported.pop('event_id', None)
+    mnubo_data.event_id = known.get('event_id', None)
     # If a latitude is present, take it.
-    mnubo_data.latitude = shadow_reported.pop('latitude', None)
+    mnubo_data.latitude = known.get('latitude', None)
     # If a longitude is present, take it.
-    mnubo_data.longitude = shadow_reported.pop('longitude', None)
-
-    # Cleanup unwanted keys before using the event_attributes_blacklist list.
-    for v in event_attributes_blacklist:
-        shadow_reported.pop(v, None)
+    mnubo_data.longitude = known.get('longitude', None)
 
     # Add custom time series
-    for k, v in shadow_reported.items():
-        # If the key is in the event_attributes_mapping dict
-        if k in event_attributes_mapping:
-            # Perform key mapping and assign the mapped key with the value
-            mnubo_data.event_data.update({event_attributes_mapping[k]: v})
-        else:
-            # Assign key and value directly
-            mnubo_data.event_data.update({k: v})
+    mnubo_data.event_data.update(event_data)
 
     # Returned the mnubo-compatible object
     return mnubo_data
 
 
-def map_iot_event_to_mnubo_event(event):
+def map_iot_event_to_mnubo_event(event, raw_timestamp=False):
     """ Mapping method to map a Thing generated event in a MQTT topic to a mnubo event
     This method operates with well-known field names, builds a mnubo event ready to be sent to the mnubo platform.
+    The event is not modified.
     :param event: The event received by the handler
+    :param raw_timestamp: If True, the timestamp is left as it is, to be normalized with the rest of the batch
     :return: A mnubo Event
     """
     # Sanity check, make sure the event is a dict.
     assert isinstance(event, dict)
 
+    # Split the well-known fields from the custom time series, applying the mapping and blacklist rules.
+    transformer = iot_event_transformers.get(event.get('event_type', IOT_MQTT_EVENT_TYPE), iot_event_transformers[None])
+    known, event_data = transformer.transform(event)
+
     # Create a new mnubo-formatted event
     mnubo_data = Event()
     # If there's an event_type in the event, use it, else use the content of the constant variable that can be
     # modified using an environment variable.
-    mnubo_data.event_type = event.pop('event_type', IOT_MQTT_EVENT_TYPE)
+    mnubo_data.event_type = known.get('event_type', IOT_MQTT_EVENT_TYPE)
     # If there's a timestamp in the event, use it.
-    mnubo_data.timestamp = standardize_timestamp(event.pop('timestamp', None))
+    mnubo_data.timestamp = known.get('timestamp', None)
+    if not raw_timestamp:
+        mnubo_data.timestamp = standardize_timestamp(mnubo_data.timestamp)
     # If there's a device_id in the event, take it.
-    mnubo_data.device_id = event.pop('device_id', None)
+    mnubo_data.device_id = known.get('device_id', None)
     # If there's a custom event id, take it.
-    mnubo_data.event_id = event.pop('event_id', None)
+    mnubo_data.event_id = known.get('event_id', None)
     # If there's a latitude defined, take it.
-    mnubo_data.latitude = event.pop('latitude', None)
+    mnubo_data.latitude = known.get('latitude', None)
     # If there's a longitude defined, take it.
-    mnubo_data.longitude = event.pop('longitude', None)
-
-    # Cleanup unwanted keys before using the event_attributes_blacklist list.
-    for v in event_attributes_blacklist:
-        event.pop(v, None)
+    mnubo_data.longitude = known.get('longitude', None)
 
     # Add custom time series
-    for k, v in event.items():
-        # If the key is in the event_attributes_mapping dict
-        if k in event_attributes_mapping:
-            # Perform key mapping and assign the mapped key with the value
-            mnubo_data.event_data.update({event_attributes_mapping[k]: v})
-        else:
-            # Assign key and value directly
-            mnubo_data.event_data.update({k: v})
+    mnubo_data.event_data.update(event_data)
 
     # Returned the mnubo-compatible object
     return mnubo_data
@@ -349,24 +1568,48 @@ def map_iot_event_to_mnubo_event(event):
 
 # Now we begin.
 logger.info('Loading mnubo forwarder function...')
-# Setup the config value to the right environment object.
-config['environment'] = select_mnubo_env(env_name=os.environ.get('MNUBO_ENV', 'sandbox'))
+# Compile the attribute mapping and blacklist rules once, loading them from the configuration file if there is one.
+# A configuration that cannot be loaded is logged and the rules of the variables are used until refresh_mapping_config
+# loads it.
+mapping_config_doc = None
+if config['mapping_config_file'] is not None:
+    mapping_config_source = MappingConfigSource(location=config['mapping_config_file'],
+                                                check_interval=config['mapping_config_check_interval'])
+    try:
+        mapping_config_doc = mapping_config_source.poll(force=True)
+    except Exception:
+        logger.exception('Could not load the mapping configuration: {0}'.format(config['mapping_config_file']))
+if mapping_config_doc is not None:
+    apply_mapping_config(mapping_config_doc)
+else:
+    compile_attribute_transformers()
+# Emit the metrics of each invocation in the CloudWatch Embedded Metric Format.
+if config['metrics_enabled']:
+    metrics.add_sink(EMFSink(namespace=config['metrics_namespace']))
 # Make sure we leave traces behind that we're using caching or not.
 if config['use_object_cache']:
-    logger.info('Use of mnubo object cache enabled.')
+    logger.info('Use of mnubo object cache enabled with backend: {0}'.format(config['cache_backend']))
 else:
     logger.info('Use of mnubo object cache disabled.')
+# Open the connections before the first event.
+if config['warm_clients']:
+    warm_clients()
+logger.info('Function loaded in {0:.0f} ms.'.format((time.time() - load_start) * 1000))
 
 
 def iot_custom_event_handler(event, context):
     """ AWS Lambda handler to be triggered by the AWS IoT rules engine. To be used with events in a custom MQTT topic.
     :param event: A JSON document built by the rule
     :param context: A AWS Lambda Context object.
-    :return: True if it works, false if not.
+    :return: True if it works. Raises DeliveryFailed if the event could not be delivered, for Lambda to retry it.
     """
+    refresh_mapping_config()
+    set_invocation_deadline(context)
+    start = metrics_clock()
     try:
         # Map the event document to a mnubo event.
-        mnubo_event = map_iot_event_to_mnubo_event(event=copy.deepcopy(event))
+        with metrics.timer('map'):
+            mnubo_event = map_iot_event_to_mnubo_event(event=event)
         # Create the object if needed.
         manage_object(mnubo_event.device_id)
         # Send the event to the mnubo platform
@@ -375,6 +1618,8 @@ def iot_custom_event_handler(event, context):
     except Exception:
         logger.error('An unexpected error occurred: event data is: {0}'.format(str(event)))
         raise
+    finally:
+        flush_metrics(context, start)
     return rc
 
 
@@ -382,17 +1627,146 @@ def iot_shadow_update_event_handler(event, context):
     """ AWS Lambda handler to be triggered by the AWS IoT rules engine. To be used with shadow update documents.
     :param event: A shadow update JSON document.
     :param context: A AWS Lambda Context object.
-    :return: True if it works, false if not.
+    :return: True if it works. Raises DeliveryFailed if the event could not be delivered, for Lambda to retry it.
     """
+    refresh_mapping_config()
+    set_invocation_deadline(context)
+    start = metrics_clock()
     try:
         # Map the shadow update document to the mnubo event
-        mnubo_event = map_shadow_update_to_mnubo_event(event=copy.deepcopy(event))
-        # Create the object if needed.
-        manage_object(mnubo_event.device_id)
-        # Send the event to the mnubo platform
-        rc = send_mnubo_event(mnubo_event)
+        with metrics.timer('map'):
+            mnubo_event = map_shadow_update_to_mnubo_event(event=event)
+        if config['shadow_delta_suppression'] and not suppress_unchanged_values(mnubo_event):
+            # Nothing changed since the last update forwarded
+            return True
+        rc = False
+        try:
+            # Create the object if needed.
+            manage_object(mnubo_event.device_id)
+            # Send the event to the mnubo platform
+            rc = send_mnubo_event(mnubo_event)
+        finally:
+            if config['shadow_delta_suppression'] and not rc:
+                # It will be retried: its values must not be suppressed as if they had been forwarded
+                get_shadow_delta_filter().forget(mnubo_event.device_id)
         logger.info('Remaining time in ms: {0}'.format(context.get_remaining_time_in_millis()))
     except Exception:
         logger.error('An unexpected error occurred: event data is: {0}'.format(str(event)))
         raise
+    finally:
+        flush_metrics(context, start)
+    return rc
+
+
+def iot_custom_event_batch_handler(event, context):
+    """ AWS Lambda handler to be triggered with a batch of custom MQTT topic events (Kinesis, SQS or an IoT rule batch).
+    :param event: The batch of JSON documents built by the rule
+    :param context: A AWS Lambda Context object.
+    :return: A partial batch response listing the records to retry.
+    """
+    refresh_mapping_config()
+    set_invocation_deadline(context)
+    start = metrics_clock()
+    # The spilled events are sent first, but the replay can stop early: they may arrive after newer ones
+    replay_spilled_events()
+    rc = forward_event_batch(event=event, mapper=map_iot_event_to_mnubo_event,
+                             aggregate=config['aggregation_window'] > 0)
+    log_connection_stats()
+    flush_metrics(context, start)
+    logger.info('Failed records: {0}, remaining time in ms: {1}'
+                .format(len(rc['batchItemFailures']), context.get_remaining_time_in_millis()))
+    return rc
+
+
+def iot_shadow_update_event_batch_handler(event, context):
+    """ AWS Lambda handler to be triggered with a batch of shadow update documents (Kinesis, SQS or an IoT rule batch).
+    :param event: The batch of shadow update JSON documents.
+    :param context: A AWS Lambda Context object.
+    :return: A partial batch response listing the records to retry.
+    """
+    refresh_mapping_config()
+    set_invocation_deadline(context)
+    start = metrics_clock()
+    # The spilled events are sent first, but the replay can stop early: they may arrive after newer ones
+    replay_spilled_events()
+    rc = forward_event_batch(event=event, mapper=map_shadow_update_to_mnubo_event,
+                             suppress_unchanged=config['shadow_delta_suppression'])
+    log_connection_stats()
+    flush_metrics(context, start)
+    logger.info('Failed records: {0}, remaining time in ms: {1}'
+                .format(len(rc['batchItemFailures']), context.get_remaining_time_in_millis()))
+    return rc
+
+
+def replay_spilled_events_handler(event, context):
+    """ AWS Lambda handler to be triggered on a schedule, to replay the events spilled by the other handlers when the
+    mnubo platform was failing. Needed with the `sqs` spill queue, the batch handlers only replay a few requests
+    before their own work.
+    :param event: The scheduled event, not used
+    :param context: A AWS Lambda Context object.
+    :return: The number of requests replayed
+    """
+    set_invocation_deadline(context)
+    start = metrics_clock()
+    replayed = 0
+    try:
+        while True:
+            count = replay_spilled_events()
+            replayed += count
+            if count < config['spill_replay_max_batches']:
+                break
+    finally:
+        flush_metrics(context, start)
+    logger.info('Replayed requests: {0}, remaining time in ms: {1}'
+                .format(replayed, context.get_remaining_time_in_millis()))
+    return replayed
+
+
+def sync_objects_handler(event, context):
+    """ AWS Lambda handler to be triggered on a schedule, to send the changes of the AWS IoT device registry to the
+    mnubo platform. The things are listed page by page and only the objects whose attributes changed since they were
+    last sent are updated, in batch calls. The things without object get one. A page is only started if it is expected
+    to be done `time_budget_safety_margin` seconds before the invocation times out, the returned `nextToken` resumes
+    the sync.
+    :param event: The scheduled event. An optional `thingTypeName` limits the sync to a thing type, an optional
+    `nextToken` resumes a sync.
+    :param context: A AWS Lambda Context object.
+    :return: A dict with the numbers of `things` listed, of objects `updated` and `failed`, and the `nextToken` of the
+    sync, None once all the things were synced
+    """
+    refresh_mapping_config()
+    set_invocation_deadline(context)
+    start = metrics_clock()
+    event = event if isinstance(event, dict) else dict()
+    budget = get_time_budget()
+    next_token = event.get('nextToken', None)
+    rc = dict(things=0, updated=0, failed=0)
+    try:
+        while True:
+            if budget is not None and not budget.admit('sync_objects', 250):
+                break
+            page_start = time.time()
+            things, next_token = list_things_page(event.get('thingTypeName', None), next_token)
+            mnubo_objects = list()
+            for thing in things:
+                try:
+                    mnubo_objects.append(map_thing_to_smart_object(thing=thing))
+                except Exception:
+                    logger.exception('Could not map thing: {0}'.format(thing.get('thingName', None)))
+                    rc['failed'] += 1
+            updated, errors = sync_objects(mnubo_objects)
+            for device_id, message in errors.items():
+                logger.error('Could not update object {0}: {1}'.format(device_id, message))
+            rc['things'] += len(things)
+            rc['updated'] += len(updated)
+            rc['failed'] += len(errors)
+            if budget is not None:
+                budget.record('sync_objects', max(len(things), 1), time.time() - page_start)
+            if not next_token:
+                break
+    finally:
+        flush_metrics(context, start)
+    rc['nextToken'] = next_token
+    logger.info('Synced things: {0}, updated: {1}, failed: {2}, remaining time in ms: {3}'
+                .format(rc['things'], rc['updated'], rc['failed'], context.get_remaining_time_in_millis()))
     return rc
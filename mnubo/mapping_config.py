@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import os
+import json
+import time
+
+# The configuration keys that can be set globally and by event type or thing type
+RULE_KEYS = ['event_attributes_mapping', 'event_attributes_blacklist', 'smart_object_attributes_mapping',
+             'smart_object_attributes_blacklist']
+
+
+def parse_mapping_config(content, location):
+    """ Method to parse and validate a mapping configuration document.
+    :param content: The JSON or YAML document
+    :param location: The file path or S3 URL of the document, its extension selects the format
+    :return: The configuration dict
+    """
+    if location.endswith('.yaml') or location.endswith('.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise EnvironmentError('The PyYAML package is required to use a YAML mapping configuration')
+        doc = yaml.safe_load(content)
+    else:
+        if isinstance(content, bytes):
+            content = content.decode('utf-8')
+        doc = json.loads(content)
+    if doc is None:
+        doc = dict()
+    if not isinstance(doc, dict):
+        raise ValueError('The mapping configuration must be a dict')
+    for rules in [doc] + list(doc.get('event_types', dict()).values()) + list(doc.get('thing_types', dict()).values()):
+        if not isinstance(rules, dict):
+            raise ValueError('The mapping configuration rule sets must be dicts')
+        for key in RULE_KEYS:
+            if key.endswith('_mapping') and not isinstance(rules.get(key, dict()), dict):
+                raise ValueError('{0} must be a dict'.format(key))
+            if key.endswith('_blacklist') and not isinstance(rules.get(key, list()), list):
+                raise ValueError('{0} must be a list'.format(key))
+    return doc
+
+
+class MappingConfigSource(object):
+    """ A mapping configuration document stored in a local file or in S3 (`s3://bucket/key`). Changes are detected
+    cheaply, using the file modification time or the S3 object ETag, at most once every `check_interval` seconds.
+    """
+    def __init__(self, location, check_interval=60):
+        self.location = location
+        self.check_interval = check_interval
+        self.version = None
+        self.next_check = 0
+        # Created on the first check of an S3 location, then reused
+        self.s3_client = None
+
+    def _s3_location(self):
+        bucket, _, key = self.location[len('s3://'):].partition('/')
+        return bucket, key
+
+    def _s3(self):
+        if self.s3_client is None:
+            import boto3
+            self.s3_client = boto3.client('s3')
+        return self.s3_client
+
+    def _current_version(self):
+        if self.location.startswith('s3://'):
+            bucket, key = self._s3_location()
+            return self._s3().head_object(Bucket=bucket, Key=key)['ETag']
+        return os.stat(self.location).st_mtime
+
+    def _read(self):
+        if self.location.startswith('s3://'):
+            bucket, key = self._s3_location()
+            return self._s3().get_object(Bucket=bucket, Key=key)['Body'].read()
+        with open(self.location, 'rb') as f:
+            return f.read()
+
+    def poll(self, force=False):
+        """ Method to load the configuration if it changed since the last call.
+        :param force: If True, check for changes even if the check interval did not elapse
+        :return: The new configuration dict, or None if it did not change or was not checked
+        """
+        now = time.time()
+        if not force and now < self.next_check:
+            return None
+        self.next_check = now + self.check_interval
+        version = self._current_version()
+        if version == self.version:
+            return None
+        doc = parse_mapping_config(self._read(), self.location)
+        self.version = version
+        return doc
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import sys
+import json
+import time
+import threading
+
+# A monotonic clock where available, the wall clock otherwise (Python 2)
+clock = getattr(time, 'perf_counter', time.time)
+
+# Maximum number of metrics in a single CloudWatch Embedded Metric Format directive
+EMF_MAX_METRICS = 100
+
+
+class _Timer(object):
+    """ Context manager timing a stage, counting the errors raised in it. """
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.record_time(self.stage, clock() - self.start)
+        if exc_type is not None:
+            self.metrics.increment(self.stage + '_errors')
+        return False
+
+
+class Metrics(object):
+    """ Stage timers, counters and payload sizes collected during an invocation and flushed once at its end to the
+    sinks. The forwarding threads record into the same instance.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sinks = list()
+        self.timers = dict()
+        self.counters = dict()
+        self.sizes = dict()
+
+    def add_sink(self, sink):
+        """ Method to add a sink, called with each flushed snapshot.
+        :param sink: A method taking a snapshot dict and a dict of dimensions
+        """
+        self.sinks.append(sink)
+
+    def remove_sink(self, sink):
+        self.sinks.remove(sink)
+
+    def timer(self, stage):
+        """ Method to time a stage: `with metrics.timer('send_events'): ...`
+        :param stage: The name of the stage
+        :return: A context manager
+        """
+        return _Timer(self, stage)
+
+    def record_time(self, stage, seconds):
+        with self.lock:
+            found = self.timers.get(stage, None)
+            if found is None:
+                self.timers[stage] = [1, seconds, seconds]
+            else:
+                found[0] += 1
+                found[1] += seconds
+                if seconds > found[2]:
+                    found[2] = seconds
+
+    def increment(self, name, count=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def record_size(self, name, size):
+        with self.lock:
+            found = self.sizes.get(name, None)
+            if found is None:
+                self.sizes[name] = [1, size, size]
+            else:
+                found[0] += 1
+                found[1] += size
+                if size > found[2]:
+                    found[2] = size
+
+    def snapshot(self):
+        """ Method to return the metrics collected since the last flush.
+        :return: A dict with the `timers` (count, total_ms, max_ms by stage), the `counters` and the `sizes` (count,
+        total and max bytes by name)
+        """
+        with self.lock:
+            return self._snapshot()
+
+    def _snapshot(self):
+        return dict(timers=dict((stage, dict(count=t[0], total_ms=t[1] * 1000.0, max_ms=t[2] * 1000.0))
+                                for stage, t in self.timers.items()),
+                    counters=dict(self.counters),
+                    sizes=dict((name, dict(count=s[0], total=s[1], max=s[2])) for name, s in self.sizes.items()))
+
+    def reset(self):
+        with self.lock:
+            self.timers = dict()
+            self.counters = dict()
+            self.sizes = dict()
+
+    def flush(self, **dimensions):
+        """ Method to pass the metrics collected since the last flush to the sinks and start over.
+        :param dimensions: The dimensions of the metrics, the handler name for instance
+        :return: The snapshot of the flushed metrics
+        """
+        with self.lock:
+            snapshot = self._snapshot()
+            self.timers = dict()
+            self.counters = dict()
+            self.sizes = dict()
+        for sink in self.sinks:
+            sink(snapshot, dimensions)
+        return snapshot
+
+
+def emf_document(snapshot, namespace, dimensions, timestamp=None):
+    """ Method to format a metrics snapshot as a CloudWatch Embedded Metric Format document.
+    :param snapshot: A snapshot returned by Metrics.flush
+    :param namespace: The CloudWatch namespace of the metrics
+    :param dimensions: A dict of dimension name to value
+    :param timestamp: The epoch timestamp of the metrics, now by default
+    :return: The document dict, to be logged as a single JSON line
+    """
+    doc = dict(dimensions)
+    definitions = list()
+
+    def add(name, value, unit):
+        doc[name] = value
+        definitions.append(dict(Name=name, Unit=unit))
+
+    for stage, t in sorted(snapshot['timers'].items()):
+        add(stage + '_ms', round(t['total_ms'], 3), 'Milliseconds')
+        add(stage + '_max_ms', round(t['max_ms'], 3), 'Milliseconds')
+        add(stage + '_calls', t['count'], 'Count')
+    for name, value in sorted(snapshot['counters'].items()):
+        add(name, value, 'Count')
+    for name, s in sorted(snapshot['sizes'].items()):
+        add(name, s['total'], 'Bytes')
+        add(name + '_max', s['max'], 'Bytes')
+
+    doc['_aws'] = dict(Timestamp=int((timestamp or time.time()) * 1000),
+                       CloudWatchMetrics=[dict(Namespace=namespace, Dimensions=[sorted(dimensions.keys())],
+                                               Metrics=definitions[start:start + EMF_MAX_METRICS])
+                                          for start in range(0, len(definitions), EMF_MAX_METRICS)])
+    return doc
+
+
+class EMFSink(object):
+    """ Writes each flushed snapshot as a CloudWatch Embedded Metric Format line. In AWS Lambda, the lines written to
+    the standard output are turned into CloudWatch metrics without any API call.
+    """
+    def __init__(self, namespace, dimensions=None, stream=None):
+        """
+        :param namespace: The CloudWatch namespace of the metrics
+        :param dimensions: A dict of dimensions added to every snapshot, the function name for instance
+        :param stream: The file the lines are written to, the standard output by default
+        """
+        self.namespace = namespace
+        self.dimensions = dimensions or dict()
+        self.stream = stream
+
+    def __call__(self, snapshot, dimensions):
+        if not snapshot['timers'] and not snapshot['counters'] and not snapshot['sizes']:
+            return
+        doc = emf_document(snapshot, self.namespace, dict(self.dimensions, **dimensions))
+        stream = self.stream or sys.stdout
+        stream.write(json.dumps(doc, sort_keys=True) + '\n')
+        stream.flush()
+
+
+class MetricsAggregator(object):
+    """ Adds up the flushed snapshots, to collect the metrics of many invocations in the tests and the benchmarks. """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flushes = 0
+        self.timers = dict()
+        self.counters = dict()
+        self.sizes = dict()
+
+    def __call__(self, snapshot, dimensions):
+        with self.lock:
+            self.flushes += 1
+            for stage, t in snapshot['timers'].items():
+                found = self.timers.setdefault(stage, dict(count=0, total_ms=0.0, max_ms=0.0))
+                found['count'] += t['count']
+                found['total_ms'] += t['total_ms']
+                found['max_ms'] = max(found['max_ms'], t['max_ms'])
+            for name, value in snapshot['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, s in snapshot['sizes'].items():
+                found = self.sizes.setdefault(name, dict(count=0, total=0, max=0))
+                found['count'] += s['count']
+                found['total'] += s['total']
+                found['max'] = max(found['max'], s['max'])
+
+    def totals(self):
+        """ Method to return the metrics added up so far.
+        :return: A dict like the snapshots, plus the number of `flushes`
+        """
+        with self.lock:
+            return dict(flushes=self.flushes,
+                        timers=dict((stage, dict(t)) for stage, t in self.timers.items()),
+                        counters=dict(self.counters),
+                        sizes=dict((name, dict(s)) for name, s in self.sizes.items()))
@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import time
+import json
+import struct
+import hashlib
+import threading
+from array import array
+from lru import LRU
+
+
+def object_fingerprint(document):
+    """ Method to compute a stable fingerprint of a SmartObject, to detect the changes of its attributes.
+    :param document: The SmartObject dict, as built by SmartObject.build
+    :return: A positive 63 bits integer, the same for equal documents whatever the order of their keys
+    """
+    data = json.dumps(document, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8')
+    # 63 bits so it fits the signed integers of sqlite, 0 marks the missing fingerprints
+    return (struct.unpack('<Q', hashlib.md5(data).digest()[:8])[0] >> 1) or 1
+
+
+class ObjectCache(object):
+    """ Base class of the object existence cache backends. Entries map a device id to the epoch timestamp (in seconds)
+    until which the object is known to exist. Next to it, an entry can hold the fingerprint of the attributes last sent
+    for the object, see object_fingerprint.
+    """
+    def get(self, device_id):
+        """ Method to get the expiration timestamp of a device.
+        :param device_id: The device id of the object
+        :return: The expiration timestamp or None if the device is not cached
+        """
+        raise NotImplementedError()
+
+    def set(self, device_id, expires_at):
+        """ Method to cache a device.
+        :param device_id: The device id of the object
+        :param expires_at: The epoch timestamp until which the entry is valid
+        """
+        raise NotImplementedError()
+
+    def get_many(self, device_ids):
+        """ Method to get the expiration timestamps of many devices at once.
+        :param device_ids: A list of device ids
+        :return: A dict of device id to expiration timestamp, for the cached devices only
+        """
+        rc = dict()
+        for device_id in device_ids:
+            found = self.get(device_id)
+            if found is not None:
+                rc[device_id] = found
+        return rc
+
+    def set_many(self, entries):
+        """ Method to cache many devices at once.
+        :param entries: A dict of device id to expiration timestamp
+        """
+        for device_id, expires_at in entries.items():
+            self.set(device_id, expires_at)
+
+    def get_fingerprints(self, device_ids):
+        """ Method to get the fingerprints of the attributes last sent for many objects.
+        :param device_ids: A list of device ids
+        :return: A dict of device id to fingerprint, for the devices having one only
+        """
+        raise NotImplementedError()
+
+    def set_fingerprints(self, entries):
+        """ Method to store the fingerprints of the attributes sent for many objects.
+        :param entries: A dict of device id to fingerprint
+        """
+        raise NotImplementedError()
+
+
+class LRUObjectCache(ObjectCache):
+    """ In-process cache backed by a `lru.LRU`. Lives as long as the Lambda container. """
+    def __init__(self, max_entries):
+        if not isinstance(max_entries, int):
+            raise ValueError('cache_max_entries must be an integer')
+        # Device id to (expiration timestamp, fingerprint) tuples
+        self.lru = LRU(max_entries)
+
+    def get(self, device_id):
+        found = self.lru.get(device_id, None)
+        return found[0] if found is not None else None
+
+    def set(self, device_id, expires_at):
+        found = self.lru.get(device_id, None)
+        self.lru[device_id] = (expires_at, found[1] if found is not None else None)
+
+    def get_fingerprints(self, device_ids):
+        rc = dict()
+        for device_id in device_ids:
+            found = self.lru.get(device_id, None)
+            if found is not None and found[1] is not None:
+                rc[device_id] = found[1]
+        return rc
+
+    def set_fingerprints(self, entries):
+        for device_id, fingerprint in entries.items():
+            found = self.lru.get(device_id, None)
+            self.lru[device_id] = (found[0] if found is not None else 0, fingerprint)
+
+
+class CompactObjectCache(ObjectCache):
+    """ In-process cache bounded by a memory budget instead of a number of entries. Device ids are replaced by 64 bits
+    fingerprints and expirations by 32 bits tick counts, stored in flat arrays: 12 bytes per slot instead of a few
+    hundred bytes per LRU entry.
+
+    The table is set-associative: a device can only live in the `ways` slots following its hash. When they are all
+    taken, the entry expiring first is evicted. Expirations are rounded down to `resolution` seconds, so entries expire
+    up to `resolution` seconds early, never late.
+
+    Two device ids sharing a fingerprint are confused, so a lookup of an unknown device is a false positive with a
+    probability of at most `ways / 2 ** 64` (about 4e-19 with the default 8 ways), whatever the number of entries.
+
+    The attribute fingerprints are kept in the slot of their device, in a third array allocated when the first one is
+    stored: 8 more bytes per slot. They are evicted with their device, and only stored for the cached devices.
+
+    A slot is written in several arrays, so the lookups hold the lock too: a lookup running along an eviction would
+    otherwise find the device id of one entry with the expiration of the other.
+    """
+    SLOT_SIZE = 12
+
+    def __init__(self, memory_budget, resolution=60, ways=8):
+        """
+        :param memory_budget: Memory budget of the cache, in bytes
+        :param resolution: Granularity of the expiration timestamps, in seconds
+        :param ways: Number of slots a device id can be stored in
+        """
+        if not isinstance(memory_budget, int) or memory_budget < self.SLOT_SIZE * ways:
+            raise ValueError('cache_max_memory must be an integer of at least {0} bytes'.format(self.SLOT_SIZE * ways))
+        self.slots = memory_budget // self.SLOT_SIZE
+        self.resolution = resolution
+        self.ways = ways
+        self.base = int(time.time()) // resolution
+        self.fingerprints = array('Q', [0]) * self.slots
+        self.expirations = array('I', [0]) * self.slots
+        self.attributes = None
+        self.lock = threading.Lock()
+
+    def _fingerprint(self, device_id):
+        if not isinstance(device_id, bytes):
+            device_id = device_id.encode('utf-8')
+        fingerprint = struct.unpack('<Q', hashlib.md5(device_id).digest()[:8])[0]
+        # 0 marks the empty slots
+        return fingerprint or 1
+
+    def _ticks(self, expires_at):
+        return min(max(expires_at // self.resolution - self.base, 0), 0xFFFFFFFF)
+
+    def _slot(self, fingerprint):
+        start = fingerprint % self.slots
+        for i in range(self.ways):
+            slot = (start + i) % self.slots
+            found = self.fingerprints[slot]
+            if found == fingerprint:
+                return slot
+            if found == 0:
+                return None
+        return None
+
+    def get(self, device_id):
+        fingerprint = self._fingerprint(device_id)
+        with self.lock:
+            slot = self._slot(fingerprint)
+            if slot is None:
+                return None
+            ticks = self.expirations[slot]
+        return (self.base + ticks) * self.resolution
+
+    def set(self, device_id, expires_at):
+        fingerprint = self._fingerprint(device_id)
+        start = fingerprint % self.slots
+        ticks = self._ticks(expires_at)
+        with self.lock:
+            victim = start
+            for i in range(self.ways):
+                slot = (start + i) % self.slots
+                found = self.fingerprints[slot]
+                if found == fingerprint or found == 0:
+                    victim = slot
+                    break
+                if self.expirations[slot] < self.expirations[victim]:
+                    victim = slot
+            if self.attributes is not None and self.fingerprints[victim] != fingerprint:
+                self.attributes[victim] = 0
+            self.fingerprints[victim] = fingerprint
+            self.expirations[victim] = ticks
+
+    def get_fingerprints(self, device_ids):
+        rc = dict()
+        if self.attributes is None:
+            return rc
+        fingerprints = [(device_id, self._fingerprint(device_id)) for device_id in device_ids]
+        with self.lock:
+            for device_id, fingerprint in fingerprints:
+                slot = self._slot(fingerprint)
+                if slot is not None and self.attributes[slot]:
+                    rc[device_id] = self.attributes[slot]
+        return rc
+
+    def set_fingerprints(self, entries):
+        with self.lock:
+            if self.attributes is None:
+                self.attributes = array('Q', [0]) * self.slots
+            for device_id, fingerprint in entries.items():
+                slot = self._slot(self._fingerprint(device_id))
+                if slot is not None:
+                    self.attributes[slot] = fingerprint
+
+
+class RedisObjectCache(ObjectCache):
+    """ Cache shared by all the Lambda containers, stored in Redis. Entries also get a Redis TTL so they expire on
+    their own, along with the fingerprint of their device: the fingerprints are only stored for the cached devices.
+    Requires the `redis` package.
+    """
+    def __init__(self, url, key_prefix='mnubo:object:', fingerprint_prefix='mnubo:fingerprint:', client=None):
+        """
+        :param url: The Redis URL
+        :param key_prefix: The prefix of the keys of the entries
+        :param fingerprint_prefix: The prefix of the keys of the fingerprints
+        :param client: An optional Redis client, used instead of connecting to url
+        """
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise EnvironmentError('The redis package is required to use the redis object cache backend')
+            client = redis.StrictRedis.from_url(url)
+        self.client = client
+        self.key_prefix = key_prefix
+        self.fingerprint_prefix = fingerprint_prefix
+
+    def get(self, device_id):
+        found = self.client.get(self.key_prefix + device_id)
+        return int(found) if found is not None else None
+
+    def get_many(self, device_ids):
+        if not device_ids:
+            return dict()
+        values = self.client.mget([self.key_prefix + device_id for device_id in device_ids])
+        return dict((device_id, int(v)) for device_id, v in zip(device_ids, values) if v is not None)
+
+    def set(self, device_id, expires_at):
+        self.set_many({device_id: expires_at})
+
+    def set_many(self, entries):
+        now = int(time.time())
+        pipe = self.client.pipeline(transaction=False)
+        for device_id, expires_at in entries.items():
+            if expires_at > now:
+                pipe.set(self.key_prefix + device_id, expires_at, ex=expires_at - now)
+                # A no-op for the devices without fingerprint
+                pipe.expire(self.fingerprint_prefix + device_id, expires_at - now)
+        pipe.execute()
+
+    def get_fingerprints(self, device_ids):
+        if not device_ids:
+            return dict()
+        values = self.client.mget([self.fingerprint_prefix + device_id for device_id in device_ids])
+        return dict((device_id, int(v)) for device_id, v in zip(device_ids, values) if v is not None)
+
+    def set_fingerprints(self, entries):
+        if not entries:
+            return
+        # Given the TTL of their entry, so that the devices that are not seen anymore do not stay in Redis
+        device_ids = list(entries.keys())
+        now = int(time.time())
+        pipe = self.client.pipeline(transaction=False)
+        for device_id, expires_at in self.get_many(device_ids).items():
+            if expires_at > now:
+                pipe.set(self.fingerprint_prefix + device_id, entries[device_id], ex=expires_at - now)
+        pipe.execute()
+
+
+class SqliteObjectCache(ObjectCache):
+    """ Cache stored in a local sqlite database file. Shared by the processes of a host, mainly meant for local
+    testing of the shared cache behaviour.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        import sqlite3
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.db.execute('CREATE TABLE IF NOT EXISTS objects (device_id TEXT PRIMARY KEY, expires_at INTEGER)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS fingerprints (device_id TEXT PRIMARY KEY, fingerprint INTEGER)')
+            self.db.commit()
+
+    def get(self, device_id):
+        with self.lock:
+            row = self.db.execute('SELECT expires_at FROM objects WHERE device_id = ?', (device_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_many(self, device_ids):
+        return self._select('SELECT device_id, expires_at FROM objects WHERE device_id IN ({0})', device_ids)
+
+    def _select(self, query, device_ids):
+        rc = dict()
+        # Stay under the sqlite host parameters limit
+        for start in range(0, len(device_ids), 500):
+            chunk = device_ids[start:start + 500]
+            with self.lock:
+                rc.update(self.db.execute(query.format(','.join('?' * len(chunk))), chunk).fetchall())
+        return rc
+
+    def set(self, device_id, expires_at):
+        self.set_many({device_id: expires_at})
+
+    def set_many(self, entries):
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO objects (device_id, expires_at) VALUES (?, ?)',
+                                list(entries.items()))
+            self.db.commit()
+
+    def get_fingerprints(self, device_ids):
+        return self._select('SELECT device_id, fingerprint FROM fingerprints WHERE device_id IN ({0})', device_ids)
+
+    def set_fingerprints(self, entries):
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO fingerprints (device_id, fingerprint) VALUES (?, ?)',
+                                list(entries.items()))
+            self.db.commit()
+
+
+class TieredObjectCache(ObjectCache):
+    """ Read-through cache: a local cache in front of a shared one. Hits in the shared cache are copied in the local
+    cache with their original expiration timestamp, so the validity period is the same in both tiers.
+    """
+    def __init__(self, local, shared):
+        self.local = local
+        self.shared = shared
+
+    def get(self, device_id):
+        now = int(time.time())
+        found = self.local.get(device_id)
+        if found is not None and found > now:
+            return found
+        found = self.shared.get(device_id)
+        if found is not None and found > now:
+            self.local.set(device_id, found)
+        return found
+
+    def get_many(self, device_ids):
+        now = int(time.time())
+        rc = self.local.get_many(device_ids)
+        misses = [device_id for device_id in device_ids if not rc.get(device_id, 0) > now]
+        if misses:
+            shared = self.shared.get_many(misses)
+            self.local.set_many(dict((k, v) for k, v in shared.items() if v > now))
+            rc.update(shared)
+        return rc
+
+    def set(self, device_id, expires_at):
+        self.local.set(device_id, expires_at)
+        self.shared.set(device_id, expires_at)
+
+    def set_many(self, entries):
+        self.local.set_many(entries)
+        self.shared.set_many(entries)
+
+    def get_fingerprints(self, device_ids):
+        rc = self.local.get_fingerprints(device_ids)
+        misses = [device_id for device_id in device_ids if device_id not in rc]
+        if misses:
+            shared = self.shared.get_fingerprints(misses)
+            self.local.set_fingerprints(shared)
+            rc.update(shared)
+        return rc
+
+    def set_fingerprints(self, entries):
+        self.local.set_fingerprints(entries)
+        self.shared.set_fingerprints(entries)
+
+
+def build_object_cache(backend, max_entries, url=None, local_tier=True, max_memory=None):
+    """ Method to build the object cache selected by the configuration.
+    :param backend: 'lru', 'compact', 'redis' or 'sqlite'
+    :param max_entries: The maximum number of entries of the local LRU cache
+    :param max_memory: The memory budget in bytes of the compact cache
+    :param url: The redis URL or the sqlite database path of the shared backends
+    :param local_tier: If True, put a local LRU cache in front of the shared backends
+    :return: An ObjectCache
+    """
+    if backend == 'lru':
+        return LRUObjectCache(max_entries)
+    elif backend == 'compact':
+        return CompactObjectCache(max_memory)
+    elif backend == 'redis':
+        shared = RedisObjectCache(url)
+    elif backend == 'sqlite':
+        shared = SqliteObjectCache(url)
+    else:
+        raise EnvironmentError('Do not know about object cache backend {0}'.format(backend))
+    if local_tier:
+        return TieredObjectCache(LRUObjectCache(max_entries), shared)
+    return shared
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import time
+import random
+import logging
+import threading
+
+logger = logging.getLogger()
+
+
+class AdaptiveBackoff(object):
+    """ Retries the calls rejected because of throttling, adapting a delay shared by all the threads making the calls.
+    Each throttled call doubles the delay, each successful call halves it, and every call waits for the current delay
+    first: concurrent callers slow down together instead of all retrying at once.
+    """
+    def __init__(self, is_throttled, max_attempts=5, initial_delay=0.1, max_delay=5.0):
+        """
+        :param is_throttled: Method taking an exception and returning True if it is a throttling error
+        :param max_attempts: Maximum number of attempts of a call
+        :param initial_delay: Delay in seconds after the first throttled call
+        :param max_delay: Maximum delay in seconds
+        """
+        self.is_throttled = is_throttled
+        self.max_attempts = max_attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.delay = 0.0
+        self.lock = threading.Lock()
+
+    def _throttled(self):
+        with self.lock:
+            self.delay = min(self.max_delay, max(self.initial_delay, self.delay * 2))
+
+    def _succeeded(self):
+        with self.lock:
+            self.delay = self.delay / 2 if self.delay > self.initial_delay else 0.0
+
+    def call(self, fn, *args, **kwargs):
+        """ Method to make a call, retrying it while it is throttled.
+        :param fn: The method to call
+        :return: The result of the call
+        """
+        attempt = 1
+        while True:
+            if self.delay:
+                # Full jitter so the waiting threads do not retry in lockstep
+                time.sleep(random.uniform(self.delay / 2, self.delay))
+            try:
+                rc = fn(*args, **kwargs)
+            except Exception as e:
+                if not self.is_throttled(e) or attempt >= self.max_attempts:
+                    raise
+                self._throttled()
+                logger.warning('Throttled, attempt {0} of {1}, delay is now {2:.2f}s'
+                               .format(attempt, self.max_attempts, self.delay))
+                attempt += 1
+                continue
+            self._succeeded()
+            return rc
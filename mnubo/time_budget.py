@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import time
+import logging
+import threading
+
+logger = logging.getLogger()
+
+
+class CostEstimator(object):
+    """ Learns the time taken per record by each stage of the forwarding from the live calls. Like the TCP
+    retransmission timeout, an estimate is the moving average of the cost plus four times its moving mean deviation,
+    so variable latencies make the estimates more cautious.
+    """
+    def __init__(self, alpha=0.125, beta=0.25):
+        """
+        :param alpha: Weight of a new measure in the moving average
+        :param beta: Weight of a new measure in the moving mean deviation
+        """
+        self.alpha = alpha
+        self.beta = beta
+        self.lock = threading.Lock()
+        # (average, mean deviation) of the seconds per record, by stage
+        self.costs = dict()
+
+    def record(self, stage, records, seconds):
+        """ Method to record the time taken by a call.
+        :param stage: The name of the stage, 'send_events' for instance
+        :param records: The number of records handled by the call
+        :param seconds: The time taken by the call
+        """
+        if records < 1:
+            return
+        cost = seconds / float(records)
+        with self.lock:
+            found = self.costs.get(stage, None)
+            if found is None:
+                self.costs[stage] = (cost, cost / 2)
+            else:
+                average, deviation = found
+                deviation = (1 - self.beta) * deviation + self.beta * abs(cost - average)
+                average = (1 - self.alpha) * average + self.alpha * cost
+                self.costs[stage] = (average, deviation)
+
+    def estimate(self, stage, records):
+        """ Method to estimate the time a call will take.
+        :param stage: The name of the stage
+        :param records: The number of records the call will handle
+        :return: The estimated seconds, 0 until a call of the stage was recorded
+        """
+        with self.lock:
+            found = self.costs.get(stage, None)
+        if found is None:
+            return 0.0
+        return (found[0] + 4 * found[1]) * records
+
+
+class TimeBudget(object):
+    """ The time left to an invocation. New work is only admitted while it is expected to be done `safety_margin`
+    seconds before the deadline. Once some work is refused, no more work is admitted: the records are left for the
+    next invocation, and the events of a device are never sent after later events of the same device.
+    """
+    def __init__(self, deadline, estimator, safety_margin=3.0, clock=time.time):
+        """
+        :param deadline: The time (as returned by the clock) at which the invocation times out
+        :param estimator: The CostEstimator, usually kept across the invocations
+        :param safety_margin: Seconds kept to finish the invocation
+        :param clock: Method returning the current time in seconds
+        """
+        self.deadline = deadline
+        self.estimator = estimator
+        self.safety_margin = safety_margin
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.closed = False
+        self.deferred = 0
+
+    def remaining(self):
+        return self.deadline - self.clock()
+
+    def admit(self, stage, records):
+        """ Method to tell if some work can start now.
+        :param stage: The name of the stage doing the work
+        :param records: The number of records it handles
+        :return: True if it can start, False if its records must be left for the next invocation, see defer
+        """
+        with self.lock:
+            if self.closed:
+                return False
+            expected = self.estimator.estimate(stage, records)
+            if self.clock() + expected + self.safety_margin < self.deadline:
+                return True
+            logger.warning('Running out of time: {0:.2f}s left, {1} of {2} records expected to take {3:.2f}s. '
+                           'No more work is started.'.format(self.remaining(), stage, records, expected))
+            self.closed = True
+            return False
+
+    def defer(self, records):
+        """ Method to count the records left for the next invocation.
+        :param records: The number of records
+        """
+        with self.lock:
+            self.deferred += records
+
+    def record(self, stage, records, seconds):
+        """ Method to record the time taken by some admitted work, see CostEstimator.record. """
+        self.estimator.record(stage, records, seconds)
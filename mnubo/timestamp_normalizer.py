@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import re
+import math
+import datetime
+import six
+from lru import LRU
+
+EPOCH = datetime.datetime(1970, 1, 1)
+# Epochs below these magnitudes are in seconds, milliseconds and microseconds, above in nanoseconds. Seconds cover
+# the years up to 5138, and milliseconds from 1973 on.
+SECONDS_LIMIT = 10 ** 11
+MILLISECONDS_LIMIT = 10 ** 14
+MICROSECONDS_LIMIT = 10 ** 17
+# Divisor of each unit to get seconds, and to get microseconds
+UNITS = [(SECONDS_LIMIT, 1, 10 ** 6), (MILLISECONDS_LIMIT, 1000, 1000), (MICROSECONDS_LIMIT, 10 ** 6, 1)]
+NANOSECONDS = (None, 10 ** 9, None)
+# Below this number of timestamps, the batch API does not bother with NumPy
+NUMPY_MIN_BATCH = 256
+# Epochs at or above this magnitude do not fit in NumPy integers, they are converted one by one
+NUMPY_MAX_EPOCH = 2 ** 63
+
+NUMBER_TYPES = (float,) + six.integer_types
+NUMERIC_STRING = re.compile(r'^-?\d+(\.\d+)?$')
+
+# ISO strings of whole seconds, by epoch second
+seconds_cache = LRU(4096)
+# The numpy module, False if it is not available, None if not imported yet
+numpy_module = None
+
+
+def epoch_unit(ts):
+    """ Method to detect the unit of an epoch timestamp from its magnitude.
+    :param ts: An epoch timestamp in seconds, milliseconds, microseconds or nanoseconds
+    :return: A (limit, divisor to seconds, divisor to microseconds) tuple
+    """
+    magnitude = abs(ts)
+    for unit in UNITS:
+        if magnitude < unit[0]:
+            return unit
+    return NANOSECONDS
+
+
+def iso_second(second):
+    """ Method to format an epoch second, from a cache since many events share the same second.
+    :param second: An integer epoch timestamp in seconds
+    :return: The ISO 8601 string, without fraction and time zone
+    """
+    found = seconds_cache.get(second, None)
+    if found is None:
+        found = (EPOCH + datetime.timedelta(seconds=second)).isoformat()
+        seconds_cache[second] = found
+    return found
+
+
+def iso_from_microseconds(second, micro):
+    if micro:
+        return '%s.%06d' % (iso_second(second), micro)
+    return iso_second(second)
+
+
+def normalize_timestamp(ts):
+    """ Method to convert a timestamp to the ISO 8601 format, as `datetime.isoformat` does for naive UTC datetimes.
+    :param ts: An epoch timestamp in seconds, milliseconds, microseconds or nanoseconds (detected from its magnitude),
+    as a number or a string of digits. Other strings are expected to already be ISO 8601 timestamps.
+    :return: The ISO 8601 string, the string passed to it or None
+    """
+    if ts is None or isinstance(ts, bool):
+        return ts
+    if isinstance(ts, six.string_types):
+        if not NUMERIC_STRING.match(ts):
+            return ts
+        ts = float(ts) if '.' in ts else int(ts)
+    _, to_seconds, to_micro = epoch_unit(ts)
+    if isinstance(ts, six.integer_types):
+        if to_micro is None:
+            # Nanoseconds, truncated to the microsecond
+            second, rest = divmod(ts, to_seconds)
+            return iso_from_microseconds(second, rest // 1000)
+        second, rest = divmod(ts, to_seconds)
+        return iso_from_microseconds(second, rest * to_micro)
+    # Floats are rounded to the microsecond like datetime.utcfromtimestamp does
+    fraction, second = math.modf(ts / float(to_seconds))
+    second = int(second)
+    micro = int(round(fraction * 10 ** 6))
+    if micro >= 10 ** 6:
+        second += 1
+        micro -= 10 ** 6
+    elif micro < 0:
+        second -= 1
+        micro += 10 ** 6
+    return iso_from_microseconds(second, micro)
+
+
+def get_numpy():
+    global numpy_module
+    if numpy_module is None:
+        try:
+            import numpy
+            numpy_module = numpy
+        except ImportError:
+            numpy_module = False
+    return numpy_module
+
+
+def numpy_microseconds(np, column):
+    """ Method to scale a column of epochs to microseconds, each according to its own unit.
+    :param np: The numpy module
+    :param column: A NumPy array of int64 or float64 epochs
+    :return: A NumPy array of int64 microseconds
+    """
+    magnitude = np.abs(column)
+    units = [magnitude < SECONDS_LIMIT, magnitude < MILLISECONDS_LIMIT, magnitude < MICROSECONDS_LIMIT]
+    if column.dtype.kind == 'i':
+        # Exact integer arithmetic, nanoseconds are truncated to the microsecond
+        return np.select(units, [column * 10 ** 6, column * 1000, column], column // 1000)
+    fraction, seconds = np.modf(column / np.select(units, [1.0, 1e3, 1e6], 1e9))
+    return seconds.astype(np.int64) * 10 ** 6 + np.round(fraction * 1e6).astype(np.int64)
+
+
+def normalize_timestamps(values):
+    """ Method to normalize a whole column of timestamps, like normalize_timestamp does for each of them. The numeric
+    epochs of large columns are converted at once with NumPy when it is available. Like normalize_timestamp, it raises
+    ValueError or OverflowError when a timestamp is out of range, infinite or NaN.
+    :param values: A list of timestamps
+    :return: The list of the normalized timestamps
+    """
+    integers = list()
+    floats = list()
+    for i, ts in enumerate(values):
+        if not isinstance(ts, NUMBER_TYPES) or isinstance(ts, bool) or abs(ts) >= NUMPY_MAX_EPOCH:
+            continue
+        if not isinstance(ts, float):
+            integers.append(i)
+        elif not math.isnan(ts):
+            floats.append(i)
+    np = get_numpy() if len(integers) + len(floats) >= NUMPY_MIN_BATCH else False
+    if not np:
+        return [normalize_timestamp(ts) for ts in values]
+
+    # The numbers are replaced below, the other values go through normalize_timestamp
+    numbers = set(integers).union(floats)
+    rc = [ts if i in numbers else normalize_timestamp(ts) for i, ts in enumerate(values)]
+    for indexes, dtype in ((integers, np.int64), (floats, np.float64)):
+        if not indexes:
+            continue
+        micros = numpy_microseconds(np, np.array([values[i] for i in indexes], dtype=dtype))
+        strings = np.datetime_as_string(micros.astype('datetime64[us]'), unit='us').tolist()
+        # isoformat only shows the fraction when there is one
+        for i, string, whole in zip(indexes, strings, (micros % 10 ** 6 == 0).tolist()):
+            rc[i] = string[:-7] if whole else string
+    return rc
@@ -0,0 +1,208 @@
+""" Local HTTP stand-in for the SmartObjects API and the AWS IoT thing registry API, used by the tests and the
+benchmarks. Point the forwarder at it with `MNUBO_ENV=<url>` and `IOT_API_ENDPOINT=<url>`.
+"""
+
+import io
+import gzip
+import json
+import time
+import random
+import threading
+from collections import Counter
+from six.moves.urllib.parse import urlparse
+from six.moves.urllib.parse import parse_qs
+from six.moves.urllib.parse import unquote
+from six.moves.BaseHTTPServer import HTTPServer
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
+
+
+class StubState(object):
+    """ The objects, owners, things and events known to the stub, and the number of calls by route. """
+    def __init__(self, latency=0.0, error_rate=0.0, max_request_bytes=None, keep_events=True):
+        """
+        :param latency: Seconds added to each API call
+        :param error_rate: Ratio of the API calls answered with a 503
+        :param max_request_bytes: Size above which the events requests are answered with a 413, as sent on the wire
+        :param keep_events: If False, the events are only counted, for the long benchmarks
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_request_bytes = max_request_bytes
+        self.keep_events = keep_events
+        self.lock = threading.Lock()
+        self.objects = dict()
+        # Device ids of the objects the batch object calls reject
+        self.rejected = set()
+        # Device ids whose events make the whole events request answered with a 400
+        self.invalid_events = set()
+        self.owners = set()
+        self.things = dict()
+        self.events = list()
+        self.event_count = 0
+        # Size on the wire and content encoding of the events requests
+        self.event_requests = list()
+        # The device ids of each bulk object existence request
+        self.exists_lookups = list()
+        self.calls = Counter()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def add_thing(self, thing_name, thing_type_name=None, attributes=None):
+        self.things[thing_name] = dict(thingName=thing_name, thingTypeName=thing_type_name,
+                                       attributes=attributes or dict())
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send the headers and the body in one segment, so the delayed acknowledgements do not add 40ms to each call
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get('content-length', 0))
+        data = self.rfile.read(length) if length else b''
+        if self.headers.get('content-encoding', None) == 'gzip':
+            data = gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+        return json.loads(data.decode('utf-8')) if data else None
+
+    def _reply(self, status, doc=None):
+        data = json.dumps(doc).encode('utf-8') if doc is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, method):
+        state = self.server.state
+        url = urlparse(self.path)
+        parts = [unquote(p) for p in url.path.strip('/').split('/')]
+        body = self._body() if method in ('POST', 'PUT') else None
+        if method == 'HEAD' or parts[0] == 'oauth':
+            return self._reply(200, None if method == 'HEAD' else dict(access_token='token', expires_in=3600))
+
+        with state.lock:
+            state.in_flight += 1
+            state.max_in_flight = max(state.max_in_flight, state.in_flight)
+        try:
+            if state.latency:
+                time.sleep(state.latency)
+            if state.error_rate and random.random() < state.error_rate:
+                return self._reply(503, dict(message='Injected error'))
+            with state.lock:
+                return self._route(state, method, parts, parse_qs(url.query), body)
+        finally:
+            with state.lock:
+                state.in_flight -= 1
+
+    def _count(self, state, name):
+        state.calls[name] += 1
+
+    def _route(self, state, method, parts, query, body):
+        if parts[:1] == ['things']:
+            if len(parts) == 2:
+                self._count(state, 'describe_thing')
+                thing = state.things.get(parts[1], None)
+                if thing is None:
+                    return self._reply(404, dict(message='Thing not found'))
+                return self._reply(200, dict(thing, version=1, defaultClientId=parts[1]))
+            self._count(state, 'list_things')
+            things = sorted(state.things.values(), key=lambda t: t['thingName'])
+            type_name = query.get('thingTypeName', [None])[0]
+            if type_name is not None:
+                things = [t for t in things if t['thingTypeName'] == type_name]
+            start = int(query.get('nextToken', ['0'])[0])
+            size = int(query.get('maxResults', ['100'])[0])
+            rc = dict(things=things[start:start + size])
+            if start + size < len(things):
+                rc['nextToken'] = str(start + size)
+            return self._reply(200, rc)
+
+        resource = parts[2:]
+        if resource[:2] == ['objects', 'exists']:
+            if method == 'GET':
+                self._count(state, 'object_exists')
+                return self._reply(200, {resource[2]: resource[2] in state.objects})
+            self._count(state, 'objects_exist')
+            state.exists_lookups.append(list(body))
+            return self._reply(200, [{d: d in state.objects} for d in body])
+        if resource[:2] == ['owners', 'exists']:
+            if method == 'GET':
+                self._count(state, 'owner_exists')
+                return self._reply(200, {resource[2]: resource[2] in state.owners})
+            self._count(state, 'owners_exist')
+            return self._reply(200, [{u: u in state.owners} for u in body])
+        if resource == ['objects'] and method == 'POST':
+            self._count(state, 'create_object')
+            if body['x_device_id'] in state.objects:
+                return self._reply(409, dict(message='Object with device id already exists'))
+            state.objects[body['x_device_id']] = body
+            return self._reply(201)
+        if resource == ['objects'] and method == 'PUT':
+            self._count(state, 'create_update_objects')
+            results = list()
+            for obj in body:
+                if obj['x_device_id'] in state.rejected:
+                    results.append(dict(id=obj['x_device_id'], result='error', message='Invalid object'))
+                    continue
+                state.objects[obj['x_device_id']] = dict(state.objects.get(obj['x_device_id'], dict()), **obj)
+                results.append(dict(id=obj['x_device_id'], result='success'))
+            return self._reply(200, results)
+        if resource[:1] == ['objects'] and method == 'PUT':
+            self._count(state, 'update_object')
+            state.objects[resource[1]].update(body)
+            return self._reply(200)
+        if resource == ['events']:
+            self._count(state, 'send_events')
+            length = int(self.headers.get('content-length', 0))
+            if state.max_request_bytes is not None and length > state.max_request_bytes:
+                return self._reply(413, dict(message='Request entity too large'))
+            if any(e['x_object']['x_device_id'] in state.invalid_events for e in body):
+                return self._reply(400, dict(message='Invalid event'))
+            state.event_requests.append((length, self.headers.get('content-encoding', None)))
+            state.event_count += len(body)
+            if state.keep_events:
+                state.events.extend(body)
+            return self._reply(200, [dict(result='success', objectExists=e['x_object']['x_device_id'] in state.objects)
+                                     for e in body])
+        return self._reply(404, dict(message='Unknown route'))
+
+    def do_HEAD(self):
+        self._handle('HEAD')
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+
+class StubServer(object):
+    """ Runs the stub on a random local port, in a background thread. """
+    def __init__(self, latency=0.0, error_rate=0.0, max_request_bytes=None, keep_events=True, port=0):
+        self.state = StubState(latency=latency, error_rate=error_rate, max_request_bytes=max_request_bytes,
+                               keep_events=keep_events)
+        self.server = _ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        self.server.state = self.state
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,79 @@
+import os
+import gzip
+import json
+import shutil
+import tempfile
+import unittest
+import backfill
+from tests.stubs import StubServer
+
+forwarder = backfill.forwarder
+
+
+class TestBackfill(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubServer().__enter__()
+        self.saved_config = dict(forwarder.config)
+        self.directory = tempfile.mkdtemp()
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'test')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'test')
+        forwarder.config.update(environment=self.stub.url, iot_endpoint=self.stub.url, client_id='id',
+                                client_secret='secret', cache_backend='lru')
+        forwarder.reset_state()
+
+    def tearDown(self):
+        forwarder.config.update(self.saved_config)
+        forwarder.reset_state()
+        shutil.rmtree(self.directory)
+        self.stub.__exit__()
+
+    def write_jsonl(self, name, docs):
+        path = os.path.join(self.directory, name)
+        with (gzip.open(path, 'wb') if name.endswith('.gz') else open(path, 'wb')) as f:
+            for doc in docs:
+                f.write(json.dumps(doc).encode('utf-8') + b'\n')
+        return path
+
+    def test_replay_gzipped_events_and_resume(self):
+        state = self.stub.state
+        state.add_thing('thing-0', 'sensor')
+        state.add_thing('thing-1', 'sensor')
+        path = self.write_jsonl('events.jsonl.gz', [dict(device_id='thing-{0}'.format(i % 3), sequence=i)
+                                                    for i in range(30)])
+        checkpoint = os.path.join(self.directory, 'checkpoint.json')
+        failures = os.path.join(self.directory, 'failures.jsonl')
+        argv = ['--batch-size', '7', '--workers', '2', '--checkpoint', checkpoint, '--failures', failures, path]
+
+        # thing-2 is not in the registry
+        self.assertEqual(backfill.main(argv), 1)
+        self.assertEqual(len(state.events), 20)
+        with open(failures, 'rb') as f:
+            self.assertEqual([json.loads(line)['sequence'] for line in f], list(range(2, 30, 3)))
+        with open(checkpoint) as f:
+            self.assertEqual(json.load(f)[os.path.abspath(path)]['records'], 30)
+
+        # Everything was processed, nothing is sent again
+        self.assertEqual(backfill.main(argv), 0)
+        self.assertEqual(len(state.events), 20)
+        pass
+
+    def test_resume_from_checkpoint_offset(self):
+        path = self.write_jsonl('events.jsonl', [dict(sequence=i) for i in range(10)])
+        batches = list(backfill.read_batches(path, 4))
+        self.assertEqual([len(lines) for _, lines in batches], [4, 4, 2])
+        rest = list(backfill.read_batches(path, 4, offset=batches[0][0]))
+        self.assertEqual([json.loads(line)['sequence'] for _, lines in rest for line in lines], list(range(4, 10)))
+        pass
+
+    def test_registry_export(self):
+        state = self.stub.state
+        path = self.write_jsonl('things.jsonl', [dict(thingName='thing-{0}'.format(i), thingTypeName='sensor',
+                                                      attributes=dict(model='m1')) for i in range(25)] +
+                                [dict(thingTypeName='sensor')])
+
+        self.assertEqual(backfill.main(['--mode', 'things', '--workers', '3', path]), 1)
+        self.assertEqual(len(state.objects), 25)
+        self.assertEqual(state.calls['create_update_objects'], 3)
+        self.assertEqual(state.objects['thing-7']['model'], 'm1')
+        pass
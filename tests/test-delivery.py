@@ -0,0 +1,260 @@
+import os
+import shutil
+import tempfile
+import unittest
+import requests
+from mnubo import CircuitBreaker
+from mnubo import CircuitOpen
+from mnubo import DeliveryFailed
+from mnubo import RetryPolicy
+from mnubo import DiskSpillQueue
+from mnubo import build_spill_queue
+from mnubo import MetricsAggregator
+import lambda_mnubo_forwarder as forwarder
+from tests.stubs import StubServer
+
+
+class Context(object):
+    def get_remaining_time_in_millis(self):
+        return 60000
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class Unavailable(Exception):
+    pass
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def failing(self, failures, error=Unavailable):
+        calls = list()
+
+        def fn(value):
+            calls.append(value)
+            if len(calls) <= failures:
+                raise error()
+            return value
+        return fn, calls
+
+    def test_retries_the_transient_errors(self):
+        clock = FakeClock()
+        policy = RetryPolicy(lambda e: isinstance(e, Unavailable), max_attempts=4, clock=clock, sleep=clock.sleep)
+        fn, calls = self.failing(2)
+
+        self.assertEqual(policy.call(fn, 'x'), 'x')
+        self.assertEqual(len(calls), 3)
+        # Other errors are not retried
+        fn, calls = self.failing(1, error=KeyError)
+        self.assertRaises(KeyError, policy.call, fn, 'x')
+        self.assertEqual(len(calls), 1)
+        # Nor too many times
+        fn, calls = self.failing(10)
+        self.assertRaises(Unavailable, policy.call, fn, 'x')
+        self.assertEqual(len(calls), 4)
+        pass
+
+    def test_stops_retrying_before_the_deadline(self):
+        clock = FakeClock()
+        policy = RetryPolicy(lambda e: True, max_attempts=100, initial_delay=1.0, max_delay=1.0, safety_margin=2.0,
+                             clock=clock, sleep=clock.sleep)
+        fn, calls = self.failing(100)
+
+        self.assertRaises(Unavailable, policy.call, fn, 'x', deadline=clock.now + 10.0)
+        self.assertLessEqual(clock.now, 1000.0 + 10.0 - 2.0)
+        self.assertLess(len(calls), 100)
+        pass
+
+    def test_circuit_breaker(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30.0, clock=clock)
+        policy = RetryPolicy(lambda e: True, breaker=breaker, max_attempts=1, clock=clock, sleep=clock.sleep)
+        fn, calls = self.failing(4)
+
+        for _ in range(3):
+            self.assertRaises(Unavailable, policy.call, fn, 'x')
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        # Fails fast without calling
+        self.assertRaises(CircuitOpen, policy.call, fn, 'x')
+        self.assertEqual(len(calls), 3)
+        # A failed trial opens it again
+        clock.now += 30.0
+        self.assertRaises(Unavailable, policy.call, fn, 'x')
+        self.assertRaises(CircuitOpen, policy.call, fn, 'x')
+        # A successful trial closes it
+        clock.now += 30.0
+        self.assertEqual(policy.call(fn, 'x'), 'x')
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(len(calls), 5)
+        pass
+
+    def test_tells_the_transient_errors(self):
+        unavailable = requests.Response()
+        unavailable.status_code = 503
+        not_found = requests.Response()
+        not_found.status_code = 404
+
+        self.assertTrue(forwarder.is_transient_error(requests.ConnectionError()))
+        self.assertTrue(forwarder.is_transient_error(requests.ReadTimeout()))
+        self.assertTrue(forwarder.is_transient_error(requests.HTTPError(response=unavailable)))
+        self.assertFalse(forwarder.is_transient_error(requests.HTTPError(response=not_found)))
+        self.assertFalse(forwarder.is_transient_error(ValueError('invalid event')))
+        pass
+
+
+class TestDiskSpillQueue(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_keeps_the_order(self):
+        queue = build_spill_queue('disk', os.path.join(self.directory, 'spill'))
+        self.assertIsInstance(queue, DiskSpillQueue)
+        for i in range(5):
+            queue.put('[{0}]'.format(i).encode('utf-8'))
+
+        items = queue.peek(3)
+        self.assertEqual([payload for _, payload in items], [b'[0]', b'[1]', b'[2]'])
+        for key, _ in items:
+            queue.remove(key)
+        self.assertEqual(len(queue), 2)
+        self.assertEqual([payload for _, payload in queue.peek(10)], [b'[3]', b'[4]'])
+        self.assertIsNone(build_spill_queue(None))
+        self.assertRaises(EnvironmentError, build_spill_queue, 'unknown')
+        pass
+
+
+class TestDeliveryWithStubs(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.stub = StubServer().__enter__()
+        self.saved_config = dict(forwarder.config)
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        forwarder.config.update(environment=self.stub.url, iot_endpoint=self.stub.url, client_id='id',
+                                client_secret='secret', cache_backend='lru', events_batch_size=10,
+                                delivery_initial_delay=0.01, delivery_max_delay=0.01, circuit_failure_threshold=3,
+                                spill_queue_backend='disk', spill_queue_url=self.directory)
+        forwarder.reset_state()
+        for i in range(3):
+            self.stub.state.objects['device-{0}'.format(i)] = dict(x_device_id='device-{0}'.format(i))
+
+    def tearDown(self):
+        forwarder.config.update(self.saved_config)
+        forwarder.reset_state()
+        self.stub.__exit__()
+        shutil.rmtree(self.directory)
+
+    def forward(self, count):
+        events = [dict(device_id='device-{0}'.format(i % 3), sequence=i) for i in range(count)]
+        aggregator = MetricsAggregator()
+        forwarder.metrics.add_sink(aggregator)
+        try:
+            rc = forwarder.iot_custom_event_batch_handler(events, Context())
+        finally:
+            forwarder.metrics.remove_sink(aggregator)
+        return rc, aggregator.totals()
+
+    def test_spills_and_replays_when_the_platform_fails(self):
+        # Warm the object cache, then fail all the events calls
+        self.assertEqual(self.forward(3)[0]['batchItemFailures'], list())
+        self.stub.state.error_rate = 1.0
+
+        rc, totals = self.forward(50)
+
+        self.assertEqual(rc['batchItemFailures'], list())
+        self.assertEqual(totals['counters']['event_requests_spilled'], 5)
+        # The circuit opened after 3 failed attempts, the other requests were spilled without being sent
+        self.assertEqual(totals['counters']['delivery_retries'], 3)
+        self.assertEqual(totals['timers']['send_events']['count'], 3)
+        self.assertEqual(forwarder.get_delivery_policy().breaker.state, 'open')
+        self.assertEqual(len(forwarder.get_spill_queue()), 5)
+
+        # Back to normal: the spilled requests are replayed in order once the circuit closes
+        self.stub.state.error_rate = 0.0
+        forwarder.get_delivery_policy().breaker.opened_at -= forwarder.config['circuit_reset_timeout']
+        rc, totals = self.forward(3)
+
+        self.assertEqual(rc['batchItemFailures'], list())
+        self.assertEqual(totals['counters']['event_requests_replayed'], 5)
+        self.assertEqual(len(forwarder.get_spill_queue()), 0)
+        replayed = self.stub.state.events[3:53]
+        self.assertEqual(sorted(e['sequence'] for e in replayed), list(range(50)))
+        # In order for each device
+        for i in range(3):
+            sequence = [e['sequence'] for e in replayed if e['x_object']['x_device_id'] == 'device-{0}'.format(i)]
+            self.assertEqual(sequence, list(range(i, 50, 3)))
+        pass
+
+    def test_does_not_spill_the_rejected_requests(self):
+        # Warm the object cache, then reject the events calls of a device
+        self.forward(3)
+        self.stub.state.invalid_events.add('device-1')
+
+        rc, totals = self.forward(6)
+
+        self.assertEqual(sorted(int(f['itemIdentifier']) for f in rc['batchItemFailures']), list(range(6)))
+        self.assertNotIn('event_requests_spilled', totals['counters'])
+        self.assertEqual(len(forwarder.get_spill_queue()), 0)
+        self.assertEqual(forwarder.get_delivery_policy().breaker.state, 'closed')
+        pass
+
+    def test_drops_the_spilled_requests_rejected_when_replayed(self):
+        queue = forwarder.get_spill_queue()
+        queue.put(b'[{"x_object":{"x_device_id":"device-9"},"sequence":100}]')
+        queue.put(b'[{"x_object":{"x_device_id":"device-2"},"sequence":101}]')
+        self.stub.state.invalid_events.add('device-9')
+
+        rc, totals = self.forward(3)
+
+        # The rejected request does not block the one after it
+        self.assertEqual(rc['batchItemFailures'], list())
+        self.assertEqual(totals['counters']['event_requests_dropped'], 1)
+        self.assertEqual(totals['counters']['event_requests_replayed'], 1)
+        self.assertEqual(len(queue), 0)
+        self.assertEqual([e['sequence'] for e in self.stub.state.events], [101, 0, 1, 2])
+        pass
+
+    def test_single_event_handlers_raise_when_not_delivered(self):
+        # Warm the object cache, then fail all the events calls
+        self.forward(3)
+        self.stub.state.error_rate = 1.0
+        forwarder.config.update(delivery_max_attempts=1, spill_queue_backend=None)
+        forwarder.event_batcher = None
+        forwarder.spill_queue = None
+        shadow = dict(device_id='device-0', state=dict(reported=dict(temperature=20)))
+
+        self.assertRaises(DeliveryFailed, forwarder.iot_custom_event_handler,
+                          dict(device_id='device-0', event_type='alarm'), Context())
+        self.assertRaises(DeliveryFailed, forwarder.iot_shadow_update_event_handler, shadow, Context())
+
+        # Spilled instead with a spill queue
+        forwarder.config.update(spill_queue_backend='disk')
+        forwarder.event_batcher = None
+        forwarder.spill_queue = None
+        self.assertTrue(forwarder.iot_shadow_update_event_handler(shadow, Context()))
+        self.assertEqual(len(forwarder.get_spill_queue()), 1)
+        pass
+
+    def test_retries_the_transient_errors(self):
+        # Warm the object cache, only the events calls are retried
+        self.forward(3)
+        self.stub.state.error_rate = 0.3
+        forwarder.config.update(delivery_max_attempts=20, circuit_failure_threshold=100)
+        forwarder.delivery_policy = None
+
+        rc, totals = self.forward(50)
+
+        self.assertEqual(rc['batchItemFailures'], list())
+        self.assertEqual(len(self.stub.state.events), 53)
+        self.assertNotIn('event_requests_spilled', totals['counters'])
+        pass
@@ -0,0 +1,125 @@
+import os
+import unittest
+from mnubo import DeltaFilter
+from mnubo import MetricsAggregator
+from mnubo import parse_deadbands
+import lambda_mnubo_forwarder as forwarder
+from tests.stubs import StubServer
+
+
+class Context(object):
+    def get_remaining_time_in_millis(self):
+        return 60000
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestDeltaFilter(unittest.TestCase):
+    def test_drops_the_unchanged_values(self):
+        f = DeltaFilter(keepalive=0)
+
+        self.assertEqual(f.apply('a', dict(temperature=20.5, mode='eco', on=True)),
+                         dict(temperature=20.5, mode='eco', on=True))
+        self.assertEqual(f.apply('a', dict(temperature=20.5, mode='eco', on=True)), dict())
+        self.assertEqual(f.apply('a', dict(temperature=21, mode='eco', on=1)), dict(temperature=21, on=1))
+        # Other devices have their own values
+        self.assertEqual(f.apply('b', dict(temperature=21)), dict(temperature=21))
+        self.assertEqual(f.stats(), dict(events=4, events_suppressed=1, values=10, values_suppressed=4))
+        pass
+
+    def test_deadbands(self):
+        f = DeltaFilter(keepalive=0, deadbands=parse_deadbands('temperature:0.5, humidity:2'))
+
+        f.apply('a', dict(temperature=20.0, humidity=40, pressure=1000))
+        self.assertEqual(f.apply('a', dict(temperature=20.4, humidity=41.9, pressure=1000.1)), dict(pressure=1000.1))
+        # Compared with the last value forwarded, not the last value seen
+        self.assertEqual(f.apply('a', dict(temperature=20.5, humidity=38)), dict(temperature=20.5, humidity=38))
+        self.assertRaises(ValueError, parse_deadbands, 'temperature')
+        pass
+
+    def test_keepalive(self):
+        clock = FakeClock()
+        f = DeltaFilter(keepalive=600, clock=clock)
+
+        f.apply('a', dict(temperature=20.0, mode='eco'))
+        clock.now += 300
+        self.assertEqual(f.apply('a', dict(temperature=20.0, mode='away')), dict(mode='away'))
+        clock.now += 300
+        self.assertEqual(f.apply('a', dict(temperature=20.0, mode='away')), dict(temperature=20.0))
+        pass
+
+    def test_bounded_and_forgotten_devices(self):
+        f = DeltaFilter(max_devices=2, keepalive=0)
+        for device_id in ('a', 'b', 'c'):
+            f.apply(device_id, dict(temperature=20))
+
+        # a was evicted
+        self.assertEqual(f.apply('a', dict(temperature=20)), dict(temperature=20))
+        self.assertEqual(f.apply('c', dict(temperature=20)), dict())
+        f.forget('c')
+        self.assertEqual(f.apply('c', dict(temperature=20)), dict(temperature=20))
+        pass
+
+
+class TestShadowDeltaSuppressionWithStubs(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubServer().__enter__()
+        self.saved_config = dict(forwarder.config)
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        forwarder.config.update(environment=self.stub.url, iot_endpoint=self.stub.url, client_id='id',
+                                client_secret='secret', cache_backend='lru', shadow_delta_suppression=True,
+                                shadow_deadbands=dict(temperature=0.5))
+        forwarder.reset_state()
+        for i in range(2):
+            self.stub.state.objects['device-{0}'.format(i)] = dict(x_device_id='device-{0}'.format(i))
+
+    def tearDown(self):
+        forwarder.config.update(self.saved_config)
+        forwarder.reset_state()
+        self.stub.__exit__()
+
+    def test_batch_handler_forwards_the_changes_only(self):
+        temperatures = [20.0, 20.1, 20.2, 21.0, 21.0, 19.0]
+        events = [dict(device_id='device-{0}'.format(i % 2), state=dict(reported=dict(temperature=t, mode='eco')),
+                       metadata=dict(timestamp=1500000000 + i))
+                  for i, t in enumerate(temperatures)]
+        aggregator = MetricsAggregator()
+        forwarder.metrics.add_sink(aggregator)
+        try:
+            rc = forwarder.iot_shadow_update_event_batch_handler(events, Context())
+        finally:
+            forwarder.metrics.remove_sink(aggregator)
+
+        self.assertEqual(rc['batchItemFailures'], list())
+        sent = dict()
+        for e in self.stub.state.events:
+            sent.setdefault(e['x_object']['x_device_id'], list()).append((e.get('temperature', None),
+                                                                          e.get('mode', None)))
+        # device-0 reports 20.0, 20.2, 21.0 and device-1 reports 20.1, 21.0, 19.0
+        self.assertEqual(sent, {'device-0': [(20.0, 'eco'), (21.0, None)],
+                                'device-1': [(20.1, 'eco'), (21.0, None), (19.0, None)]})
+        counters = aggregator.totals()['counters']
+        self.assertEqual(counters['records'], 6)
+        self.assertEqual(counters['shadow_events_suppressed'], 1)
+        self.assertEqual(counters['shadow_values_suppressed'], 5)
+        pass
+
+    def test_failed_devices_are_forwarded_in_full_when_retried(self):
+        events = [dict(device_id='device-0', state=dict(reported=dict(temperature=20.0, mode='eco')))]
+        self.stub.state.error_rate = 1.0
+        forwarder.config.update(delivery_max_attempts=1)
+        rc = forwarder.iot_shadow_update_event_batch_handler(events, Context())
+        self.assertEqual(len(rc['batchItemFailures']), 1)
+
+        self.stub.state.error_rate = 0.0
+        forwarder.get_delivery_policy().breaker.record_success()
+        rc = forwarder.iot_shadow_update_event_batch_handler(events, Context())
+        self.assertEqual(rc['batchItemFailures'], list())
+        self.assertEqual(self.stub.state.events[0]['temperature'], 20.0)
+        pass
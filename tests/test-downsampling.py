@@ -0,0 +1,163 @@
+import os
+import sys
+import random
+import unittest
+from smartobjects import Event
+from mnubo import WindowAggregator
+from mnubo import MetricsAggregator
+from mnubo import parse_reductions
+from mnubo import parse_default_reductions
+import lambda_mnubo_forwarder as forwarder
+from tests.stubs import StubServer
+
+
+class Context(object):
+    def get_remaining_time_in_millis(self):
+        return 60000
+
+
+def make_event(device_id, timestamp, event_type='reading', latitude=None, **values):
+    event = Event()
+    event.device_id = device_id
+    event.event_type = event_type
+    event.timestamp = timestamp
+    event.latitude = latitude
+    event.longitude = None if latitude is None else -latitude
+    event.event_data.update(values)
+    return event
+
+
+class TestWindowAggregator(unittest.TestCase):
+    def test_aggregates_by_device_type_and_window(self):
+        aggregator = WindowAggregator(60, reductions=parse_reductions('temperature:min+max+mean+count,mode:last'))
+        items = [('0', make_event('a', 1500000000, temperature=20, mode='eco')),
+                 ('1', make_event('a', 1500000030000, temperature=23, latitude=45.0)),
+                 ('2', make_event('b', 1500000010.5, temperature=10.5)),
+                 ('3', make_event('a', '2017-07-14T02:40:59.999Z', temperature=21, mode='away')),
+                 ('4', make_event('a', 1500000060, temperature=30)),
+                 ('5', make_event('a', 1500000010, event_type='alarm', level=3)),
+                 ('6', make_event('a', 'yesterday', temperature=0))]
+
+        rc = aggregator.aggregate(items)
+
+        self.assertEqual([identifiers for identifiers, _ in rc], [['6'], ['0', '1', '3'], ['2'], ['4'], ['5']])
+        event = rc[1][1]
+        self.assertEqual((event.device_id, event.event_type, event.timestamp), ('a', 'reading', 1500000000))
+        self.assertEqual(event.event_data, dict(temperature_min=20, temperature_max=23, temperature_mean=64 / 3.0,
+                                                temperature_count=3, mode='away'))
+        self.assertIsInstance(event.event_data['temperature_min'], int)
+        self.assertEqual((event.latitude, event.longitude), (45.0, -45.0))
+        self.assertEqual(rc[2][1].event_data['temperature_max'], 10.5)
+        # The default reduction is last
+        self.assertEqual(rc[4][1].event_data, dict(level=3))
+        # Not aggregated, the timestamp cannot be read
+        self.assertIs(rc[0][1], items[6][1])
+        pass
+
+    def test_non_numeric_values_keep_their_last_value(self):
+        aggregator = WindowAggregator(10, default_reductions=['mean'])
+        rc = aggregator.aggregate([(str(i), make_event('a', 100 + i, state='s{0}'.format(i), flag=i % 2 == 0))
+                                   for i in range(5)])
+
+        self.assertEqual(rc[0][1].event_data, dict(state='s4', flag=True))
+        self.assertRaises(ValueError, parse_reductions, 'temperature:median')
+        self.assertRaises(ValueError, WindowAggregator, 0)
+        pass
+
+    def test_rejects_the_unknown_default_reductions(self):
+        self.assertEqual(parse_default_reductions('mean + max'), ['mean', 'max'])
+        self.assertRaises(ValueError, parse_default_reductions, 'avg')
+        self.assertRaises(ValueError, parse_default_reductions, '')
+        self.assertRaises(ValueError, WindowAggregator, 10, default_reductions=['avg'])
+        self.assertRaises(ValueError, WindowAggregator, 10, reductions=dict(temperature=['median']))
+        pass
+
+    def test_numpy_and_python_reductions_agree(self):
+        rng = random.Random(7)
+        items = [(str(i), make_event('device-{0}'.format(rng.randrange(20)), 1500000000 + rng.randrange(600),
+                                     temperature=rng.uniform(-10, 40), count=rng.randrange(100)))
+                 for i in range(5000)]
+        aggregator = WindowAggregator(60, default_reductions=['min', 'max', 'mean', 'count', 'last'])
+        module = sys.modules[WindowAggregator.__module__]
+        saved = module.NUMPY_MIN_VALUES
+        try:
+            module.NUMPY_MIN_VALUES = 0
+            vectorized = aggregator.aggregate(items)
+            module.NUMPY_MIN_VALUES = sys.maxsize
+            looped = aggregator.aggregate(items)
+        finally:
+            module.NUMPY_MIN_VALUES = saved
+
+        self.assertEqual(len(vectorized), len(looped))
+        for (ids_a, a), (ids_b, b) in zip(vectorized, looped):
+            self.assertEqual(ids_a, ids_b)
+            self.assertEqual(sorted(a.event_data.keys()), sorted(b.event_data.keys()))
+            for name, value in a.event_data.items():
+                self.assertAlmostEqual(value, b.event_data[name], places=6)
+        pass
+
+
+class TestDownsamplingWithStubs(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubServer().__enter__()
+        self.saved_config = dict(forwarder.config)
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        forwarder.config.update(environment=self.stub.url, iot_endpoint=self.stub.url, client_id='id',
+                                client_secret='secret', cache_backend='lru', aggregation_window=1,
+                                aggregation_reductions=dict(temperature=['mean', 'max']))
+        forwarder.reset_state()
+        for i in range(2):
+            self.stub.state.objects['device-{0}'.format(i)] = dict(x_device_id='device-{0}'.format(i))
+
+    def tearDown(self):
+        forwarder.config.update(self.saved_config)
+        forwarder.reset_state()
+        self.stub.__exit__()
+
+    def forward(self):
+        # 2 devices at 100 Hz during 5 seconds
+        events = [dict(device_id='device-{0}'.format(i % 2), timestamp=1500000000000 + 10 * (i // 2),
+                       temperature=i % 7) for i in range(1000)]
+        aggregator = MetricsAggregator()
+        forwarder.metrics.add_sink(aggregator)
+        try:
+            rc = forwarder.iot_custom_event_batch_handler(events, Context())
+        finally:
+            forwarder.metrics.remove_sink(aggregator)
+        return rc, aggregator.totals()
+
+    def test_batch_handler_sends_one_event_per_window(self):
+        rc, totals = self.forward()
+
+        self.assertEqual(rc['batchItemFailures'], list())
+        events = self.stub.state.events
+        self.assertEqual(len(events), 10)
+        self.assertEqual(sorted(set(e['x_timestamp'] for e in events)),
+                         ['2017-07-14T02:40:0{0}'.format(i) for i in range(5)])
+        self.assertTrue(all(e['temperature_max'] == 6 for e in events))
+        self.assertEqual(totals['counters']['records'], 1000)
+        self.assertEqual(totals['counters']['events_aggregated'], 1000)
+        self.assertEqual(totals['counters']['aggregated_events'], 10)
+        pass
+
+    def test_failed_windows_fail_all_their_records(self):
+        self.stub.state.error_rate = 1.0
+        forwarder.config.update(delivery_max_attempts=1)
+        forwarder.global_cache = None
+        forwarder.get_object_cache().set_many(dict(('device-{0}'.format(i), 2 ** 31) for i in range(2)))
+
+        rc, _ = self.forward()
+
+        self.assertEqual(sorted(int(f['itemIdentifier']) for f in rc['batchItemFailures']), list(range(1000)))
+        pass
+
+    def test_invalid_timestamps_fail_their_records_only(self):
+        events = [dict(device_id='device-0', timestamp=1500000000000 + i, temperature=i) for i in range(10)]
+        events[3]['timestamp'] = float('nan')
+        events[7]['timestamp'] = 10 ** 25
+
+        rc = forwarder.iot_custom_event_batch_handler(events, Context())
+
+        self.assertEqual(sorted(int(f['itemIdentifier']) for f in rc['batchItemFailures']), [3, 7])
+        self.assertEqual(len(self.stub.state.events), 1)
+        pass
@@ -0,0 +1,179 @@
+import io
+import os
+import gzip
+import json
+import unittest
+from mnubo import EventBatcher
+from mnubo import PayloadTooLarge
+from mnubo import MetricsAggregator
+import lambda_mnubo_forwarder as forwarder
+from tests.stubs import StubServer
+
+
+class Context(object):
+    def get_remaining_time_in_millis(self):
+        return 60000
+
+
+class FakeEndpoint(object):
+    """ Accepts the bodies up to a size, as the mnubo platform does. """
+    def __init__(self, max_bytes, rejected=()):
+        self.max_bytes = max_bytes
+        self.rejected = rejected
+        self.requests = list()
+
+    def __call__(self, body, compressed):
+        if len(body) > self.max_bytes:
+            raise PayloadTooLarge()
+        events = json.loads((gzip.GzipFile(fileobj=io.BytesIO(body)).read() if compressed else body).decode('utf-8'))
+        self.requests.append((len(body), compressed, events))
+        return [dict(result='error' if e['n'] in self.rejected else 'success', message='rejected') for e in events]
+
+
+def make_events(count, padding=100):
+    return [dict(x_object=dict(x_device_id='device-{0}'.format(i % 3)), n=i, padding='x' * padding)
+            for i in range(count)]
+
+
+class TestEventBatcher(unittest.TestCase):
+    def test_chunks_by_size_and_count(self):
+        endpoint = FakeEndpoint(max_bytes=1000)
+        batcher = EventBatcher(endpoint, max_events=5, max_bytes=1000)
+
+        self.assertEqual(batcher.send(make_events(40)), list())
+
+        self.assertEqual([e['n'] for _, _, events in endpoint.requests for e in events], list(range(40)))
+        for size, _, events in endpoint.requests:
+            self.assertLessEqual(size, 1000)
+            self.assertLessEqual(len(events), 5)
+        # About 150 bytes per event: 6 events would fit in 1000 bytes, the count limit applies first
+        self.assertEqual(len(endpoint.requests[0][2]), 5)
+        stats = batcher.stats()
+        self.assertEqual(stats['events'], 40)
+        self.assertEqual(stats['requests'], len(endpoint.requests))
+        self.assertEqual(stats['sent_bytes'], sum(size for size, _, _ in endpoint.requests))
+        self.assertAlmostEqual(stats['bytes_per_event'], stats['sent_bytes'] / 40.0)
+        pass
+
+    def test_fills_the_requests_up_to_the_size_limit(self):
+        endpoint = FakeEndpoint(max_bytes=1000)
+        batcher = EventBatcher(endpoint, max_events=1000, max_bytes=1000)
+
+        batcher.send(make_events(40))
+
+        sizes = [size for size, _, _ in endpoint.requests]
+        self.assertTrue(all(size <= 1000 for size in sizes))
+        # Each request but the last could not take one more event
+        self.assertTrue(all(size > 1000 - 150 for size in sizes[:-1]))
+        pass
+
+    def test_reports_the_oversized_and_rejected_events(self):
+        endpoint = FakeEndpoint(max_bytes=1000, rejected=(3,))
+        batcher = EventBatcher(endpoint, max_events=10, max_bytes=1000)
+        events = make_events(6)
+        events[4]['padding'] = 'x' * 2000
+
+        self.assertEqual(batcher.send(events), [3, 4])
+        self.assertEqual(sorted(e['n'] for _, _, sent in endpoint.requests for e in sent), [0, 1, 2, 3, 5])
+        self.assertEqual(batcher.stats()['oversized_events'], 1)
+        pass
+
+    def test_splits_the_requests_rejected_for_their_size(self):
+        endpoint = FakeEndpoint(max_bytes=700)
+        batcher = EventBatcher(endpoint, max_events=1000, max_bytes=5000)
+
+        self.assertEqual(batcher.send(make_events(20)), list())
+
+        self.assertEqual([e['n'] for _, _, events in endpoint.requests for e in events], list(range(20)))
+        self.assertGreater(batcher.stats()['split_requests'], 0)
+        pass
+
+    def test_compresses_the_requests(self):
+        endpoint = FakeEndpoint(max_bytes=1000)
+        sent = list()
+        batcher = EventBatcher(endpoint, max_events=1000, max_bytes=3000, compress=True,
+                               on_sent=lambda events, payload, body: sent.append((events, payload, body)))
+
+        self.assertEqual(batcher.send(make_events(30)), list())
+
+        self.assertTrue(all(compressed for _, compressed, _ in endpoint.requests))
+        self.assertEqual(sum(events for events, _, _ in sent), 30)
+        stats = batcher.stats()
+        self.assertLess(stats['sent_bytes'] * 5, stats['payload_bytes'])
+        self.assertEqual(stats['payload_bytes'], sum(payload for _, payload, _ in sent))
+        pass
+
+    def test_spills_the_transient_failures_only(self):
+        spilled = list()
+        errors = list()
+
+        def post(body, compressed):
+            raise errors.pop(0)
+
+        batcher = EventBatcher(post, max_events=2, max_bytes=5000, spill=spilled.append,
+                               spillable=lambda e: isinstance(e, IOError))
+        errors.extend([IOError('connection reset'), ValueError('400 Invalid event')])
+
+        # The rejected request is reported as failed instead of being spilled
+        self.assertEqual(batcher.send(make_events(4)), [2, 3])
+        self.assertEqual(len(spilled), 1)
+        self.assertEqual([e['n'] for e in json.loads(spilled[0].decode('utf-8'))], [0, 1])
+        self.assertEqual(batcher.stats()['spilled_events'], 2)
+        pass
+
+
+class TestEventBatcherWithStubs(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubServer(max_request_bytes=2000).__enter__()
+        self.saved_config = dict(forwarder.config)
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        forwarder.config.update(environment=self.stub.url, iot_endpoint=self.stub.url, client_id='id',
+                                client_secret='secret', cache_backend='lru', events_max_bytes=2000)
+        forwarder.reset_state()
+
+    def tearDown(self):
+        forwarder.config.update(self.saved_config)
+        forwarder.reset_state()
+        self.stub.__exit__()
+
+    def forward(self, count):
+        for i in range(3):
+            self.stub.state.objects['device-{0}'.format(i)] = dict(x_device_id='device-{0}'.format(i))
+        events = [dict(device_id='device-{0}'.format(i % 3), sequence=i, comment='y' * 80) for i in range(count)]
+        aggregator = MetricsAggregator()
+        forwarder.metrics.add_sink(aggregator)
+        try:
+            rc = forwarder.iot_custom_event_batch_handler(events, Context())
+        finally:
+            forwarder.metrics.remove_sink(aggregator)
+        self.assertEqual(rc['batchItemFailures'], list())
+        self.assertEqual(sorted(e['sequence'] for e in self.stub.state.events), list(range(count)))
+        return aggregator.totals()
+
+    def test_requests_within_the_size_limit(self):
+        totals = self.forward(100)
+
+        requests = self.stub.state.event_requests
+        self.assertGreater(len(requests), 1)
+        self.assertTrue(all(size <= 2000 and encoding is None for size, encoding in requests))
+        self.assertEqual(totals['sizes']['event_sent_bytes']['total'], sum(size for size, _ in requests))
+        self.assertEqual(totals['sizes']['event_sent_bytes']['count'], len(requests))
+        pass
+
+    def test_compressed_requests(self):
+        forwarder.config.update(events_compression=True, events_max_bytes=20000)
+        totals = self.forward(100)
+
+        requests = self.stub.state.event_requests
+        self.assertTrue(all(size <= 2000 and encoding == 'gzip' for size, encoding in requests))
+        self.assertLess(totals['sizes']['event_sent_bytes']['total'],
+                        totals['sizes']['event_payload_bytes']['total'])
+        pass
+
+    def test_requests_too_large_are_split(self):
+        forwarder.config.update(events_max_bytes=20000)
+        self.forward(100)
+
+        self.assertGreater(self.stub.state.calls['send_events'], len(self.stub.state.event_requests))
+        self.assertTrue(all(size <= 2000 for size, _ in self.stub.state.event_requests))
+        pass
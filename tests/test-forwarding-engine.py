@@ -0,0 +1,265 @@
+import os
+import time
+import unittest
+from mnubo import ForwardingEngine
+from mnubo import MetricsAggregator
+from mnubo import CostEstimator
+from mnubo import TimeBudget
+import lambda_mnubo_forwarder as forwarder
+from tests.stubs import StubServer
+
+
+class Context(object):
+    def __init__(self, remaining=60000):
+        self.deadline = time.time() + remaining / 1000.0
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.time()) * 1000)
+
+
+class TestForwardingEngine(unittest.TestCase):
+    def test_keeps_the_order_of_each_device(self):
+        sent = list()
+
+        def send_events(events):
+            # Give the other chunks a chance to overtake this one
+            time.sleep(0.01 * (len(sent) % 3))
+            sent.extend(events)
+            return list()
+
+        engine = ForwardingEngine(resolve_existing=lambda ids: dict((d, True) for d in ids),
+                                  create_objects=lambda device_ids: set(),
+                                  send_events=send_events, max_in_flight=4, batch_size=3)
+        items = [(str(i), 'device-{0}'.format(i % 2), (i % 2, i)) for i in range(20)]
+        self.assertEqual(engine.forward(items), list())
+        self.assertEqual(len(sent), 20)
+        for device in (0, 1):
+            sequence = [i for d, i in sent if d == device]
+            self.assertEqual(sequence, sorted(sequence))
+        pass
+
+    def test_reports_the_failed_items(self):
+        def create_objects(device_ids):
+            return set(d for d in device_ids if d == 'new')
+
+        engine = ForwardingEngine(resolve_existing=lambda ids: dict((d, d not in ('new', 'c')) for d in ids),
+                                  create_objects=create_objects,
+                                  send_events=lambda events: [i for i, e in enumerate(events) if e == 'bad'],
+                                  max_in_flight=2, batch_size=2)
+        items = [('0', 'a', 'ok'), ('1', 'new', 'ok'), ('2', 'a', 'bad'), ('3', 'b', 'ok'), ('4', 'c', 'ok')]
+        self.assertEqual(sorted(engine.forward(items)), ['1', '2'])
+        pass
+
+    def test_fails_the_later_events_of_a_failed_chunk(self):
+        sent = list()
+
+        def send_events(events):
+            if ('a', 1) in events:
+                raise IOError('connection reset')
+            sent.extend(events)
+            return list()
+
+        engine = ForwardingEngine(resolve_existing=lambda ids: dict((d, True) for d in ids),
+                                  create_objects=lambda device_ids: set(),
+                                  send_events=send_events, max_in_flight=4, batch_size=2)
+        items = [(str(i), 'a' if i < 6 else 'b', ('a' if i < 6 else 'b', i)) for i in range(8)]
+
+        self.assertEqual(sorted(engine.forward(items)), ['0', '1', '2', '3', '4', '5'])
+        self.assertEqual(sent, [('b', 6), ('b', 7)])
+        pass
+
+    def test_creates_the_missing_objects_in_batches(self):
+        batches = list()
+
+        def create_objects(device_ids):
+            batches.append(list(device_ids))
+            return set()
+
+        engine = ForwardingEngine(resolve_existing=lambda ids: dict((d, False) for d in ids),
+                                  create_objects=create_objects, send_events=lambda events: list(),
+                                  max_in_flight=2, batch_size=10, objects_batch_size=3)
+        items = [(str(i), 'device-{0}'.format(i), None) for i in range(10)]
+        self.assertEqual(engine.forward(items), list())
+        self.assertEqual(sorted(len(b) for b in batches), [1, 3, 3, 3])
+        self.assertEqual(sorted(d for b in batches for d in b), sorted(d for _, d, _ in items))
+        pass
+
+    def test_leaves_the_work_it_has_no_time_for(self):
+        class Clock(object):
+            now = 0.0
+
+            def __call__(self):
+                return self.now
+        clock = Clock()
+        sent = list()
+
+        def send_events(events):
+            clock.now += 1.0
+            sent.extend(events)
+            return list()
+
+        def create_objects(device_ids):
+            clock.now += 1.0
+            return set()
+
+        budget = TimeBudget(10.0, CostEstimator(), safety_margin=2.0, clock=clock)
+        engine = ForwardingEngine(resolve_existing=lambda ids: dict((d, d != 'new') for d in ids),
+                                  create_objects=create_objects, send_events=send_events,
+                                  max_in_flight=1, batch_size=2, budget=budget)
+        items = [(str(i), 'device-{0}'.format(i % 2), i) for i in range(20)] + [('new', 'new', 'new')]
+
+        failures = engine.forward(items)
+
+        self.assertGreater(len(sent), 0)
+        self.assertLess(clock.now, 10.0)
+        # Every item is either sent or reported, and the work stopped at the first refusal
+        self.assertEqual(sorted(failures + [str(i) for i in sent]), sorted(i for i, _, _ in items))
+        for device in (0, 1):
+            sequence = [i for i in sent if i % 2 == device]
+            self.assertEqual(sequence, list(range(device, 20, 2))[:len(sequence)])
+        self.assertEqual(budget.deferred, len(failures))
+        pass
+
+
+class TestBatchForwardingWithStubs(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubServer(latency=0.005).__enter__()
+        self.saved_config = dict(forwarder.config)
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'test')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'test')
+        forwarder.config.update(environment=self.stub.url, iot_endpoint=self.stub.url, client_id='id',
+                                client_secret='secret', cache_backend='lru', max_in_flight=4, events_batch_size=10)
+        forwarder.reset_state()
+
+    def tearDown(self):
+        forwarder.config.update(self.saved_config)
+        forwarder.reset_state()
+        self.stub.__exit__()
+
+    def test_batch_handler_against_stubs(self):
+        state = self.stub.state
+        for i in range(5):
+            state.add_thing('thing-{0}'.format(i), 'sensor', dict(model='m1'))
+        state.objects['thing-0'] = dict(x_device_id='thing-0')
+        events = [dict(device_id='thing-{0}'.format(i % 6), sequence=i) for i in range(60)]
+        aggregator = MetricsAggregator()
+        forwarder.metrics.add_sink(aggregator)
+
+        try:
+            rc = forwarder.iot_custom_event_batch_handler(events, Context())
+        finally:
+            forwarder.metrics.remove_sink(aggregator)
+
+        # thing-5 is not in the registry
+        failed = sorted(int(f['itemIdentifier']) for f in rc['batchItemFailures'])
+        self.assertEqual(failed, list(range(5, 60, 6)))
+        self.assertEqual(state.calls['objects_exist'], 1)
+        self.assertEqual(state.calls['describe_thing'], 5)
+        # thing-1 to thing-4 created by 2 batch calls, one per creation thread
+        self.assertEqual(state.calls['create_object'], 0)
+        self.assertEqual(state.calls['create_update_objects'], 2)
+        self.assertEqual(len(state.objects), 5)
+        self.assertEqual(len(state.events), 50)
+        self.assertLessEqual(state.max_in_flight, 4)
+        for i in range(5):
+            sequence = [e['sequence'] for e in state.events if e['x_object']['x_device_id'] == 'thing-{0}'.format(i)]
+            self.assertEqual(sequence, list(range(i, 60, 6)))
+        # The stages are measured once per invocation
+        totals = aggregator.totals()
+        self.assertEqual(totals['flushes'], 1)
+        self.assertEqual(totals['counters']['records'], 60)
+        self.assertEqual(totals['counters']['object_cache_misses'], 6)
+        self.assertEqual(totals['counters']['objects_created'], 4)
+        self.assertEqual(totals['counters']['events_sent'], 50)
+        self.assertEqual(totals['timers']['map']['count'], 60)
+        self.assertEqual(totals['timers']['describe_thing']['count'], 5)
+        self.assertEqual(totals['timers']['send_events']['count'], 5)
+        self.assertGreater(totals['sizes']['request_bytes']['total'], 0)
+        # The pooled connections are reused
+        stats = forwarder.get_connection_stats()
+        self.assertLessEqual(stats['mnubo']['connections'], 4)
+        self.assertGreater(stats['mnubo']['requests'], stats['mnubo']['connections'])
+        pass
+
+    def test_batch_handler_fails_the_invalid_timestamps_only(self):
+        state = self.stub.state
+        state.objects['thing-0'] = dict(x_device_id='thing-0')
+        # Enough events for NumPy to normalize them
+        events = [dict(device_id='thing-0', sequence=i, timestamp=1500000000000 + i) for i in range(300)]
+        events[5]['timestamp'] = 10 ** 25
+        events[17]['timestamp'] = float('nan')
+        events[42]['timestamp'] = float('inf')
+
+        rc = forwarder.iot_custom_event_batch_handler(events, Context())
+
+        self.assertEqual(sorted(int(f['itemIdentifier']) for f in rc['batchItemFailures']), [5, 17, 42])
+        self.assertEqual(len(state.events), 297)
+        self.assertEqual(state.events[0]['x_timestamp'], '2017-07-14T02:40:00')
+        pass
+
+    def test_prefetch_things_during_onboarding(self):
+        state = self.stub.state
+        for i in range(600):
+            state.add_thing('thing-{0}'.format(i), 'sensor' if i % 2 else 'gateway', dict(model='m1'))
+        forwarder.config.update(thing_prefetch_threshold=100, thing_prefetch_types=['sensor'])
+        events = [dict(device_id='thing-{0}'.format(i), sequence=i) for i in range(1, 600, 2)]
+
+        rc = forwarder.iot_custom_event_batch_handler(events, Context())
+
+        self.assertEqual(rc['batchItemFailures'], list())
+        # 300 sensors fetched in 2 pages of 250 instead of 300 describe_thing calls
+        self.assertEqual(state.calls['list_things'], 2)
+        self.assertEqual(state.calls['describe_thing'], 0)
+        # 300 objects created by 4 batch calls, one per creation thread
+        self.assertEqual(state.calls['create_update_objects'], 4)
+        self.assertEqual(len(state.objects), 300)
+        pass
+
+    def test_owners_checked_once_per_username(self):
+        state = self.stub.state
+        state.owners.add('alice')
+        for i in range(40):
+            state.add_thing('thing-{0}'.format(i), 'sensor', dict(owner_username='alice' if i % 2 else 'bob'))
+        events = [dict(device_id='thing-{0}'.format(i), sequence=i) for i in range(40)]
+
+        rc = forwarder.iot_custom_event_batch_handler(events, Context())
+
+        self.assertEqual(rc['batchItemFailures'], list())
+        self.assertEqual(state.calls['owner_exists'], 0)
+        self.assertLessEqual(state.calls['owners_exist'], 4)
+        self.assertEqual(state.objects['thing-1']['x_owner']['username'], 'alice')
+        self.assertNotIn('x_owner', state.objects['thing-0'])
+        # The owners are cached for the next invocations
+        calls = state.calls['owners_exist']
+        forwarder.resolve_owners_exist(['alice', 'bob'])
+        self.assertEqual(state.calls['owners_exist'], calls)
+        pass
+
+    def test_returns_the_records_it_has_no_time_for(self):
+        self.stub.state.latency = 0.1
+        forwarder.config.update(max_in_flight=1, time_budget_safety_margin=1.0)
+        for i in range(3):
+            self.stub.state.objects['thing-{0}'.format(i)] = dict(x_device_id='thing-{0}'.format(i))
+        events = [dict(device_id='thing-{0}'.format(i % 3), sequence=i) for i in range(200)]
+        aggregator = MetricsAggregator()
+        forwarder.metrics.add_sink(aggregator)
+
+        start = time.time()
+        try:
+            rc = forwarder.iot_custom_event_batch_handler(events, Context(remaining=2000))
+        finally:
+            forwarder.metrics.remove_sink(aggregator)
+
+        self.assertLess(time.time() - start, 2.0)
+        failed = sorted(int(f['itemIdentifier']) for f in rc['batchItemFailures'])
+        sent = [e['sequence'] for e in self.stub.state.events]
+        self.assertGreater(len(failed), 0)
+        self.assertGreater(len(sent), 0)
+        self.assertEqual(sorted(failed + sent), list(range(200)))
+        # The first events of each device were sent, the following ones are left for the next invocation
+        for i in range(3):
+            sequence = [s for s in sent if s % 3 == i]
+            self.assertEqual(sequence, list(range(i, 200, 3))[:len(sequence)])
+        self.assertEqual(aggregator.totals()['counters']['records_deferred'], len(failed))
+        pass
@@ -0,0 +1,76 @@
+import io
+import os
+import gzip
+import json
+import unittest
+import requests
+import gateway
+from tests.stubs import StubServer
+
+forwarder = gateway.forwarder
+
+
+class TestGateway(unittest.TestCase):
+    def test_shards_are_stable_and_spread(self):
+        events = [dict(device_id='device-{0}'.format(i)) for i in range(1000)]
+        shards = [gateway.shard_of(e, 4) for e in events]
+        self.assertEqual(shards, [gateway.shard_of(e, 4) for e in events])
+        self.assertTrue(all(shards.count(shard) > 150 for shard in range(4)))
+        self.assertEqual(gateway.shard_of(dict(), 4), 0)
+        self.assertEqual(gateway.shard_of(None, 4), 0)
+        pass
+
+    def test_parse_events(self):
+        self.assertEqual(gateway.parse_events(b'[{"a": 1}, {"a": 2}]'), [dict(a=1), dict(a=2)])
+        self.assertEqual(gateway.parse_events(b'{\n "a": 1\n}'), [dict(a=1)])
+        self.assertEqual(gateway.parse_events(b'{"a": 1}\n\nnot json\n{"a": 2}\n'), [dict(a=1), None, dict(a=2)])
+        self.assertRaises(ValueError, gateway.parse_events, b'[{"a": 1},')
+        pass
+
+
+class TestGatewayWithStubs(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubServer().__enter__()
+        self.saved_config = dict(forwarder.config)
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        forwarder.config.update(environment=self.stub.url, iot_endpoint=self.stub.url, client_id='id',
+                                client_secret='secret', cache_backend='lru', events_batch_size=10)
+        forwarder.reset_state()
+        for i in range(10):
+            self.stub.state.objects['device-{0}'.format(i)] = dict(x_device_id='device-{0}'.format(i))
+        self.gateway = gateway.Gateway(port=0, workers=2, linger=0.001, timeout=10).start()
+
+    def tearDown(self):
+        self.gateway.stop()
+        forwarder.config.update(self.saved_config)
+        forwarder.reset_state()
+        self.stub.__exit__()
+
+    def test_forwards_the_events_of_each_device_in_order(self):
+        lines = [json.dumps(dict(device_id='device-{0}'.format(i % 10), sequence=i)) for i in range(100)]
+        lines[17] = '{"device_id": '
+        lines[42] = json.dumps(dict(sequence=42))
+        session = requests.Session()
+
+        r = session.post(self.gateway.url + '/events/custom', data='\n'.join(lines).encode('utf-8'))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json(), dict(records=100, failed=[17, 42]))
+
+        events = self.stub.state.events
+        self.assertEqual(len(events), 98)
+        for device in range(10):
+            sequence = [e['sequence'] for e in events if e['x_object']['x_device_id'] == 'device-{0}'.format(device)]
+            self.assertEqual(sequence, [i for i in range(device, 100, 10) if i not in (17, 42)])
+
+        body = io.BytesIO()
+        with gzip.GzipFile(fileobj=body, mode='wb') as f:
+            f.write(json.dumps([dict(device_id='device-1', state=dict(reported=dict(temperature=20)))]).encode('utf-8'))
+        r = session.post(self.gateway.url + '/events/shadow', data=body.getvalue(),
+                         headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(r.json(), dict(records=1, failed=[]))
+        self.assertEqual(self.stub.state.events[-1]['temperature'], 20)
+
+        self.assertEqual(session.post(self.gateway.url + '/events/other', data=b'{}').status_code, 404)
+        self.assertEqual(session.post(self.gateway.url + '/events/custom', data=b'[{').status_code, 400)
+        self.assertEqual(session.get(self.gateway.url + '/health').json(), dict(workers=2, alive=2))
+        pass
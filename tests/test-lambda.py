@@ -1,9 +1,19 @@
+import os
 import unittest
+import threading
+import json
+import socket
+import base64
 from mnubo import map_shadow_update_to_mnubo_event
 from mnubo import map_iot_event_to_mnubo_event
 from mnubo import map_thing_to_smart_object
 from mnubo import select_mnubo_env
+from mnubo import extract_batch_records
+from mnubo import decode_batch_record
+from mnubo import AttributeTransformer
+import lambda_mnubo_forwarder as forwarder
 from smartobjects import Environments
+from tests.stubs import StubServer
 
 
 class TestLambda(unittest.TestCase):
@@ -103,6 +113,21 @@ class TestLambda(unittest.TestCase):
         self.assertEqual(result['humidity'], humidity)
         pass
 
+    def test_mappers_do_not_modify_their_input(self):
+        shadow = dict(
+            device_id='1234',
+            state=dict(reported=dict(temperature=32, latitude=45.5, event_id='e1')),
+            metadata=dict(reported=dict(temperature=dict(timestamp=1500000000)), timestamp=1500000000)
+        )
+        event = dict(device_id='1234', event_type='temperature_change', temperature=32, timestamp=1500000000)
+        thing = dict(thingName='1234', attributes=dict(owner_username='yo@yomama.com', model='temperature-thingy'))
+        expected = [repr(shadow), repr(event), repr(thing)]
+        map_shadow_update_to_mnubo_event(shadow)
+        map_iot_event_to_mnubo_event(event)
+        map_thing_to_smart_object(thing=thing)
+        self.assertEqual([repr(shadow), repr(event), repr(thing)], expected)
+        pass
+
     def test_map_to_mnubo_object_with_everything(self):
         device_id = '1234'
         object_type = 'temperatureThing'
@@ -233,3 +258,192 @@ class TestLambda(unittest.TestCase):
         with self.assertRaises(EnvironmentError):
             select_mnubo_env(environment)
         pass
+
+    def test_extract_batch_records_iot_rule_list(self):
+        events = [dict(device_id='1234', temperature=32), dict(device_id='5678', temperature=12)]
+        result = extract_batch_records(events)
+        self.assertEqual([identifier for identifier, _ in result], ['0', '1'])
+        self.assertEqual(decode_batch_record(result[1][1]), events[1])
+        pass
+
+    def test_extract_batch_records_kinesis(self):
+        event = dict(device_id='1234', temperature=32)
+        data = base64.b64encode(json.dumps(event).encode('utf-8')).decode('ascii')
+        batch = dict(Records=[dict(eventSource='aws:kinesis', kinesis=dict(sequenceNumber='42', data=data))])
+        result = extract_batch_records(batch)
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0][0], '42')
+        self.assertEqual(decode_batch_record(result[0][1]), event)
+        pass
+
+    def test_extract_batch_records_sqs(self):
+        event = dict(device_id='1234', temperature=32)
+        batch = dict(Records=[dict(eventSource='aws:sqs', messageId='abc', body=json.dumps(event))])
+        result = extract_batch_records(batch)
+        self.assertEqual(result[0][0], 'abc')
+        self.assertEqual(decode_batch_record(result[0][1]), event)
+        pass
+
+    def test_decode_batch_record_not_an_object(self):
+        record = dict(eventSource='aws:sqs', messageId='abc', body='[1, 2]')
+        with self.assertRaises(ValueError):
+            decode_batch_record(record)
+        pass
+
+    def test_attribute_transformer(self):
+        transformer = AttributeTransformer(mapping=dict(temp='temperature', secret='not_secret'),
+                                           blacklist=['secret', 'device_id'],
+                                           well_known=['device_id', 'latitude'])
+        payload = dict(device_id='1234', latitude=45.5, temp=32, secret='s3cr3t', humidity=0.45)
+        known, custom = transformer.transform(payload)
+        # Well-known fields are not affected by the blacklist
+        self.assertEqual(known, dict(device_id='1234', latitude=45.5))
+        # The blacklist wins over the mapping
+        self.assertEqual(custom, dict(temperature=32, humidity=0.45))
+        # The payload is left untouched
+        self.assertEqual(len(payload), 5)
+        pass
+
+
+class TestObjectsWithStubs(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubServer().__enter__()
+        self.saved_config = dict(forwarder.config)
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'test')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'test')
+        forwarder.config.update(environment=self.stub.url, iot_endpoint=self.stub.url, client_id='id',
+                                client_secret='secret', cache_backend='lru', objects_batch_size=10,
+                                use_object_cache=True, iot_throttling_max_attempts=1, iot_max_attempts=1)
+        forwarder.reset_state()
+        for i in range(0, 25, 2):
+            self.stub.state.objects['device-{0}'.format(i)] = dict(x_device_id='device-{0}'.format(i))
+
+    def tearDown(self):
+        forwarder.config.update(self.saved_config)
+        forwarder.reset_state()
+        self.stub.__exit__()
+
+    def test_looks_up_each_distinct_device_once(self):
+        device_ids = ['device-{0}'.format(i % 25) for i in range(100)]
+
+        rc = forwarder.cached_mnubo_objects_exist(device_ids)
+
+        self.assertEqual(rc, dict(('device-{0}'.format(i), i % 2 == 0) for i in range(25)))
+        looked_up = [d for lookup in self.stub.state.exists_lookups for d in lookup]
+        self.assertEqual(sorted(looked_up), sorted(set(device_ids)))
+        # Only the missing objects are looked up again
+        first_lookups = len(self.stub.state.exists_lookups)
+        forwarder.cached_mnubo_objects_exist(device_ids)
+        looked_up = [d for lookup in self.stub.state.exists_lookups[first_lookups:] for d in lookup]
+        self.assertEqual(sorted(looked_up), sorted('device-{0}'.format(i) for i in range(1, 25, 2)))
+        self.assertEqual(self.stub.state.calls['object_exists'], 0)
+        pass
+
+    def test_looks_up_in_chunks_of_objects_batch_size(self):
+        device_ids = ['device-{0}'.format(i) for i in range(25)]
+
+        rc = forwarder.mnubo_objects_exist(device_ids)
+
+        self.assertEqual(len(rc), 25)
+        self.assertEqual([len(lookup) for lookup in self.stub.state.exists_lookups], [10, 10, 5])
+        self.assertEqual([d for lookup in self.stub.state.exists_lookups for d in lookup], device_ids)
+        forwarder.config.update(objects_batch_size=0)
+        self.assertRaises(ValueError, forwarder.mnubo_objects_exist, device_ids)
+        pass
+
+    def test_reports_the_rejected_objects_only(self):
+        self.stub.state.rejected.add('device-1')
+        mnubo_objects = [map_thing_to_smart_object(dict(thingName='device-{0}'.format(i), thingTypeName='sensor',
+                                                        attributes=dict())) for i in range(3)]
+
+        errors = forwarder.mnubo_create_objects(mnubo_objects)
+
+        self.assertEqual(errors, {'device-1': 'Invalid object'})
+        self.assertIn('device-0', self.stub.state.objects)
+        self.assertIn('device-2', self.stub.state.objects)
+        self.assertNotIn('device-1', self.stub.state.objects)
+        # The single object creation updates an existing object and raises for a rejected one
+        forwarder.mnubo_create_object(mnubo_objects[0])
+        self.assertRaises(ValueError, forwarder.mnubo_create_object, mnubo_objects[1])
+        self.assertEqual(self.stub.state.calls['create_object'], 0)
+        pass
+
+    def test_negative_caches_the_missing_and_rejected_objects(self):
+        state = self.stub.state
+        for name in ('thing-a', 'thing-b'):
+            state.add_thing(name, 'sensor')
+        state.rejected.add('thing-b')
+
+        failed = forwarder.manage_missing_objects(['thing-a', 'thing-b', 'thing-c'])
+
+        self.assertEqual(failed, set(['thing-b', 'thing-c']))
+        self.assertEqual(sorted(forwarder.get_negative_cache().keys()), ['thing-b', 'thing-c'])
+        calls = dict(state.calls)
+        self.assertEqual(forwarder.manage_missing_objects(['thing-b', 'thing-c']), set(['thing-b', 'thing-c']))
+        self.assertRaises(ValueError, forwarder.manage_object, 'thing-c')
+        self.assertEqual(dict(state.calls), calls)
+        pass
+
+    def test_does_not_negative_cache_the_transient_failures(self):
+        state = self.stub.state
+        for name in ('thing-a', 'thing-b'):
+            state.add_thing(name, 'sensor')
+        # The thing definition of thing-a is cached, its creation fails
+        forwarder.get_thing_attributes('thing-a')
+        state.error_rate = 1.0
+
+        self.assertEqual(forwarder.manage_missing_objects(['thing-a', 'thing-b']), set(['thing-a', 'thing-b']))
+        self.assertRaises(Exception, forwarder.create_missing_object, 'thing-a')
+        self.assertEqual(len(forwarder.get_negative_cache()), 0)
+
+        state.error_rate = 0.0
+        self.assertEqual(forwarder.manage_missing_objects(['thing-a', 'thing-b']), set())
+        self.assertIn('thing-b', state.objects)
+        pass
+
+    def test_does_not_negative_cache_an_unreachable_platform(self):
+        self.stub.state.add_thing('thing-a', 'sensor')
+        # Nothing listens on the port of a closed socket
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        forwarder.config.update(environment='http://127.0.0.1:{0}'.format(closed.getsockname()[1]))
+        closed.close()
+
+        self.assertEqual(forwarder.manage_missing_objects(['thing-a']), set(['thing-a']))
+        try:
+            forwarder.create_missing_object('thing-a')
+            self.fail('The creation of thing-a did not fail')
+        except Exception as e:
+            self.assertTrue(forwarder.is_transient_error(e))
+            self.assertFalse(forwarder.is_permanent_creation_error(e))
+        self.assertEqual(len(forwarder.get_negative_cache()), 0)
+        pass
+
+    def test_concurrent_creations_of_a_device_are_coalesced(self):
+        state = self.stub.state
+        state.add_thing('thing-a', 'sensor')
+        state.latency = 0.05
+        errors = list()
+
+        def create(device_id):
+            try:
+                forwarder.create_missing_object(device_id)
+            except Exception as e:
+                errors.append(e)
+
+        for device_id in ('thing-a', 'thing-missing'):
+            threads = [threading.Thread(target=create, args=(device_id,)) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertIn('thing-a', state.objects)
+        self.assertEqual(state.calls['create_update_objects'], 1)
+        # Described once for each device
+        self.assertEqual(state.calls['describe_thing'], 2)
+        self.assertEqual(len(errors), 5)
+        self.assertIn('thing-missing', forwarder.get_negative_cache())
+        self.assertEqual(len(forwarder.pending_creations), 0)
+        pass
@@ -0,0 +1,79 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+from mnubo import parse_mapping_config
+from mnubo import MappingConfigSource
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+class TestMappingConfig(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'mapping.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, doc, mtime):
+        with open(self.path, 'w') as f:
+            json.dump(doc, f)
+        os.utime(self.path, (mtime, mtime))
+
+    def test_parse_mapping_config_json(self):
+        doc = parse_mapping_config('{"event_attributes_mapping": {"temp": "temperature"}}', 'mapping.json')
+        self.assertEqual(doc['event_attributes_mapping'], dict(temp='temperature'))
+        pass
+
+    @unittest.skipIf(yaml is None, 'PyYAML is not installed')
+    def test_parse_mapping_config_yaml(self):
+        content = 'thing_types:\n  sensor:\n    smart_object_attributes_blacklist: [secret]\n'
+        doc = parse_mapping_config(content, 'mapping.yaml')
+        self.assertEqual(doc['thing_types']['sensor']['smart_object_attributes_blacklist'], ['secret'])
+        pass
+
+    def test_parse_mapping_config_invalid(self):
+        with self.assertRaises(ValueError):
+            parse_mapping_config('{"event_attributes_blacklist": "secret"}', 'mapping.json')
+        with self.assertRaises(ValueError):
+            parse_mapping_config('{"event_types": {"alarm": {"event_attributes_mapping": []}}}', 'mapping.json')
+        pass
+
+    def test_mapping_config_source_reloads_on_change(self):
+        self.write(dict(event_attributes_blacklist=['a']), 1000)
+        source = MappingConfigSource(self.path, check_interval=3600)
+        self.assertEqual(source.poll()['event_attributes_blacklist'], ['a'])
+        # Not checked again before the check interval
+        self.write(dict(event_attributes_blacklist=['b']), 2000)
+        self.assertIsNone(source.poll())
+        self.assertEqual(source.poll(force=True)['event_attributes_blacklist'], ['b'])
+        # Unchanged
+        self.assertIsNone(source.poll(force=True))
+        pass
+
+    def test_mapping_config_source_reuses_its_s3_client(self):
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        source = MappingConfigSource('s3://bucket/mapping.json')
+        self.assertIs(source._s3(), source._s3())
+        pass
+
+    def test_function_loads_without_its_mapping_config(self):
+        with open(self.path, 'w') as f:
+            f.write('{"event_attributes_blacklist": ')
+        module_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'mnubo')
+        env = dict(os.environ, PYTHONPATH=module_dir, WARM_CLIENTS='0', METRICS_ENABLED='0',
+                   AWS_DEFAULT_REGION='us-east-1')
+        for location in (self.path, os.path.join(self.tmp_dir, 'missing.json')):
+            env['MAPPING_CONFIG_FILE'] = location
+            script = 'import lambda_mnubo_forwarder as f; print(len(f.iot_event_transformers))'
+            output = subprocess.check_output([sys.executable, '-c', script], env=env, stderr=subprocess.STDOUT)
+            self.assertIn(b'Could not load the mapping configuration', output)
+            self.assertTrue(output.strip().endswith(b'1'))
+        pass
@@ -0,0 +1,61 @@
+import io
+import json
+import unittest
+from mnubo import Metrics
+from mnubo import EMFSink
+from mnubo import MetricsAggregator
+from mnubo import emf_document
+
+
+class TestMetrics(unittest.TestCase):
+    def test_timers_counters_and_sizes(self):
+        metrics = Metrics()
+        with metrics.timer('send_events'):
+            pass
+        with self.assertRaises(ValueError):
+            with metrics.timer('send_events'):
+                raise ValueError('Rejected')
+        metrics.increment('events_sent', 3)
+        metrics.record_size('request_bytes', 100)
+        metrics.record_size('request_bytes', 300)
+
+        snapshot = metrics.flush()
+        self.assertEqual(snapshot['timers']['send_events']['count'], 2)
+        self.assertEqual(snapshot['counters'], dict(events_sent=3, send_events_errors=1))
+        self.assertEqual(snapshot['sizes']['request_bytes'], dict(count=2, total=400, max=300))
+        # Flushing starts over
+        self.assertEqual(metrics.snapshot(), dict(timers=dict(), counters=dict(), sizes=dict()))
+        pass
+
+    def test_emf_document(self):
+        snapshot = dict(timers=dict(map=dict(count=2, total_ms=1.5, max_ms=1.0)), counters=dict(records=2),
+                        sizes=dict(request_bytes=dict(count=1, total=10, max=10)))
+        doc = emf_document(snapshot, 'mnubo/forwarder', dict(FunctionName='forwarder'), timestamp=1500000000)
+        self.assertEqual(doc['_aws']['Timestamp'], 1500000000000)
+        directive = doc['_aws']['CloudWatchMetrics'][0]
+        self.assertEqual(directive['Namespace'], 'mnubo/forwarder')
+        self.assertEqual(directive['Dimensions'], [['FunctionName']])
+        for definition in directive['Metrics']:
+            self.assertIn(definition['Name'], doc)
+        self.assertEqual(doc['map_ms'], 1.5)
+        self.assertEqual(doc['records'], 2)
+        self.assertEqual(doc['request_bytes'], 10)
+        self.assertEqual(doc['FunctionName'], 'forwarder')
+        pass
+
+    def test_one_line_per_flush(self):
+        stream = io.StringIO()
+        aggregator = MetricsAggregator()
+        metrics = Metrics()
+        metrics.add_sink(EMFSink('mnubo/forwarder', stream=stream))
+        metrics.add_sink(aggregator)
+        for _ in range(3):
+            for _ in range(10):
+                metrics.increment('records')
+            metrics.flush(FunctionName='forwarder')
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(json.loads(lines[0])['records'], 10)
+        self.assertEqual(aggregator.totals()['counters']['records'], 30)
+        self.assertEqual(aggregator.totals()['flushes'], 3)
+        pass
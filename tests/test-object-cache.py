@@ -0,0 +1,207 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+from mnubo import LRUObjectCache
+from mnubo import CompactObjectCache
+from mnubo import SqliteObjectCache
+from mnubo import RedisObjectCache
+from mnubo import TieredObjectCache
+from mnubo import build_object_cache
+from mnubo import object_fingerprint
+
+
+class FakeRedis(object):
+    """ Keeps the values and the TTLs of the keys, as bytes like Redis returns them. """
+    def __init__(self):
+        self.values = dict()
+        self.ttls = dict()
+
+    def get(self, key):
+        return self.values.get(key, None)
+
+    def mget(self, keys):
+        return [self.values.get(key, None) for key in keys]
+
+    def set(self, key, value, ex=None):
+        self.values[key] = str(value).encode('utf-8')
+        self.ttls[key] = ex
+
+    def expire(self, key, seconds):
+        if key in self.values:
+            self.ttls[key] = seconds
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+    def __init__(self, client):
+        self.client = client
+        self.commands = list()
+
+    def set(self, *args, **kwargs):
+        self.commands.append((self.client.set, args, kwargs))
+
+    def expire(self, *args):
+        self.commands.append((self.client.expire, args, dict()))
+
+    def execute(self):
+        for command, args, kwargs in self.commands:
+            command(*args, **kwargs)
+        self.commands = list()
+
+
+class TestObjectCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, 'objects.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lru_object_cache(self):
+        cache = LRUObjectCache(2)
+        cache.set('a', 10)
+        cache.set_many(dict(b=20, c=30))
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get_many(['a', 'b', 'c']), dict(b=20, c=30))
+        pass
+
+    def test_compact_object_cache(self):
+        now = int(time.time())
+        cache = CompactObjectCache(1024 * 1024)
+        for i in range(1000):
+            cache.set('device-{0}'.format(i), now + 3600)
+        for i in range(1000):
+            found = cache.get('device-{0}'.format(i))
+            # Expirations are rounded down to the resolution
+            self.assertTrue(now + 3600 - 60 < found <= now + 3600)
+        self.assertIsNone(cache.get('unknown'))
+        pass
+
+    def test_compact_object_cache_evicts_when_full(self):
+        now = int(time.time())
+        cache = CompactObjectCache(CompactObjectCache.SLOT_SIZE * 8, resolution=1)
+        for i in range(8):
+            cache.set('device-{0}'.format(i), now + 100 + i)
+        cache.set('new', now + 1000)
+        self.assertEqual(cache.get('new'), now + 1000)
+        # The entry expiring first was evicted
+        self.assertIsNone(cache.get('device-0'))
+        self.assertEqual(cache.get('device-7'), now + 107)
+        pass
+
+    def test_compact_object_cache_lookups_wait_for_the_writes(self):
+        expires_at = int(time.time()) + 3600
+        cache = CompactObjectCache(1024, resolution=1)
+        cache.set('a', expires_at)
+        cache.set_fingerprints(dict(a=1))
+        found = list()
+
+        def read():
+            found.append(cache.get('a'))
+            found.append(cache.get_fingerprints(['a']))
+
+        # A slot is written in several arrays: the lookups must not run in the middle of a set
+        with cache.lock:
+            reader = threading.Thread(target=read)
+            reader.start()
+            reader.join(0.1)
+            self.assertTrue(reader.is_alive())
+            self.assertEqual(found, list())
+        reader.join()
+        self.assertEqual(found, [expires_at, dict(a=1)])
+        pass
+
+    def test_sqlite_object_cache_is_shared(self):
+        cache = SqliteObjectCache(self.db_path)
+        cache.set_many(dict(a=10, b=20))
+        other = SqliteObjectCache(self.db_path)
+        self.assertEqual(other.get('a'), 10)
+        self.assertEqual(other.get_many(['a', 'b', 'c']), dict(a=10, b=20))
+        self.assertIsNone(other.get('c'))
+        pass
+
+    def test_tiered_object_cache_read_through(self):
+        expires_at = int(time.time()) + 3600
+        shared = SqliteObjectCache(self.db_path)
+        shared.set('a', expires_at)
+        local = LRUObjectCache(10)
+        cache = TieredObjectCache(local, shared)
+        self.assertEqual(cache.get('a'), expires_at)
+        # The shared hit is copied in the local tier with the same expiration
+        self.assertEqual(local.get('a'), expires_at)
+        cache.set('b', expires_at)
+        self.assertEqual(shared.get('b'), expires_at)
+        pass
+
+    def test_tiered_object_cache_ignores_expired_local_entries(self):
+        now = int(time.time())
+        shared = SqliteObjectCache(self.db_path)
+        shared.set('a', now + 3600)
+        local = LRUObjectCache(10)
+        local.set('a', now - 1)
+        cache = TieredObjectCache(local, shared)
+        self.assertEqual(cache.get_many(['a']), dict(a=now + 3600))
+        self.assertEqual(local.get('a'), now + 3600)
+        pass
+
+    def test_fingerprints_are_kept_next_to_the_entries(self):
+        expires_at = int(time.time()) + 3600
+        a = object_fingerprint(dict(x_device_id='a', x_object_type='sensor', model='m1'))
+        self.assertEqual(a, object_fingerprint(dict(model='m1', x_object_type='sensor', x_device_id='a')))
+        self.assertNotEqual(a, object_fingerprint(dict(x_device_id='a', x_object_type='sensor', model='m2')))
+        self.assertTrue(0 < a < 2 ** 63)
+
+        for cache in (LRUObjectCache(10), CompactObjectCache(1024), SqliteObjectCache(self.db_path),
+                      RedisObjectCache(None, client=FakeRedis()),
+                      TieredObjectCache(LRUObjectCache(10), SqliteObjectCache(self.db_path + '.shared'))):
+            self.assertEqual(cache.get_fingerprints(['a']), dict())
+            cache.set_many(dict(a=expires_at, b=expires_at))
+            cache.set_fingerprints(dict(a=a, b=2))
+            cache.set('a', expires_at + 60)
+            self.assertEqual(cache.get_fingerprints(['a', 'b', 'c']), dict(a=a, b=2))
+            # Rounded down by the compact cache
+            self.assertTrue(expires_at < cache.get('a') <= expires_at + 60)
+
+        # Evicted with their entry
+        cache = CompactObjectCache(CompactObjectCache.SLOT_SIZE * 8, resolution=1)
+        for i in range(8):
+            cache.set('device-{0}'.format(i), expires_at + i)
+        cache.set_fingerprints(dict(('device-{0}'.format(i), i + 1) for i in range(8)))
+        cache.set('new', expires_at + 100)
+        self.assertEqual(cache.get_fingerprints(['device-0', 'new']), dict())
+        self.assertEqual(cache.get_fingerprints(['device-7']), {'device-7': 8})
+        pass
+
+    def test_redis_fingerprints_expire_with_their_entry(self):
+        now = int(time.time())
+        client = FakeRedis()
+        cache = RedisObjectCache(None, client=client)
+        cache.set_many(dict(a=now + 3600, b=now - 1))
+        self.assertEqual(cache.get_many(['a', 'b']), dict(a=now + 3600))
+
+        cache.set_fingerprints(dict(a=1, b=2, c=3))
+
+        # Only stored for the cached devices, with the TTL of their entry
+        self.assertEqual(cache.get_fingerprints(['a', 'b', 'c']), dict(a=1))
+        self.assertAlmostEqual(client.ttls['mnubo:fingerprint:a'], 3600, delta=2)
+        # Extended with their entry
+        cache.set('a', now + 7200)
+        self.assertAlmostEqual(client.ttls['mnubo:object:a'], 7200, delta=2)
+        self.assertAlmostEqual(client.ttls['mnubo:fingerprint:a'], 7200, delta=2)
+        self.assertNotIn('mnubo:fingerprint:b', client.ttls)
+        pass
+
+    def test_build_object_cache(self):
+        self.assertIsInstance(build_object_cache('lru', 10), LRUObjectCache)
+        self.assertIsInstance(build_object_cache('compact', 10, max_memory=1024), CompactObjectCache)
+        self.assertIsInstance(build_object_cache('sqlite', 10, url=self.db_path), TieredObjectCache)
+        self.assertIsInstance(build_object_cache('sqlite', 10, url=self.db_path, local_tier=False),
+                              SqliteObjectCache)
+        with self.assertRaises(EnvironmentError):
+            build_object_cache('foo', 10)
+        pass
@@ -0,0 +1,98 @@
+import os
+import unittest
+from mnubo import MetricsAggregator
+import lambda_mnubo_forwarder as forwarder
+from tests.stubs import StubServer
+
+
+class Context(object):
+    function_name = 'test'
+
+    def __init__(self, remaining=60000):
+        self.remaining = remaining
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining
+
+
+class TestObjectSyncWithStubs(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubServer().__enter__()
+        self.saved_config = dict(forwarder.config)
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'test')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'test')
+        forwarder.config.update(environment=self.stub.url, iot_endpoint=self.stub.url, client_id='id',
+                                client_secret='secret', cache_backend='lru', attribute_sync=True,
+                                thing_cache_validity_period=0)
+        forwarder.reset_state()
+
+    def tearDown(self):
+        forwarder.config.update(self.saved_config)
+        forwarder.reset_state()
+        self.stub.__exit__()
+
+    def run_handler(self, handler, event, context=None):
+        aggregator = MetricsAggregator()
+        forwarder.metrics.add_sink(aggregator)
+        try:
+            rc = handler(event, context or Context())
+        finally:
+            forwarder.metrics.remove_sink(aggregator)
+        return rc, aggregator.totals()['counters']
+
+    def test_batch_handler_only_updates_the_changed_objects(self):
+        state = self.stub.state
+        for i in range(4):
+            state.add_thing('thing-{0}'.format(i), 'sensor', dict(model='m1'))
+        # Created before the sync was enabled: sent once to get its fingerprint
+        state.objects['thing-3'] = dict(x_device_id='thing-3', x_object_type='sensor')
+        events = [dict(device_id='thing-{0}'.format(i % 4), sequence=i) for i in range(20)]
+
+        rc, counters = self.run_handler(forwarder.iot_custom_event_batch_handler, events)
+        self.assertEqual(rc['batchItemFailures'], list())
+        self.assertEqual(counters['objects_created'], 3)
+        self.assertEqual(counters['objects_updated'], 1)
+        self.assertEqual(state.objects['thing-3']['model'], 'm1')
+
+        # The existence is still cached, the things are described again
+        calls = state.calls['create_update_objects']
+        rc, counters = self.run_handler(forwarder.iot_custom_event_batch_handler, events)
+        self.assertEqual(counters['objects_unchanged'], 4)
+        self.assertNotIn('objects_updated', counters)
+        self.assertEqual(state.calls['create_update_objects'], calls)
+
+        state.things['thing-1']['attributes']['model'] = 'm2'
+        rc, counters = self.run_handler(forwarder.iot_custom_event_batch_handler, events)
+        self.assertEqual(counters['objects_updated'], 1)
+        self.assertEqual(counters['objects_unchanged'], 3)
+        self.assertEqual(state.objects['thing-1']['model'], 'm2')
+        self.assertEqual(len(state.events), 60)
+        pass
+
+    def test_registry_sync_sends_only_the_changed_objects(self):
+        state = self.stub.state
+        for i in range(600):
+            state.add_thing('thing-{0:03d}'.format(i), 'sensor' if i % 2 else 'gateway', dict(model='m1'))
+
+        rc, counters = self.run_handler(forwarder.sync_objects_handler, dict())
+        self.assertEqual(rc, dict(things=600, updated=600, failed=0, nextToken=None))
+        self.assertEqual(state.calls['list_things'], 3)
+        self.assertEqual(len(state.objects), 600)
+
+        state.things['thing-001']['attributes']['model'] = 'm2'
+        state.things['thing-400']['attributes']['model'] = 'm2'
+        calls = state.calls['create_update_objects']
+        rc, counters = self.run_handler(forwarder.sync_objects_handler, dict(thingTypeName='sensor'))
+        self.assertEqual(rc, dict(things=300, updated=1, failed=0, nextToken=None))
+        self.assertEqual(counters['objects_unchanged'], 299)
+        self.assertEqual(state.calls['create_update_objects'], calls + 1)
+        self.assertEqual(state.objects['thing-001']['model'], 'm2')
+        self.assertEqual(state.objects['thing-400']['model'], 'm1')
+
+        # No page is started without the time to do it, the sync resumes from the token
+        rc, _ = self.run_handler(forwarder.sync_objects_handler, dict(nextToken='250'), Context(remaining=1000))
+        self.assertEqual(rc, dict(things=0, updated=0, failed=0, nextToken='250'))
+        rc, _ = self.run_handler(forwarder.sync_objects_handler, dict(nextToken='250'))
+        self.assertEqual(rc, dict(things=350, updated=1, failed=0, nextToken=None))
+        pass
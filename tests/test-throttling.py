@@ -0,0 +1,83 @@
+import os
+import unittest
+from botocore.exceptions import ClientError
+from botocore.exceptions import EndpointConnectionError
+from mnubo import AdaptiveBackoff
+import lambda_mnubo_forwarder as forwarder
+
+
+class Throttled(Exception):
+    pass
+
+
+class TestAdaptiveBackoff(unittest.TestCase):
+    def test_retries_throttled_calls(self):
+        calls = list()
+
+        def call(value):
+            calls.append(value)
+            if len(calls) < 3:
+                raise Throttled()
+            return value
+
+        backoff = AdaptiveBackoff(lambda e: isinstance(e, Throttled), max_attempts=5, initial_delay=0.001)
+        self.assertEqual(backoff.call(call, 42), 42)
+        self.assertEqual(len(calls), 3)
+        # The delay decreases after a successful call
+        self.assertLess(backoff.delay, 0.004)
+        pass
+
+    def test_gives_up_after_max_attempts(self):
+        def call():
+            raise Throttled()
+
+        backoff = AdaptiveBackoff(lambda e: isinstance(e, Throttled), max_attempts=3, initial_delay=0.001)
+        with self.assertRaises(Throttled):
+            backoff.call(call)
+        self.assertEqual(backoff.delay, 0.002)
+        pass
+
+    def test_does_not_retry_other_errors(self):
+        calls = list()
+
+        def call():
+            calls.append(1)
+            raise ValueError()
+
+        backoff = AdaptiveBackoff(lambda e: isinstance(e, Throttled), initial_delay=0.001)
+        with self.assertRaises(ValueError):
+            backoff.call(call)
+        self.assertEqual(len(calls), 1)
+        pass
+
+
+class TestIotRetries(unittest.TestCase):
+    def setUp(self):
+        self.saved_config = dict(forwarder.config)
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        forwarder.reset_state()
+
+    def tearDown(self):
+        forwarder.config.update(self.saved_config)
+        forwarder.reset_state()
+
+    def test_the_sdk_does_not_retry_under_the_backoff(self):
+        forwarder.config.update(iot_max_attempts=5, iot_throttling_max_attempts=5)
+        self.assertEqual(forwarder.get_aws_iot_client().meta.config.retries['total_max_attempts'], 1)
+
+        forwarder.reset_state()
+        forwarder.config.update(iot_throttling_max_attempts=1)
+        self.assertEqual(forwarder.get_aws_iot_client().meta.config.retries['total_max_attempts'], 5)
+        pass
+
+    def test_the_backoff_retries_what_the_sdk_would(self):
+        def client_error(code, status):
+            return ClientError(dict(Error=dict(Code=code), ResponseMetadata=dict(HTTPStatusCode=status)),
+                               'DescribeThing')
+
+        self.assertTrue(forwarder.is_retryable_iot_error(client_error('ThrottlingException', 400)))
+        self.assertTrue(forwarder.is_retryable_iot_error(client_error('ServiceUnavailableException', 503)))
+        self.assertTrue(forwarder.is_retryable_iot_error(EndpointConnectionError(endpoint_url='https://iot')))
+        self.assertFalse(forwarder.is_retryable_iot_error(client_error('ResourceNotFoundException', 404)))
+        self.assertFalse(forwarder.is_retryable_iot_error(ValueError()))
+        pass
@@ -0,0 +1,45 @@
+import unittest
+from mnubo import CostEstimator
+from mnubo import TimeBudget
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTimeBudget(unittest.TestCase):
+    def test_estimates_the_cost_per_record(self):
+        estimator = CostEstimator()
+        self.assertEqual(estimator.estimate('send_events', 100), 0.0)
+        for _ in range(50):
+            estimator.record('send_events', 10, 0.1)
+        # Steady costs: the deviation vanishes
+        self.assertAlmostEqual(estimator.estimate('send_events', 100), 1.0, places=2)
+        # Variable costs make the estimates more cautious
+        for i in range(50):
+            estimator.record('create_objects', 10, 0.05 if i % 2 else 0.15)
+        self.assertGreater(estimator.estimate('create_objects', 100), 1.5)
+        pass
+
+    def test_stops_admitting_once_out_of_time(self):
+        clock = FakeClock()
+        estimator = CostEstimator()
+        estimator.record('send_events', 10, 1.0)
+        budget = TimeBudget(clock.now + 10.0, estimator, safety_margin=2.0, clock=clock)
+
+        # 1.5 seconds expected for 10 records
+        self.assertTrue(budget.admit('send_events', 10))
+        clock.now += 6.0
+        self.assertTrue(budget.admit('send_events', 1))
+        self.assertFalse(budget.admit('send_events', 10))
+        # Smaller work is not admitted after a refusal
+        self.assertFalse(budget.admit('send_events', 1))
+        budget.defer(10)
+        budget.defer(1)
+        self.assertEqual(budget.deferred, 11)
+        self.assertAlmostEqual(budget.remaining(), 4.0)
+        pass
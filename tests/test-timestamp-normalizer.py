@@ -0,0 +1,52 @@
+import sys
+import datetime
+import unittest
+from mnubo import normalize_timestamp
+from mnubo import normalize_timestamps
+from lambda_mnubo_forwarder import standardize_timestamp
+
+
+class TestTimestampNormalizer(unittest.TestCase):
+    def test_epoch_units(self):
+        self.assertEqual(normalize_timestamp(1500000000), '2017-07-14T02:40:00')
+        self.assertEqual(normalize_timestamp(1500000000123), '2017-07-14T02:40:00.123000')
+        self.assertEqual(normalize_timestamp(1500000000123456), '2017-07-14T02:40:00.123456')
+        self.assertEqual(normalize_timestamp(1500000000123456789), '2017-07-14T02:40:00.123456')
+        self.assertEqual(normalize_timestamp(1500000000123.5), '2017-07-14T02:40:00.123500')
+        self.assertEqual(standardize_timestamp(1500000000000), '2017-07-14T02:40:00')
+        pass
+
+    def test_strings(self):
+        self.assertEqual(normalize_timestamp('1500000000000'), '2017-07-14T02:40:00')
+        self.assertEqual(normalize_timestamp('1500000000.25'), '2017-07-14T02:40:00.250000')
+        self.assertEqual(normalize_timestamp('2017-07-14T02:40:00+00:00'), '2017-07-14T02:40:00+00:00')
+        self.assertIsNone(normalize_timestamp(None))
+        pass
+
+    def test_same_as_utcfromtimestamp_for_seconds(self):
+        for ts in (0, -1, -0.5, 1500000000.5, 1500000000.0000005, 1500000000.9999996, 2092964762.4868326):
+            expected = (datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=ts)).isoformat()
+            self.assertEqual(normalize_timestamp(ts), expected)
+        pass
+
+    def test_batch_same_as_scalar(self):
+        values = [1500000000 + i for i in range(300)] + [1500000000123 + i for i in range(300)] + \
+                 [1500000000.5, 1500000000123456789, '2017-07-14T02:40:00', None, True]
+        expected = [normalize_timestamp(ts) for ts in values]
+        self.assertEqual(normalize_timestamps(values), expected)
+        # Without NumPy as well
+        timestamp_normalizer = sys.modules[normalize_timestamps.__module__]
+        saved = timestamp_normalizer.numpy_module
+        try:
+            timestamp_normalizer.numpy_module = False
+            self.assertEqual(normalize_timestamps(values), expected)
+        finally:
+            timestamp_normalizer.numpy_module = saved
+        pass
+
+    def test_batch_raises_on_the_invalid_timestamps(self):
+        for invalid in (10 ** 25, -10 ** 25, float('nan'), float('inf'), 1e300):
+            for size in (1, 300):
+                values = [1500000000 + i for i in range(size - 1)] + [invalid]
+                self.assertRaises((ValueError, OverflowError), normalize_timestamps, values)
+        pass